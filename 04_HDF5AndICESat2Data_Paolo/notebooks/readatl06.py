@@ -20,23 +20,53 @@ except:
     print('No GDAL, proceeding without it!')
 
 
-def segDifferenceFilter(dh_fit_dx, h_li, tol=2):
-
-    dAT=20.
+def segDifferenceFilter(dh_fit_dx, h_li, tol=2, dAT=20., track=None):
+    """
+        Segment difference filter for ATL06 data.
+        
+        Flags segments whose end-points differ from the centre height of
+        their along-track neighbours by more than tol. Works on arrays
+        concatenated from several beams/granules: neighbours are only
+        compared when they share the same 'track' id (e.g. beam or
+        granule number), so no difference is taken across a boundary.
+        Tracks shorter than 3 segments are kept (all True).
+    """
     
-    if h_li.shape[0] < 3:
-        mask = np.ones_like(h_li, dtype=bool)
-        return mask
-
+    # Make sure we have arrays
+    h_li = np.asarray(h_li)
+    dh_fit_dx = np.asarray(dh_fit_dx)
+    
+    # Number of segments
+    n = h_li.shape[0]
+    
+    # Test for no data
+    if n == 0:
+        return np.ones_like(h_li, dtype=bool)
+    
+    # Neighbours on the same track (boundary markers)
+    if track is None:
+        same = np.ones(n - 1, dtype=bool)
+    else:
+        track = np.asarray(track)
+        same = track[1:] == track[:-1]
+    
+    # Segment end-points (segments overlap by dAT)
     EPplus  = h_li + dAT * dh_fit_dx
     EPminus = h_li - dAT * dh_fit_dx
-
-    segDiff       = np.zeros_like(h_li)
-    segDiff[0:-1] = np.abs(EPplus[0:-1] - h_li[1:])
-    segDiff[1:]   = np.maximum(segDiff[1:], np.abs(h_li[0:-1] - EPminus[1:]))
     
-    mask = segDiff < tol
-
+    # Largest end-point difference to each neighbour
+    segDiff       = np.zeros_like(h_li, dtype=np.float64)
+    segDiff[0:-1] = np.where(same, np.abs(EPplus[0:-1] - h_li[1:]), 0)
+    segDiff[1:]   = np.maximum(segDiff[1:],
+                        np.where(same, np.abs(h_li[0:-1] - EPminus[1:]), 0))
+    
+    # Length of the track each segment belongs to
+    i_start = np.r_[0, np.flatnonzero(~same) + 1]
+    n_track = np.diff(np.r_[i_start, n])
+    
+    # Keep all segments on tracks too short to filter
+    mask = (segDiff < tol) | (np.repeat(n_track, n_track) < 3)
+    
     return mask
 
 def gps2dyr(time):
@@ -150,9 +180,160 @@ def geotiffread(ifile,metaData):
     return X, Y, Z, dx, dy, proj
 
 
+class RasterStencil(object):
+    """Sampling weights of a set of points on a raster (see RasterSampler.stencil).
+    
+    Built once, it samples the same points on any number of rasters of
+    the same grid.
+    """
+    
+    def __init__(self, shape, k, u=None, v=None, valid=None):
+        self.shape = shape
+        # Flat index of the lower-left node (nearest node for u = None)
+        self.k = k
+        # Fractional offsets along the columns and rows
+        self.u = u
+        self.v = v
+        self.valid = valid
+    
+    def apply(self, z, fill=np.nan):
+        """Sample z (ny, nx) or a stack (..., ny, nx) at the stencil points."""
+        
+        z = np.asarray(z)
+        
+        assert z.shape[-2:] == self.shape
+        
+        ny, nx = self.shape
+        
+        # Flat view of each raster (no copy for contiguous input)
+        zf = z.reshape(z.shape[:-2] + (ny * nx,))
+        
+        if self.u is None:
+            zi = zf[..., self.k].astype('float64')
+        else:
+            k, u, v = self.k, self.u, self.v
+            zi = zf[..., k] * ((1 - u) * (1 - v))
+            zi += zf[..., k + 1] * (u * (1 - v))
+            zi += zf[..., k + nx] * ((1 - u) * v)
+            zi += zf[..., k + nx + 1] * (u * v)
+        
+        zi[..., ~self.valid] = fill
+        
+        return zi
+
+
+class RasterSampler(object):
+    """Point sampling of a regular raster (e.g. from geotiffread).
+    
+    Same interface as RasterSampler in the gridding tutorial utils.
+    x/y are the 2D node coordinates (or the 1D axes) of z. The affine
+    mapping from x/y to columns/rows keeps the sign of the steps, so z
+    is sampled as stored (no flipped copies, whatever its orientation).
+    """
+    
+    def __init__(self, x, y, z=None):
+        
+        x = np.asarray(x)
+        y = np.asarray(y)
+        
+        # Axes of the grid
+        x = x[0, :] if x.ndim == 2 else x
+        y = y[:, 0] if y.ndim == 2 else y
+        
+        self.nx, self.ny = x.size, y.size
+        
+        assert self.nx > 1 and self.ny > 1
+        
+        # Origin and (signed) step of the columns and rows
+        self.x0, self.y0 = x[0], y[0]
+        self.dx = (x[-1] - x[0]) / (self.nx - 1.)
+        self.dy = (y[-1] - y[0]) / (self.ny - 1.)
+        
+        self.z = None if z is None else np.ascontiguousarray(z)
+        
+        if self.z is not None: assert self.z.shape[-2:] == (self.ny, self.nx)
+    
+    def coords(self, xi, yi):
+        """Fractional column and row of points."""
+        
+        return (np.asarray(xi, dtype='float64') - self.x0) / self.dx, \
+               (np.asarray(yi, dtype='float64') - self.y0) / self.dy
+    
+    def stencil(self, xi, yi, method='linear'):
+        """Stencil of points for repeated sampling ('linear' or 'nearest')."""
+        
+        # Scalars are broadcast against arrays
+        xi, yi = np.broadcast_arrays(np.asarray(xi, dtype='float64'),
+                                     np.asarray(yi, dtype='float64'))
+        
+        c, r = self.coords(xi.ravel(), yi.ravel())
+        
+        # Points outside the grid are filled
+        valid = (c >= 0) & (c <= self.nx - 1) & (r >= 0) & (r <= self.ny - 1)
+        c[~valid] = 0
+        r[~valid] = 0
+        
+        if method == 'nearest':
+            i = np.floor(c + 0.5).astype(int)
+            j = np.floor(r + 0.5).astype(int)
+            return RasterStencil((self.ny, self.nx), j * self.nx + i, valid=valid)
+        
+        elif method == 'linear':
+            # Last column/row uses the cell before it
+            i = np.minimum(np.floor(c).astype(int), self.nx - 2)
+            j = np.minimum(np.floor(r).astype(int), self.ny - 2)
+            return RasterStencil((self.ny, self.nx), j * self.nx + i, c - i, r - j, valid)
+        
+        else:
+            raise ValueError("method must be 'linear' or 'nearest'")
+    
+    def sample(self, xi, yi, z=None, method='linear', fill=np.nan, size=int(1e6)):
+        """Sample z (default the raster of the sampler) at points xi/yi.
+        
+        z may be a stack (..., ny, nx). Points are done size at a time to
+        bound the temporary arrays. Returns values shaped like xi/yi.
+        """
+        
+        z = self.z if z is None else np.asarray(z)
+        
+        xi, yi = np.broadcast_arrays(np.asarray(xi, dtype='float64'),
+                                     np.asarray(yi, dtype='float64'))
+        shape = xi.shape
+        xi, yi = xi.ravel(), yi.ravel()
+        
+        zi = np.empty(z.shape[:-2] + (len(xi),))
+        
+        for i0 in range(0, len(xi), size):
+            block = slice(i0, min(i0 + size, len(xi)))
+            zi[..., block] = self.stencil(xi[block], yi[block], method).apply(z, fill)
+        
+        return zi.reshape(z.shape[:-2] + shape)
+    
+    __call__ = sample
+
+
+def as_raster_type(zi, dtype):
+    """Sampled values in the type of the raster, integers rounded (as map_coordinates)."""
+    
+    if np.dtype(dtype).kind in 'iub':
+        return np.trunc(zi + np.copysign(0.5, zi)).astype(dtype)
+    
+    return zi
+
+
 def bilinear2d(xd,yd,data,xq,yq, **kwargs):
     """Bilinear interpolation from grid."""
     
+    order = kwargs.get('order', 3)
+    
+    # Nearest/bilinear directly (same result as map_coordinates with mode='constant')
+    if order in (0, 1) and kwargs.get('mode', 'constant') == 'constant' and \
+            set(kwargs) <= {'order', 'mode', 'cval'}:
+        sampler = RasterSampler(xd, yd, data)
+        zq = sampler.sample(xq, yq, method='linear' if order else 'nearest',
+                            fill=kwargs.get('cval', 0.0))
+        return as_raster_type(zq, sampler.z.dtype)
+    
     xd = np.flipud(xd)
     yd = np.flipud(yd)
     data = np.flipud(data)
@@ -167,9 +348,9 @@ def bilinear2d(xd,yd,data,xq,yq, **kwargs):
     assert (xd[-1] > xd[0]) and (yd[-1] > yd[0])
     
     if np.size(xq) == 1 and np.size(yq) > 1:
-        xq = xq*ones(yq.size)
+        xq = xq*np.ones(yq.size)
     elif np.size(yq) == 1 and np.size(xq) > 1:
-        yq = yq*ones(xq.size)
+        yq = yq*np.ones(xq.size)
     
     xp = (xq-xd[0])*(nx-1)/(xd[-1]-xd[0])
     yp = (yq-yd[0])*(ny-1)/(yd[-1]-yd[0])
@@ -272,6 +453,9 @@ if fmask is not None:
         Xm = Fmask['X'][:]
         Ym = Fmask['Y'][:]
         Zm = Fmask['Z'][:]
+    
+    # Set up mask sampling once for all files
+    Sm = RasterSampler(Xm, Ym, Zm)
 
 # Loop trough and open files
 def main(ifile, n=''):
@@ -370,7 +554,7 @@ def main(ifile, n=''):
                 x, y = lon, lat
         
             # Interpolation of grid to points for masking
-            i_m = bilinear2d(Xm, Ym, Zm, x.T, y.T, order=1)
+            i_m = as_raster_type(Sm.sample(x.T, y.T, fill=0.0), Sm.z.dtype)
         
             # Set all NaN's to zero
             i_m[np.isnan(i_m)] = 0
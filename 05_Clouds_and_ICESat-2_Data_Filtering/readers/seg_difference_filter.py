@@ -0,0 +1,75 @@
+import numpy as np
+
+
+def concatenate_D6(D6_list, fields=None):
+    """
+        Concatenate a list of ATL06 dictionaries (from ATL06_to_dict) into one
+
+        Input arguments:
+            D6_list: list of ATL06 dictionaries, one per beam (and per granule)
+            fields: datasets to concatenate.  If None, every array-valued
+                    entry of the first dictionary is used
+        Output argument:
+            D6: dictionary of concatenated arrays.  The 'track' entry gives,
+                for each segment, the index of the dictionary it came from,
+                and marks the beam/granule boundaries for the filters below
+    """
+    if fields is None:
+        fields=[key for key, val in D6_list[0].items() if isinstance(val, np.ndarray)]
+    D6={}
+    for field in fields:
+        D6[field]=np.concatenate([Di[field] for Di in D6_list])
+    D6['track']=np.concatenate([np.zeros(Di['h_li'].size, dtype=int)+ind for ind, Di in enumerate(D6_list)])
+    return D6
+
+
+def seg_difference_filter(D6, tol=2, seg_spacing=20., track=None):
+    """
+        seg_difference_filter: Use elevations and slopes to find bad ATL06 segments
+
+        Runs in one pass over data from any number of beams and granules
+        concatenated together.  Neighbors are only compared if they are on
+        the same track, so segments on either side of a beam or granule
+        boundary are never differenced against each other.
+
+        Inputs:
+            D6: ATL06 data, in dictionary format.  Must have entries:
+                h_li, dh_fit_dx
+            tol: a tolerance.  Segments whose ends are different from their neighbors
+                 by more than tol are marked as bad
+            seg_spacing: along-track distance between segment centers (20 m for ATL06).
+                 Each segment's endpoints fall on its neighbors' centers.
+            track: an array the same size as D6['h_li'] giving a track identifier
+                 (e.g. beam or granule number) for each segment.  Defaults to
+                 D6['track'] if present (see concatenate_D6), otherwise all segments
+                 are treated as one track.
+        Returns:
+            good: an array the same size as D6['h_li'].  True  entries indicate that
+                both ends of the segment are compatible with the segment's neighbors.
+                Segments on tracks with fewer than 3 segments are always good.
+            delta_h_seg: an array the same size as D6['h_li'].  Gives the largest
+                endpoint difference for each segment
+    """
+    h_li=np.asarray(D6['h_li'])
+    dh_fit_dx=np.asarray(D6['dh_fit_dx'])
+    if track is None:
+        track=D6.get('track', None)
+    # same_track[i] is True if segment i and segment i+1 can be compared
+    if track is None:
+        same_track=np.ones(max(h_li.size-1, 0), dtype=bool)
+    else:
+        track=np.asarray(track)
+        same_track=track[1:]==track[:-1]
+    # heights of the segment endpoints
+    h_ep=np.zeros([2, h_li.size])
+    h_ep[0, :]=h_li-dh_fit_dx*seg_spacing
+    h_ep[1, :]=h_li+dh_fit_dx*seg_spacing
+    # difference between each endpoint and the center of the neighbor it falls on
+    delta_h_seg=np.zeros(h_li.size)
+    delta_h_seg[:-1]=np.where(same_track, np.abs(h_ep[1, :-1]-h_li[1:]), 0)
+    delta_h_seg[1:]=np.maximum(delta_h_seg[1:], np.where(same_track, np.abs(h_li[:-1]-h_ep[0, 1:]), 0))
+    # number of segments in the track that each segment belongs to
+    track_start=np.r_[0, np.flatnonzero(~same_track)+1]
+    track_len=np.diff(np.r_[track_start, h_li.size])
+    good=(delta_h_seg < tol) | (np.repeat(track_len, track_len) < 3)
+    return good, delta_h_seg
@@ -0,0 +1,243 @@
+"""
+Space-time binned elevation-change (dh/dt) estimation.
+
+Fits, in every spatial cell (and optionally every time window), the model
+
+    h = h0 + dhdt * (t - tref) [+ dhdx * (x - xc) + dhdy * (y - yc)]
+
+to repeat-track heights, e.g. the reduced ATL06 files from readatl06.py
+(lon, lat, h_elv, s_elv, t_year). The normal equations of all cells are
+accumulated chunk by chunk with bincount, so the data never have to be in
+memory at once and partial sums from several workers can simply be added.
+All cells are then solved together. Outliers are removed by iterative
+n-sigma editing of the residuals, one more pass over the data each.
+
+Example:
+
+    chunks = atl06_chunks(sorted(glob.glob('ATL06_reduced/*.h5')), proj='3031')
+    fit = fit_dhdt(chunks, xmin, xmax, ymin, ymax, dx=5e3, dy=5e3)
+    x, y, z, s = fit_points(fit)
+    grid = make_grid(xmin, xmax, ymin, ymax, 1e3, 1e3, lazy=True)
+    zi = gaussip(x, y, z, s, grid, None, n=25, d=10e3, a=5e3).reshape(grid.shape)
+
+"""
+
+import numpy as np
+import h5py
+
+from utils import transform_coord
+
+
+def atl06_chunks(files, proj='3031', chunk=int(1e7), vars=('lon', 'lat', 't_year', 'h_elv', 's_elv')):
+    """Chunk source over reduced ATL06 files (see readatl06.py).
+
+    Returns a function that, each time it is called, yields (x, y, t, h, s)
+    chunks projected to EPSG proj (so the data can be read once per pass).
+    """
+
+    def chunks():
+        for fname in files:
+            with h5py.File(fname, 'r') as f:
+                npts = f[vars[0]].shape[0]
+                for i0 in range(0, npts, chunk):
+                    sl = slice(i0, min(i0 + chunk, npts))
+                    lon, lat, t, h = [f[v][sl] for v in vars[0:4]]
+                    s = f[vars[4]][sl] if len(vars) > 4 and vars[4] in f else np.ones(h.shape)
+                    x, y = transform_coord('4326', proj, lon, lat)
+                    yield np.asarray(x), np.asarray(y), t, h, s
+
+    return chunks
+
+
+def cell_index(x, y, t, grid):
+    """Flat cell number of each point (-1 outside the grid or not finite)."""
+
+    xmin, ymin, dx, dy, nx, ny, tedges = grid
+
+    # Non-finite coordinates are moved to the grid origin before the cast
+    valid = np.isfinite(x) & np.isfinite(y) & np.isfinite(t)
+
+    i = np.floor((np.where(valid, x, xmin) - xmin) / dx).astype(int)
+    j = np.floor((np.where(valid, y, ymin) - ymin) / dy).astype(int)
+    k = np.searchsorted(tedges, t, side='right') - 1 if tedges is not None else np.zeros(len(t), int)
+    nt = len(tedges) - 1 if tedges is not None else 1
+
+    ok = valid & (i >= 0) & (i < nx) & (j >= 0) & (j < ny) & (k >= 0) & (k < nt)
+
+    return np.where(ok, (k * ny + j) * nx + i, -1)
+
+
+def design(x, y, t, cell, grid, tref, topo):
+    """Design matrix of the points (columns 1, t - tref [, x - xc, y - yc])."""
+
+    xmin, ymin, dx, dy, nx, ny, tedges = grid
+
+    cols = [np.ones(len(t)), t - tref]
+
+    if topo:
+        # Offsets from the cell centre
+        i = cell % nx
+        j = (cell // nx) % ny
+        cols += [x - (xmin + (i + 0.5) * dx), y - (ymin + (j + 0.5) * dy)]
+
+    return np.vstack(cols).T
+
+
+def accumulate(A, h, w, cell, N, b, hh, n):
+    """Add the normal equations (A'WA, A'Wh, h'Wh, n) of one chunk to N, b, hh, n.
+
+    Only the cells with points in the chunk are counted and updated, so the
+    temporary arrays scale with the chunk and not with the grid.
+    """
+
+    p = A.shape[1]
+
+    # Cells of the chunk (each once, so indexed += adds correctly)
+    ucell, k = np.unique(cell, return_inverse=True)
+    m = len(ucell)
+
+    for i in range(p):
+        b[ucell, i] += np.bincount(k, weights=w * A[:, i] * h, minlength=m)
+        for j in range(i, p):
+            Nij = np.bincount(k, weights=w * A[:, i] * A[:, j], minlength=m)
+            N[ucell, i, j] += Nij
+            if j != i: N[ucell, j, i] += Nij
+
+    hh[ucell] += np.bincount(k, weights=w * h * h, minlength=m)
+    n[ucell] += np.bincount(k, minlength=m)
+
+
+def solve(N, b, hh, n, minobs, mintspan):
+    """Solve the normal equations of all cells together.
+
+    Returns the parameters, their standard errors and the rms of the
+    (weighted) residuals of each cell, nan where the fit is not possible.
+    """
+
+    ncell, p = b.shape
+
+    x = np.zeros((ncell, p)) * np.nan
+    e = np.zeros((ncell, p)) * np.nan
+    rms = np.zeros(ncell) * np.nan
+
+    # Enough data and time spread (weighted std of t from the normal matrix)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        tstd = np.sqrt(np.abs(N[:, 1, 1] / N[:, 0, 0] - (N[:, 0, 1] / N[:, 0, 0]) ** 2))
+    ok = (n >= max(minobs, p + 1)) & (tstd >= mintspan / 4.)
+
+    if not ok.any(): return x, e, rms
+
+    # Pseudo-inverse of the stacked normal matrices (singular ones give nan errors below)
+    Ni = np.linalg.pinv(N[ok])
+    xo = np.einsum('kij,kj->ki', Ni, b[ok])
+
+    # Residual sum of squares and variance of unit weight
+    rss = np.maximum(hh[ok] - np.einsum('ki,ki->k', xo, b[ok]), 0)
+    s2 = rss / (n[ok] - p)
+
+    x[ok] = xo
+    e[ok] = np.sqrt(np.abs(s2[:, None] * np.diagonal(Ni, axis1=1, axis2=2)))
+    rms[ok] = np.sqrt(rss / n[ok])
+
+    return x, e, rms
+
+
+def fit_dhdt(chunks, xmin, xmax, ymin, ymax, dx, dy, tedges=None, tref=None, topo=True,
+             weighted=True, nsigma=3.0, niter=3, minobs=10, mintspan=0.5, verbose=True):
+    """Cell-wise dh/dt from chunked point data.
+
+    chunks() must yield (x, y, t, h, s) arrays, once per pass over the data
+    (see atl06_chunks). Cells are dx by dy from (xmin, ymin) and, if tedges
+    is given, between successive times of tedges (one rate per window).
+    topo also fits a plane for the surface slope in each cell, weighted uses
+    1/s**2 weights. Points further than nsigma * rms from the fit of their
+    cell are removed, repeated niter times. Cells need minobs points and a
+    time span of about mintspan (years) for a solution.
+
+    Heights are fitted relative to a reference height of each cell (its
+    first point), so the residual sums keep their precision for large h.
+
+    Returns a dict of (nt,) ny x nx grids: dhdt, dhdt_err, h0, rms and nobs,
+    with the cell centre coordinates x, y and the time window edges.
+    """
+
+    nx = int(np.ceil((xmax - xmin) / dx))
+    ny = int(np.ceil((ymax - ymin) / dy))
+    nt = len(tedges) - 1 if tedges is not None else 1
+    grid = (xmin, ymin, dx, dy, nx, ny, tedges)
+    ncell = nx * ny * nt
+    p = 4 if topo else 2
+
+    # Reference time: mean time of the data (one extra pass) unless given
+    if tref is None:
+        tsum, tn = 0., 0
+        for x, y, t, h, s in chunks():
+            tsum, tn = tsum + np.nansum(t), tn + np.sum(~np.isnan(t))
+        tref = tsum / max(tn, 1)
+
+    par, rms = None, None
+
+    # Reference height of each cell (set from its first point)
+    href = np.zeros(ncell) * np.nan
+
+    for it in range(niter + 1):
+
+        N = np.zeros((ncell, p, p))
+        b = np.zeros((ncell, p))
+        hh = np.zeros(ncell)
+        n = np.zeros(ncell, dtype=int)
+
+        for x, y, t, h, s in chunks():
+
+            # Valid points inside the grid
+            cell = cell_index(x, y, t, grid)
+            keep = (cell >= 0) & np.isfinite(h) & np.isfinite(t)
+            if weighted: keep &= np.isfinite(s) & (s > 0)
+            x, y, t, h, s, cell = x[keep], y[keep], t[keep], h[keep], s[keep], cell[keep]
+
+            # Heights relative to the cell reference
+            ucell, first = np.unique(cell, return_index=True)
+            new = np.isnan(href[ucell])
+            href[ucell[new]] = h[first[new]]
+            h = h - href[cell]
+
+            A = design(x, y, t, cell, grid, tref, topo)
+            w = 1. / s ** 2 if weighted else np.ones(len(h))
+
+            # Edit outliers from the previous fit (cells with a fit only)
+            if par is not None:
+                r = h - np.einsum('ki,ki->k', A, par[cell])
+                with np.errstate(invalid='ignore'):
+                    bad = np.abs(r) * np.sqrt(w) > nsigma * rms[cell]
+                A, h, w, cell = A[~bad], h[~bad], w[~bad], cell[~bad]
+
+            # Add the normal equations of the chunk
+            accumulate(A, h, w, cell, N, b, hh, n)
+
+        par, err, rms = solve(N, b, hh, n, minobs, mintspan)
+
+        if verbose: print('Pass', it + 1, 'of', niter + 1, ':', int(n.sum()), 'points,',
+                          int(np.isfinite(par[:, 1]).sum()), 'cells solved')
+
+    shape = (nt, ny, nx) if tedges is not None else (ny, nx)
+
+    return {'dhdt': par[:, 1].reshape(shape), 'dhdt_err': err[:, 1].reshape(shape),
+            'h0': (par[:, 0] + href).reshape(shape), 'rms': rms.reshape(shape), 'nobs': n.reshape(shape),
+            'x': xmin + (np.arange(nx) + 0.5) * dx, 'y': ymin + (np.arange(ny) + 0.5) * dy,
+            'tedges': tedges, 'tref': tref}
+
+
+def fit_points(fit, k=None):
+    """Solved cells as points (x, y, dhdt, dhdt_err) for gaussip/lscip.
+
+    k selects the time window when the fit has several.
+    """
+
+    Xc, Yc = np.meshgrid(fit['x'], fit['y'])
+
+    z = fit['dhdt'] if k is None else fit['dhdt'][k]
+    s = fit['dhdt_err'] if k is None else fit['dhdt_err'][k]
+
+    ok = np.isfinite(z) & np.isfinite(s)
+
+    return Xc[ok], Yc[ok], z[ok], s[ok]
@@ -0,0 +1,335 @@
+"""
+Out-of-core gridding of point clouds larger than memory.
+
+Points are read in chunks from HDF5 and partitioned into spatial tiles
+on disk (each tile with the points within a halo of it). Each tile is
+then gridded with one of the interpolators in utils.py and written into
+a chunked HDF5 raster, so peak memory is set by the chunk and tile sizes
+and not by the size of the data set. Nodes whose n nearest points may
+lie beyond the halo are solved again, after all tiles, from the points
+around them (one more pass over the data), so the result is the same as
+gridding all the data at once.
+
+Example (halo, d and a in the units of x/y, here m, for all methods):
+
+    grid = make_grid(xmin, xmax, ymin, ymax, dx=5e3, dy=5e3, lazy=True)
+    grid_ooc('ATL06_dhdt.h5', 'dhdt_grid.h5', grid, halo=20e3,
+             method='lscip', n=25, d=20e3, a=5e3)
+
+"""
+
+import os
+import glob
+import time
+import shutil
+import numpy as np
+import h5py
+from scipy.spatial import cKDTree
+from concurrent.futures import ProcessPoolExecutor
+
+from utils import medip, gaussip, lscip, SpatialIndex, query_tree
+
+
+def tile_file(tiledir, k):
+    """Name of the point file of tile k."""
+
+    return os.path.join(tiledir, 'tile_%06i.h5' % k)
+
+
+def partition_points(fname, tiledir, grid, tile, halo, vars=('x', 'y', 'z', 's'),
+                     chunk=int(1e7)):
+    """Split the points of an HDF5 file into one file per tile (with halo).
+
+    vars are the names of x, y, z and (optional) sigma in fname. Points are
+    read chunk at a time; a point within halo of several tiles is copied to
+    each. Returns the number of points in each tile and the extent (xmin,
+    xmax, ymin, ymax) of all the points.
+    """
+
+    if not os.path.exists(tiledir): os.makedirs(tiledir)
+
+    # Remove tiles of an earlier run
+    for f in glob.glob(os.path.join(tiledir, 'tile_*.h5')): os.remove(f)
+
+    x_i, y_i = grid.x, grid.y
+    tiles = grid.tiles(tile)
+    ntx = int(np.ceil(len(x_i) / float(tile)))
+    nty = int(np.ceil(len(y_i) / float(tile)))
+
+    # Extent (with halo) of each tile
+    ext = np.array([[x_i[c].min() - halo, x_i[c].max() + halo,
+                     y_i[r].min() - halo, y_i[r].max() + halo] for r, c in tiles])
+
+    # Tile size in coordinates and how many tiles a halo can reach
+    step_x = (x_i[1] - x_i[0]) * tile if len(x_i) > 1 else np.inf
+    step_y = (y_i[1] - y_i[0]) * tile if len(y_i) > 1 else np.inf
+    mx = int(np.ceil(halo / np.abs(step_x))) + 1 if np.isfinite(step_x) else 0
+    my = int(np.ceil(halo / np.abs(step_y))) + 1 if np.isfinite(step_y) else 0
+
+    counts = np.zeros(len(tiles), dtype=int)
+    extent = np.array([np.inf, -np.inf, np.inf, -np.inf])
+
+    with h5py.File(fname, 'r') as fi:
+
+        npts = fi[vars[0]].shape[0]
+        has_s = len(vars) > 3 and vars[3] in fi
+
+        for i0 in range(0, npts, chunk):
+
+            # Read chunk of data
+            sl = slice(i0, min(i0 + chunk, npts))
+            x, y, z = fi[vars[0]][sl], fi[vars[1]][sl], fi[vars[2]][sl]
+            s = fi[vars[3]][sl] if has_s else np.ones(x.shape)
+
+            if len(x) > 0:
+                extent = np.array([min(extent[0], x.min()), max(extent[1], x.max()),
+                                   min(extent[2], y.min()), max(extent[3], y.max())])
+
+            # Tile holding each point (without halo)
+            tc = np.floor((x - x_i[0]) / step_x).astype(int) if mx else np.zeros(len(x), int)
+            tr = np.floor((y - y_i[0]) / step_y).astype(int) if my else np.zeros(len(x), int)
+
+            # Tile numbers of each point and its neighbours reached by the halo
+            keys, rows = [], []
+            for oy in range(-my, my + 1):
+                for ox in range(-mx, mx + 1):
+                    r, c = tr + oy, tc + ox
+                    ok = (r >= 0) & (r < nty) & (c >= 0) & (c < ntx)
+                    j = np.flatnonzero(ok)
+                    k = r[j] * ntx + c[j]
+                    # Exact test against the tile extent
+                    e = ext[k]
+                    inside = ((x[j] >= e[:, 0]) & (x[j] <= e[:, 1]) &
+                              (y[j] >= e[:, 2]) & (y[j] <= e[:, 3]))
+                    keys.append(k[inside])
+                    rows.append(j[inside])
+            keys = np.concatenate(keys)
+            rows = np.concatenate(rows)
+
+            # Append the points of each tile to its file
+            order = np.argsort(keys, kind='mergesort')
+            keys, rows = keys[order], rows[order]
+            utile, start = np.unique(keys, return_index=True)
+            for k, j in zip(utile, np.split(rows, start[1:])):
+                with h5py.File(tile_file(tiledir, k), 'a') as fo:
+                    for name, v in zip(('x', 'y', 'z', 's'), (x, y, z, s)):
+                        if name not in fo:
+                            fo.create_dataset(name, data=v[j], maxshape=(None,), chunks=True)
+                        else:
+                            n = fo[name].shape[0]
+                            fo[name].resize((n + len(j),))
+                            fo[name][n:] = v[j]
+                counts[k] += len(j)
+
+    return counts, extent
+
+
+def interpolate(x, y, z, s, Xi, Yi, method, kwargs, index):
+    """Interpolator of method at the nodes (Grid, or Xi/Yi arrays), as a tuple.
+
+    d and a are in the units of x/y for all methods (lscip takes km).
+    """
+
+    if method == 'medip':
+        return (medip(x, y, z, Xi, Yi, index=index, **kwargs),)
+    elif method == 'gaussip':
+        return (gaussip(x, y, z, s, Xi, Yi, index=index, **kwargs),)
+    elif method == 'lscip':
+        kwargs = dict(kwargs, d=kwargs['d'] / 1e3, a=kwargs['a'] / 1e3)
+        return lscip(x, y, z, s, Xi, Yi, index=index, **kwargs)
+    else:
+        raise ValueError("method must be 'medip', 'gaussip' or 'lscip'")
+
+
+def beyond_box(tree, xi, yi, box, n, d):
+    """Nodes whose interpolation may need points outside box.
+
+    Points outside box are farther from a node than the box edge. A node
+    is exact from the points in box if its n-th neighbour there is no
+    farther than the edge, or if no point at all can be within d of it
+    (no solution either way). Returns the flags and the n-th neighbour
+    distance in box (inf if fewer than n points), which bounds the true one.
+    """
+
+    if tree is None or tree.n == 0:
+        dxy = np.zeros((len(xi), 1)) + np.inf
+    else:
+        dxy = query_tree(tree, xi, yi, k=n, workers=1)[0]
+
+    edge = np.min([xi - box[0], box[1] - xi, yi - box[2], box[3] - yi], axis=0)
+
+    redo = (dxy[:, -1] > edge) & ((dxy[:, 0] <= d) | (edge < d))
+
+    return redo, dxy[:, -1]
+
+
+def grid_tile(fname, grid, method, kwargs, box):
+    """Grid the points of one tile file onto the nodes of grid (a window).
+
+    box is the extent of the tile points (see beyond_box). Also returns
+    the nodes that need points beyond it, and their search radius.
+    """
+
+    t0 = time.time()
+
+    xi, yi = grid.coords()
+
+    if fname is None or not os.path.exists(fname):
+        zi = np.zeros(grid.shape) * np.nan
+        out = (zi, zi, zi) if method == 'lscip' else (zi,)
+        redo, rk = beyond_box(None, xi, yi, box, int(kwargs['n']), kwargs['d'])
+        return out, redo, rk, time.time() - t0
+
+    with h5py.File(fname, 'r') as f:
+        x, y, z, s = f['x'][:], f['y'][:], f['z'][:], f['s'][:]
+
+    # Index of the tile only, kept out of the shared cache
+    index = SpatialIndex(x, y)
+
+    out = interpolate(x, y, z, s, grid, None, method, kwargs, index)
+    redo, rk = beyond_box(index.tree, xi, yi, box, int(kwargs['n']), kwargs['d'])
+
+    return tuple(v.reshape(grid.shape) for v in out), redo, rk, time.time() - t0
+
+
+def points_near(fname, xi, yi, radius, vars=('x', 'y', 'z', 's'), chunk=int(1e7)):
+    """Points of fname within radius of any of the nodes xi/yi (one pass)."""
+
+    tree = cKDTree(np.c_[xi, yi])
+
+    # Slightly larger, so points at exactly radius are kept
+    rmax = radius.max() * (1 + 1e-9) + 1e-9
+
+    out = [[], [], [], []]
+
+    with h5py.File(fname, 'r') as fi:
+
+        npts = fi[vars[0]].shape[0]
+        has_s = len(vars) > 3 and vars[3] in fi
+
+        for i0 in range(0, npts, chunk):
+
+            sl = slice(i0, min(i0 + chunk, npts))
+            x, y, z = fi[vars[0]][sl], fi[vars[1]][sl], fi[vars[2]][sl]
+            s = fi[vars[3]][sl] if has_s else np.ones(x.shape)
+
+            j = np.isfinite(x) & np.isfinite(y)
+            if np.isfinite(rmax):
+                j[j] = np.isfinite(tree.query(np.c_[x[j], y[j]], k=1, distance_upper_bound=rmax)[0])
+
+            for v, w in zip(out, (x, y, z, s)): v.append(w[j])
+
+    return [np.concatenate(v) for v in out]
+
+
+def grid_ooc(fname, outfile, grid, halo, method='gaussip', tile=256, njobs=1, chunk=int(1e7),
+             vars=('x', 'y', 'z', 's'), tiledir=None, verbose=True, **kwargs):
+    """Out-of-core gridding of the points in fname (HDF5) to outfile (HDF5).
+
+    grid is a Grid, from make_grid(xmin, xmax, ymin, ymax, dx, dy,
+    lazy=True). halo is the distance (same units as x/y) of the data used
+    around each tile. kwargs are passed to the interpolator (n, d and for
+    gaussip/lscip a), with d and a in the units of x/y for all methods.
+    Tiles are gridded on njobs processes, at most 2*njobs at a time.
+
+    Nodes whose n nearest points may lie beyond the halo are then solved
+    again from the points around them (one more pass over fname), so the
+    result does not depend on the tiling. A halo of about the distance to
+    the n-th neighbour keeps these few; the points gathered for them must
+    fit in memory.
+
+    outfile holds x, y (axes) and z (and e, n for lscip) chunked by tile.
+    The tile files go to tiledir (default outfile + '.tiles', removed at
+    the end). Returns the time (s) spent on each tile.
+    """
+
+    x_i, y_i = grid.x, grid.y
+    tiles = grid.tiles(tile)
+
+    keep_tiles = tiledir is not None
+    if tiledir is None: tiledir = outfile + '.tiles'
+
+    # Partition the points on disk
+    t0 = time.time()
+    counts, extent = partition_points(fname, tiledir, grid, tile, halo, vars, chunk)
+    if verbose: print('Partitioned', counts.sum(), 'points into', len(tiles), 'tiles in %.1f s' % (time.time() - t0))
+
+    names = ['z', 'e', 'n'] if method == 'lscip' else ['z']
+    times = np.zeros(len(tiles))
+
+    # Nodes to solve again: tile, flat node numbers in the tile, search radius
+    redo = []
+
+    def box(k):
+        # Extent of the points of tile k (unbounded where no point was left out)
+        r, c = tiles[k]
+        b = [x_i[c].min() - halo, x_i[c].max() + halo, y_i[r].min() - halo, y_i[r].max() + halo]
+        if extent[0] >= b[0]: b[0] = -np.inf
+        if extent[1] <= b[1]: b[1] = np.inf
+        if extent[2] >= b[2]: b[2] = -np.inf
+        if extent[3] <= b[3]: b[3] = np.inf
+        return b
+
+    with h5py.File(outfile, 'w') as fo:
+
+        # Chunked output raster
+        fo['x'] = x_i
+        fo['y'] = y_i
+        shape = grid.shape
+        chunks = (min(tile, shape[0]), min(tile, shape[1]))
+        for name in names:
+            fo.create_dataset(name, shape, dtype='float64', chunks=chunks, fillvalue=np.nan)
+
+        def write(k, result):
+            out, flags, rk, dt = result
+            r, c = tiles[k]
+            for name, v in zip(names, out): fo[name][r, c] = v
+            times[k] = dt
+            if flags.any(): redo.append((k, np.flatnonzero(flags), rk[flags]))
+            if verbose: print('Tile', k + 1, 'of', len(tiles), '(%i points) in %.2f s' % (counts[k], dt))
+
+        def args(k):
+            r, c = tiles[k]
+            f = tile_file(tiledir, k) if counts[k] > 0 else None
+            return f, grid.window(r, c), method, kwargs, box(k)
+
+        if njobs == 1:
+            for k in range(len(tiles)): write(k, grid_tile(*args(k)))
+        else:
+            with ProcessPoolExecutor(max_workers=njobs) as executor:
+                pending = []
+                for k in list(range(len(tiles))) + [None]:
+                    if k is not None:
+                        pending.append((k, executor.submit(grid_tile, *args(k))))
+                    # Keep a bounded number of tiles in flight
+                    while pending and (len(pending) >= 2 * njobs or k is None):
+                        j, future = pending.pop(0)
+                        write(j, future.result())
+
+        if len(redo) > 0:
+
+            # Nodes of all tiles needing points beyond the halo
+            t0 = time.time()
+            windows = [grid.window(*tiles[k]) for k, j, rk in redo]
+            xy = [w.coords(j) for w, (k, j, rk) in zip(windows, redo)]
+            xr = np.concatenate([v[0] for v in xy])
+            yr = np.concatenate([v[1] for v in xy])
+            radius = np.concatenate([rk for k, j, rk in redo])
+
+            # Solve them from the points around them
+            x, y, z, s = points_near(fname, xr, yr, radius, vars, chunk)
+            if len(x) > 0:
+                out = interpolate(x, y, z, s, xr, yr, method, kwargs, SpatialIndex(x, y))
+                i0 = 0
+                for w, (k, j, rk) in zip(windows, redo):
+                    r, c = tiles[k]
+                    for name, v in zip(names, out):
+                        block = fo[name][r, c]
+                        block.flat[j] = v[i0:i0 + len(j)]
+                        fo[name][r, c] = block
+                    i0 += len(j)
+            if verbose: print('Solved', len(xr), 'nodes again from', len(x), 'points in %.1f s' % (time.time() - t0))
+
+    if not keep_tiles: shutil.rmtree(tiledir)
+
+    return times
@@ -0,0 +1,354 @@
+"""
+Robust statistics (median, MAD) of data sets larger than memory.
+
+Data are given as a chunk source: a function that, each time it is
+called, yields 1D arrays (nan and inf values are ignored), so the data can be
+read once per pass (see as_chunks and dhdt.atl06_chunks).
+
+Three ways to the median and MAD-std of all the data:
+
+    exact      - repeated histograms narrow down the ranks of the median
+                 (a few passes) until the values left fit in memory
+    histogram  - one pass, fixed-width bins (resolution width)
+    sketch     - three passes, log-spaced bins (relative accuracy alpha)
+
+The Histogram and QuantileSketch summaries are mergeable: build one per
+worker or file and add them with merge().
+
+Example (global 3-sigma editing):
+
+    with h5py.File('IS1_IS2_AnIS_XOVER_PIG_ALL_BEAMS_R205.h5', 'r') as f:
+        chunks = as_chunks(f['dhdt'])
+        med, std = chunk_mad_std(chunks, method='exact')
+        for x in chunks():
+            bad = np.abs(x - med) > 3 * std
+
+"""
+
+import numpy as np
+
+
+def as_chunks(x, chunk=int(1e7)):
+    """Chunk source over an array or HDF5 dataset (read chunk at a time)."""
+
+    def chunks():
+        for i0 in range(0, x.shape[0], chunk):
+            yield np.asarray(x[i0:i0 + chunk], dtype='float64').ravel()
+
+    return chunks
+
+
+def finite(x):
+    """Finite values (nan and inf dropped) of a chunk as float64."""
+
+    x = np.asarray(x, dtype='float64').ravel()
+
+    return x[np.isfinite(x)]
+
+
+def count_keys(k):
+    """Distinct (sorted) bin numbers and their counts."""
+
+    if len(k) == 0: return k, np.zeros(0)
+
+    k0 = k.min()
+
+    # Dense bins are counted directly, sparse ones sorted
+    if k.max() - k0 < 4 * len(k) + 1e6:
+        c = np.bincount(k - k0)
+        i = np.flatnonzero(c)
+        return i + k0, c[i]
+
+    return np.unique(k, return_counts=True)
+
+
+def add_counts(keys, counts, k, c):
+    """Merge sparse bin counts (k, c) into sorted (keys, counts)."""
+
+    keys, inv = np.unique(np.r_[keys, k], return_inverse=True)
+    counts = np.bincount(inv.ravel(), weights=np.r_[counts, c], minlength=len(keys))
+
+    return keys, counts
+
+
+def inverse(r, F, x):
+    """Inverse of a piecewise-linear non-decreasing function F(x) at r.
+
+    Takes the first x where F reaches r (flat stretches are empty bins).
+    """
+
+    i = np.clip(np.searchsorted(F, r, side='left'), 1, len(F) - 1)
+    f0, f1 = F[i - 1], F[i]
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        w = np.where(f1 > f0, (r - f0) / (f1 - f0), 1.)
+
+    return x[i - 1] + w * (x[i] - x[i - 1])
+
+
+class Histogram(object):
+    """Mergeable histogram of fixed-width bins (only bins with data are kept).
+
+    Quantiles and MAD are interpolated within bins, so their error is
+    within the bin width. No range is needed beforehand.
+    """
+
+    def __init__(self, width, origin=0.0):
+        self.width = float(width)
+        self.origin = float(origin)
+        self.keys = np.zeros(0, dtype='int64')
+        self.counts = np.zeros(0)
+        self.n = 0
+
+    def update(self, x):
+        """Add the values of a chunk."""
+
+        x = finite(x)
+
+        k, c = count_keys(np.floor((x - self.origin) / self.width).astype('int64'))
+
+        self.keys, self.counts = add_counts(self.keys, self.counts, k, c)
+        self.n += len(x)
+
+        return self
+
+    def merge(self, other):
+        """Add another histogram (same width and origin)."""
+
+        assert (self.width, self.origin) == (other.width, other.origin)
+
+        self.keys, self.counts = add_counts(self.keys, self.counts, other.keys, other.counts)
+        self.n += other.n
+
+        return self
+
+    def cdf(self):
+        """Breakpoints (x, cumulative count) of the piecewise-linear CDF."""
+
+        left = self.origin + self.keys * self.width
+        cum = np.cumsum(self.counts)
+
+        x = np.vstack([left, left + self.width]).T.ravel()
+        F = np.vstack([cum - self.counts, cum]).T.ravel()
+
+        return x, F
+
+    def quantile(self, q):
+        """Quantile(s) q (0-1) of the data."""
+
+        if self.n == 0: return np.nan * np.asarray(q)
+
+        x, F = self.cdf()
+
+        return inverse(np.asarray(q) * self.n, F, x)
+
+    def median(self):
+        """Median of the data."""
+
+        return self.quantile(0.5)
+
+    def mad(self, center=None):
+        """Median absolute deviation from center (default the median)."""
+
+        if self.n == 0: return np.nan
+
+        if center is None: center = self.median()
+
+        x, F = self.cdf()
+
+        # Count within center +/- t is linear between these distances
+        t = np.unique(np.abs(x - center))
+        G = np.interp(center + t, x, F) - np.interp(center - t, x, F)
+
+        return inverse(0.5 * self.n, G, t)
+
+    def mad_std(self):
+        """Robust standard deviation (using MAD)."""
+
+        return 1.4826 * self.mad()
+
+
+class QuantileSketch(object):
+    """Mergeable quantile sketch with relative accuracy alpha.
+
+    Values are counted in log-spaced bins (as DDSketch), separately for
+    positive and negative values, so any quantile is within a factor
+    1 +/- alpha of the true value, whatever the range of the data.
+    """
+
+    def __init__(self, alpha=0.005, min_value=1e-12):
+        self.alpha = alpha
+        self.min_value = min_value
+        self.gamma = (1 + alpha) / (1 - alpha)
+        self.pos = (np.zeros(0, dtype='int64'), np.zeros(0))
+        self.neg = (np.zeros(0, dtype='int64'), np.zeros(0))
+        self.zero = 0
+        self.n = 0
+
+    def key(self, x):
+        """Bin number of positive values."""
+
+        return np.ceil(np.log(x) / np.log(self.gamma)).astype('int64')
+
+    def value(self, k):
+        """Representative value of bins."""
+
+        return 2 * self.gamma ** k / (self.gamma + 1)
+
+    def update(self, x):
+        """Add the values of a chunk."""
+
+        x = finite(x)
+
+        for sign, name in ((1, 'pos'), (-1, 'neg')):
+            v = sign * x[sign * x > self.min_value]
+            k, c = count_keys(self.key(v))
+            setattr(self, name, add_counts(*(getattr(self, name) + (k, c))))
+
+        self.zero += np.sum(np.abs(x) <= self.min_value)
+        self.n += len(x)
+
+        return self
+
+    def merge(self, other):
+        """Add another sketch (same alpha)."""
+
+        assert (self.alpha, self.min_value) == (other.alpha, other.min_value)
+
+        self.pos = add_counts(*(self.pos + other.pos))
+        self.neg = add_counts(*(self.neg + other.neg))
+        self.zero += other.zero
+        self.n += other.n
+
+        return self
+
+    def quantile(self, q):
+        """Quantile(s) q (0-1) of the data."""
+
+        if self.n == 0: return np.nan * np.asarray(q)
+
+        # All bins in increasing order of value
+        v = np.r_[-self.value(self.neg[0][::-1]), 0., self.value(self.pos[0])]
+        c = np.r_[self.neg[1][::-1], self.zero, self.pos[1]]
+
+        i = np.searchsorted(np.cumsum(c), np.asarray(q) * (self.n - 1), side='right')
+
+        return v[np.minimum(i, len(v) - 1)]
+
+    def median(self):
+        """Median of the data."""
+
+        return self.quantile(0.5)
+
+
+def chunk_range(chunks):
+    """Number, min and max of the valid values (one pass)."""
+
+    n, vmin, vmax = 0, np.inf, -np.inf
+
+    for x in chunks():
+        x = finite(x)
+        if len(x) == 0: continue
+        n += len(x)
+        vmin, vmax = min(vmin, x.min()), max(vmax, x.max())
+
+    return n, vmin, vmax
+
+
+def chunk_quantile(chunks, q, nbins=4096, maxn=int(1e7), maxiter=20):
+    """Exact quantile q of a chunk source (as np.quantile of all the data).
+
+    Each pass counts the values in nbins bins of the range holding the
+    ranks needed, and narrows the range to their bins. Once at most maxn
+    values are left they are collected and partitioned.
+    """
+
+    n, lo, hi = chunk_range(chunks)
+
+    if n == 0: return np.nan
+
+    # Ranks around the quantile (linear interpolation between them)
+    p = q * (n - 1)
+    ranks = np.array([np.floor(p), np.ceil(p)], dtype='int64')
+
+    # Range [lo, hi] (hi included if closed) holds the ranks
+    closed = True
+
+    for it in range(maxiter + 1):
+
+        # Values in range, below range and their histogram
+        nbelow, ninside = 0, 0
+        counts = np.zeros(nbins)
+        inside = []
+        width = (hi - lo) / float(nbins)
+
+        for x in chunks():
+            x = finite(x)
+            nbelow += np.sum(x < lo)
+            x = x[(x >= lo) & ((x <= hi) if closed else (x < hi))]
+            ninside += len(x)
+            if width > 0:
+                i = np.minimum(((x - lo) / width).astype('int64'), nbins - 1)
+                counts += np.bincount(i, minlength=nbins)
+            if ninside <= maxn: inside.append(x)
+
+        # All values left are the same
+        if width == 0: return lo
+
+        # Few enough values (or no progress possible): select them
+        if ninside <= maxn or lo + width == lo or it == maxiter:
+            if ninside > maxn:
+                inside = [x[(x >= lo) & ((x <= hi) if closed else (x < hi))]
+                          for x in map(finite, chunks())]
+            v = np.partition(np.concatenate(inside), np.unique(ranks - nbelow))
+            v0, v1 = v[ranks - nbelow]
+            return v0 + (p - ranks[0]) * (v1 - v0)
+
+        # Bins holding the ranks (and one more each side for rounding at the edges)
+        cum = nbelow + np.cumsum(counts)
+        b0, b1 = np.searchsorted(cum, ranks, side='right')
+        b0, b1 = max(b0 - 1, 0), min(b1 + 1, nbins - 1)
+
+        closed = closed and b1 == nbins - 1
+        lo, hi = lo + b0 * width, (lo + (b1 + 1) * width if b1 < nbins - 1 else hi)
+
+
+def chunk_median(chunks, **kwargs):
+    """Exact median of a chunk source (see chunk_quantile)."""
+
+    return chunk_quantile(chunks, 0.5, **kwargs)
+
+
+def chunk_mad_std(chunks, method='exact', width=None, alpha=0.005, **kwargs):
+    """Median and robust standard deviation (MAD) of a chunk source.
+
+    method is 'exact' (passes of chunk_quantile), 'histogram' (one pass,
+    bins of width, needed) or 'sketch' (three passes, relative accuracy
+    alpha). kwargs are passed to chunk_quantile.
+    """
+
+    if method == 'exact':
+        med = chunk_median(chunks, **kwargs)
+        mad = chunk_median(lambda: (np.abs(finite(x) - med) for x in chunks()), **kwargs)
+
+    elif method == 'histogram':
+        if width is None: raise ValueError("method 'histogram' needs a bin width")
+        hist = Histogram(width)
+        for x in chunks(): hist.update(x)
+        med, mad = hist.median(), hist.mad()
+
+    elif method == 'sketch':
+        # Median refined about a first guess (the accuracy is relative)
+        med = 0.
+        for it in range(2):
+            sketch = QuantileSketch(alpha)
+            for x in chunks(): sketch.update(finite(x) - med)
+            med += sketch.median()
+        sketch = QuantileSketch(alpha)
+        for x in chunks(): sketch.update(np.abs(finite(x) - med))
+        mad = sketch.median()
+
+    else:
+        raise ValueError("method must be 'exact', 'histogram' or 'sketch'")
+
+    return med, 1.4826 * mad
@@ -13,15 +13,25 @@ Jet Propulsion Laboratory, California Institute of Technology
 
 """
 
+import os
+import time
+import pickle
+import hashlib
+from collections import OrderedDict
 import numpy as np
 import pyproj
 from scipy.spatial import cKDTree
 from scipy.spatial.distance import cdist
 from scipy import stats
 from scipy.ndimage import map_coordinates
+from concurrent.futures import ProcessPoolExecutor
 
-def make_grid(xmin, xmax, ymin, ymax, dx, dy):
-    """Construct output grid-coordinates."""
+def make_grid(xmin, xmax, ymin, ymax, dx, dy, lazy=False):
+    """Construct output grid-coordinates.
+    
+    With lazy a Grid of the same nodes is returned instead of the
+    coordinate arrays.
+    """
     
     # Setup grid dimensions
     Nn = int((np.abs(ymax - ymin)) / dy) + 1
@@ -31,9 +41,83 @@ def make_grid(xmin, xmax, ymin, ymax, dx, dy):
     x_i = np.linspace(xmin, xmax, num=Ne)
     y_i = np.linspace(ymin, ymax, num=Nn)
     
+    if lazy: return Grid(x_i, y_i)
+    
     return np.meshgrid(x_i, y_i)
 
 
+class Grid(object):
+    """Regular grid of nodes (as make_grid) without the coordinate arrays.
+    
+    Only the node axes are kept. Coordinates are made on demand for blocks
+    of nodes (in the order of Xi.ravel() from make_grid), and windows of
+    the grid are grids themselves. Pass it as Xi (Yi is not used) to medip,
+    gaussip, lscip and lscip_tiled, or as x to RasterSampler.
+    """
+    
+    def __init__(self, x, y):
+        self.x = np.asarray(x, dtype='float64')
+        self.y = np.asarray(y, dtype='float64')
+        self.nx, self.ny = len(self.x), len(self.y)
+        self.shape = (self.ny, self.nx)
+        self.size = self.nx * self.ny
+        # Extent and (signed) node spacing
+        self.extent = (self.x.min(), self.x.max(), self.y.min(), self.y.max())
+        self.dx = (self.x[-1] - self.x[0]) / (self.nx - 1.) if self.nx > 1 else 0.
+        self.dy = (self.y[-1] - self.y[0]) / (self.ny - 1.) if self.ny > 1 else 0.
+    
+    def coords(self, block=None):
+        """Coordinates of a block of nodes (slice or flat node numbers, default all)."""
+        
+        if block is None: block = slice(None)
+        
+        if isinstance(block, slice):
+            k = np.arange(*block.indices(self.size))
+        else:
+            k = np.asarray(block)
+        
+        return self.x[k % self.nx], self.y[k // self.nx]
+    
+    def blocks(self, size=int(1e6)):
+        """Slices of about size nodes."""
+        
+        return node_blocks(self.size, 1, size)
+    
+    def window(self, rows, cols):
+        """Grid of a window (row/col slices) of the nodes."""
+        
+        return Grid(self.x[cols], self.y[rows])
+    
+    def tiles(self, tile):
+        """Row/col slices of tiles of tile x tile nodes."""
+        
+        return [(slice(r, min(r + tile, self.ny)), slice(c, min(c + tile, self.nx)))
+                for r in range(0, self.ny, tile) for c in range(0, self.nx, tile)]
+    
+    def meshgrid(self):
+        """Coordinate arrays of all nodes (as make_grid)."""
+        
+        return np.meshgrid(self.x, self.y)
+    
+    def index(self, x, y):
+        """Flat number of the node nearest to each point (-1 off the grid)."""
+        
+        x = np.asarray(x, dtype='float64')
+        y = np.asarray(y, dtype='float64')
+        
+        # Column and row (a single node covers everything along its axis)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            i = np.floor((x - self.x[0]) / self.dx + 0.5) if self.nx > 1 else 0 * x
+            j = np.floor((y - self.y[0]) / self.dy + 0.5) if self.ny > 1 else 0 * y
+        
+        ok = (i >= 0) & (i < self.nx) & (j >= 0) & (j < self.ny)
+        
+        i = np.where(ok, i, 0).astype(int)
+        j = np.where(ok, j, 0).astype(int)
+        
+        return np.where(ok, j * self.nx + i, -1)
+
+
 def transform_coord(proj1, proj2, x, y):
     """Transform coordinates from proj1 to proj2 (EPSG num)."""
     
@@ -46,76 +130,195 @@ def transform_coord(proj1, proj2, x, y):
 
 
 def mad_std(x, axis=None):
-    """ Robust standard deviation (using MAD). """
-    return 1.4826 * np.nanmedian(np.abs(x - np.nanmedian(x, axis)), axis)
+    """ Robust standard deviation (using MAD). 
+    
+    See robust.py for approximate and chunked (out-of-memory) versions.
+    """
+    
+    if axis is not None:
+        return 1.4826 * np.nanmedian(np.abs(x - np.nanmedian(x, axis, keepdims=True)), axis)
+    
+    # One copy of the valid values, partitioned in place for both medians
+    x = np.asarray(x, dtype='float64').ravel()
+    x = x[~np.isnan(x)]
+    
+    if len(x) == 0: return np.nan
+    
+    x -= np.median(x, overwrite_input=True)
+    
+    return 1.4826 * np.median(np.abs(x, out=x), overwrite_input=True)
 
 
-def medip(x, y, z, Xi, Yi, n, d):
-    """2D interpolation using median."""
+class SpatialIndex(object):
+    """KD-tree of a point set, built once and shared by the interpolators.
+    
+    Pass it as index= to medip, gaussip, lscip and lscip_tiled, or let
+    them find it in the in-memory cache (see get_index).
+    """
+    
+    def __init__(self, x, y, key=None):
+        self.key = data_key(x, y) if key is None else key
+        self.tree = cKDTree(np.c_[x, y])
+        self.n = self.tree.n
+        # Approximate memory use (data, indices and nodes)
+        self.nbytes = self.tree.data.nbytes * 3
+    
+    def save(self, fname):
+        """Save the index (no rebuild on load)."""
+        with open(fname, 'wb') as f:
+            pickle.dump(self, f, protocol=pickle.HIGHEST_PROTOCOL)
+    
+    @staticmethod
+    def load(fname):
+        """Load a saved index."""
+        with open(fname, 'rb') as f:
+            return pickle.load(f)
+
+
+# In-memory cache of spatial indices (least recently used evicted first)
+index_cache = OrderedDict()
+index_cache_bytes = int(2e9)
+
+
+def data_key(x, y):
+    """Hash of the point coordinates, used to find their index."""
+    
+    h = hashlib.sha1()
+    for v in (x, y):
+        v = np.ascontiguousarray(v, dtype='float64')
+        h.update(str(v.shape).encode())
+        h.update(v.data)
+    
+    return h.hexdigest()
+
+
+def get_index(x, y, index=None, fname=None, cache=True):
+    """Spatial index of x/y: given, cached, loaded from fname, or built.
+    
+    A newly built index is cached (cache=True) and saved to fname.
+    """
+    
+    if index is not None:
+        if index.n != len(x):
+            raise ValueError('Spatial index does not match the data (%i != %i points)' % (index.n, len(x)))
+        return index
+    
+    key = data_key(x, y)
+    
+    if key in index_cache:
+        index_cache.move_to_end(key)
+        return index_cache[key]
+    
+    if fname is not None and os.path.exists(fname):
+        index = SpatialIndex.load(fname)
+        if index.key != key:
+            raise ValueError('Spatial index in ' + fname + ' is for other data')
+    else:
+        index = SpatialIndex(x, y, key)
+        if fname is not None: index.save(fname)
+    
+    if cache:
+        index_cache[key] = index
+        # Evict until under the size limit (keep the newest)
+        while len(index_cache) > 1 and sum(i.nbytes for i in index_cache.values()) > index_cache_bytes:
+            index_cache.popitem(last=False)
+    
+    return index
+
+
+def query_tree(tree, xi, yi, k, workers=-1):
+    """Batched k-nearest query of all points, always (n, k) arrays.
+    
+    Missing neighbours (k > data points) get distance inf and index tree.n.
+    """
+    
+    pts = np.c_[xi, yi]
     
-    # Ravel grid coord.
-    xi = Xi.ravel()
-    yi = Yi.ravel()
+    # Keyword for parallel queries changed name in scipy 1.6
+    try:
+        dxy, idx = tree.query(pts, k=k, workers=workers)
+    except TypeError:
+        dxy, idx = tree.query(pts, k=k, n_jobs=workers)
+    
+    return dxy.reshape(len(pts), -1), idx.reshape(len(pts), -1)
+
+
+def node_blocks(nnodes, k, size=int(1e7)):
+    """Slices of grid nodes so that a (nodes x k) block has about size elements."""
+    
+    step = max(int(size // max(k, 1)), 1)
+    
+    return [slice(i, min(i + step, nnodes)) for i in range(0, nnodes, step)]
+
+
+def node_coords(Xi, Yi, block):
+    """Coordinates of a block of nodes from a Grid or coordinate arrays."""
+    
+    if isinstance(Xi, Grid): return Xi.coords(block)
+    
+    return Xi.ravel()[block], Yi.ravel()[block]
+
+
+def medip(x, y, z, Xi, Yi, n, d, workers=-1, index=None):
+    """2D interpolation using median."""
     
     # Create output vectors
-    zi = np.zeros(len(xi)) * np.nan
+    zi = np.zeros(Xi.size) * np.nan
     
-    # Create kdtree
-    tree = cKDTree(np.c_[x, y])
+    # Get kdtree (shared, see get_index)
+    tree = get_index(x, y, index).tree
     
-    # Loop through observations
-    for i in range(len(xi)):
+    # Pad so missing neighbours (index tree.n) read as nan
+    z = np.append(z, np.nan)
+    
+    # Batched queries over blocks of nodes
+    for block in node_blocks(Xi.size, n):
         
         # Find closest number of observations
-        (dxy, idx) = tree.query((xi[i], yi[i]), k=n)
-        
-        # Check max distance
-        if dxy.min() > d: continue
+        (dxy, idx) = query_tree(tree, *node_coords(Xi, Yi, block), k=n, workers=workers)
         
         # Get parameters
         zc = z[idx]
         
-        # Check for empty solutions
-        if len(zc[~np.isnan(zc)]) == 0: continue
+        # Check max distance and empty solutions
+        ok = (dxy.min(axis=1) <= d) & np.any(~np.isnan(zc), axis=1)
         
         # Predicted value
-        zi[i] = np.nanmedian(zc)
+        zi[np.flatnonzero(ok) + block.start] = np.nanmedian(zc[ok], axis=1)
     
     # Return interpolated points
     return zi
 
 
-def gaussip(x, y, z, s, Xi, Yi, n, d, a):
+def gaussip(x, y, z, s, Xi, Yi, n, d, a, workers=-1, index=None):
     """2D interpolation using gaussian weight."""
     
-    # Ravel grid coord.
-    xi = Xi.ravel()
-    yi = Yi.ravel()
-    
     # Create output vectors
-    zi = np.zeros(len(xi)) * np.nan
+    zi = np.zeros(Xi.size) * np.nan
     
-    # Create kdtree
-    tree = cKDTree(np.c_[x, y])
+    # Get kdtree (shared, see get_index)
+    tree = get_index(x, y, index).tree
     
     # Test sigma vector
     if np.all(np.isnan(s)): s = np.ones(s.shape)
     
-    # Loop through observations
-    for i in range(len(xi)):
+    # Pad so missing neighbours (index tree.n) read as nan
+    z = np.append(z, np.nan)
+    s = np.append(s, np.nan)
+    
+    # Batched queries over blocks of nodes
+    for block in node_blocks(Xi.size, n):
         
         # Find closest number of observations
-        (dr, idx) = tree.query((xi[i], yi[i]), k=n)
-        
-        # Check max distance
-        if dr.min() > d: continue
+        (dr, idx) = query_tree(tree, *node_coords(Xi, Yi, block), k=n, workers=workers)
         
         # Get parameters
         zc = z[idx]
         sc = s[idx]
         
-        # Check for empty solutions
-        if len(zc[~np.isnan(zc)]) == 0: continue
+        # Check max distance and empty solutions
+        ok = (dr.min(axis=1) <= d) & np.any(~np.isnan(zc), axis=1)
+        zc, sc, dr = zc[ok], sc[ok], dr[ok]
         
         # Compute the weighting factor
         wc = (1./sc**2) * np.exp(-(dr**2)/(2*a**2))
@@ -124,42 +327,40 @@ def gaussip(x, y, z, s, Xi, Yi, n, d, a):
         wc += 1e-6
         
         # Predicted value
-        zi[i] = np.nansum(wc*zc) / np.nansum(wc)
+        zi[np.flatnonzero(ok) + block.start] = np.nansum(wc*zc, axis=1) / np.nansum(wc, axis=1)
     
     # Return interpolated points
     return zi
 
 
-def lscip(x, y, z, s, Xi, Yi, d, a, n):
-    """2D interpolation using ordinary kriging"""
+def lsc_nodes(tree, x, y, z, s, xi, yi, d, a, n, workers=-1):
+    """Least-squares collocation at a set of nodes with batched solves.
     
-    # Cast as int!
-    n = int(n)
-    
-    # Ravel grid coord.
-    xi = Xi.ravel()
-    yi = Yi.ravel()
+    Nodes are xi/yi arrays or a Grid (as xi). Distances d and a in meters.
+    Also returns the distance to the n-th neighbour of each node (inf if
+    there are fewer than n points).
+    """
     
     # Create output vectors
-    zi = np.zeros(len(xi)) * np.nan
-    ei = np.zeros(len(xi)) * np.nan
-    ni = np.zeros(len(xi)) * np.nan
-    
-    # Create KDTree
-    tree = cKDTree(np.c_[x, y])
+    zi = np.zeros(xi.size) * np.nan
+    ei = np.zeros(xi.size) * np.nan
+    ni = np.zeros(xi.size) * np.nan
+    rk = np.zeros(xi.size) + np.inf
     
-    # Convert to meters
-    a *= 0.595 * 1e3
-    d *= 1e3
+    # Need minimum of two observations
+    if n < 2 or len(x) == 0: return zi, ei, ni, rk
     
-    # Loop through observations
-    for i in range(len(xi)):
+    # Blocks of nodes with about 1e7 covariance elements
+    for block in node_blocks(xi.size, n * n):
         
         # Find closest number of observations
-        (dxy, idx) = tree.query((xi[i], yi[i]), k=n)
+        (dxy, idx) = query_tree(tree, *node_coords(xi, yi, block), k=n, workers=workers)
+        rk[block] = dxy[:, -1]
         
-        # Check minimum distance
-        if dxy.min() > d: continue
+        # Check minimum distance (and that n observations exist)
+        ok = (dxy.min(axis=1) <= d) & np.isfinite(dxy[:, -1])
+        if not ok.any(): continue
+        dxy, idx = dxy[ok], idx[ok]
         
         # Get parameters
         xc = x[idx]
@@ -167,115 +368,459 @@ def lscip(x, y, z, s, Xi, Yi, d, a, n):
         zc = z[idx]
         sc = s[idx]
         
-        # Need minimum of two observations
-        if len(zc) < 2: continue
-        
         # Estimate local median (robust) and local variance of data
-        m0 = np.nanmedian(zc)
-        c0 = np.nanvar(zc)
+        m0 = np.nanmedian(zc, axis=1)[:, None]
+        c0 = np.nanvar(zc, axis=1)[:, None]
         
         # Covariance function for Dxy
         Cxy = c0 * (1 + (dxy / a)) * np.exp(-dxy / a)
         
         # Compute pair-wise distance
-        dxx = cdist(np.c_[xc, yc], np.c_[xc, yc], "euclidean")
-        
-        # Covariance function Dxx
-        Cxx = c0 * (1 + (dxx / a)) * np.exp(-dxx / a)
+        dxx = np.sqrt((xc[:, :, None] - xc[:, None, :]) ** 2 +
+                      (yc[:, :, None] - yc[:, None, :]) ** 2)
         
-        # Measurement noise matrix
-        N = np.eye(len(Cxx)) * sc * sc
+        # Covariance function Dxx plus measurement noise
+        Cxx = c0[:, :, None] * (1 + (dxx / a)) * np.exp(-dxx / a)
+        Cxx[:, np.arange(n), np.arange(n)] += sc * sc
         
-        # Solve for the inverse
-        CxyCxxi = np.linalg.solve((Cxx + N).T, Cxy.T)
+        # Solve for the inverse (stacked systems)
+        CxyCxxi = np.linalg.solve(np.swapaxes(Cxx, 1, 2), Cxy[:, :, None])[:, :, 0]
         
         # Predicted value
-        zi[i] = np.dot(CxyCxxi, zc) + (1 - np.sum(CxyCxxi)) * m0
+        rows = np.flatnonzero(ok) + block.start
+        zi[rows] = np.sum(CxyCxxi * zc, axis=1) + (1 - np.sum(CxyCxxi, axis=1)) * m0[:, 0]
         
         # Predicted error
-        ei[i] = np.sqrt(np.abs(c0 - np.dot(CxyCxxi, Cxy.T)))
+        ei[rows] = np.sqrt(np.abs(c0[:, 0] - np.sum(CxyCxxi * Cxy, axis=1)))
         
         # Number of data used for prediction
-        ni[i] = len(zc)
+        ni[rows] = n
+    
+    return zi, ei, ni, rk
+
+
+def lscip(x, y, z, s, Xi, Yi, d, a, n, workers=-1, index=None):
+    """2D interpolation using ordinary kriging"""
+    
+    # Cast as int!
+    n = int(n)
+    
+    # Get KDTree (shared, see get_index)
+    tree = get_index(x, y, index).tree
+    
+    # Convert to meters
+    a *= 0.595 * 1e3
+    d *= 1e3
+    
+    # Batched solution for all nodes
+    zi, ei, ni = lsc_nodes(tree, x, y, z, s, Xi, Yi, d, a, n, workers)[0:3]
     
     # Return interpolated values
     return zi, ei, ni
 
 
-def spatial_filter(x, y, z, dx, dy, sigma=5.0):
-    """ Cleaning of spatial data """
+def lsc_tile(xi, yi, x, y, z, s, box, d, a, n):
+    """Collocation of one tile from its own (halo) data.
+    
+    Nodes whose n-th neighbour could lie outside the data box are flagged
+    for a solution from the full data set.
+    """
+    
+    t0 = time.time()
+    
+    tree = cKDTree(np.c_[x, y])
+    zi, ei, ni, rk = lsc_nodes(tree, x, y, z, s, xi, yi, d, a, n, workers=1)
+    
+    # Distance from each node to the edge of the data box
+    edge = np.min([xi - box[0], box[1] - xi, yi - box[2], box[3] - yi], axis=0)
+    redo = ~(rk < edge)
+    
+    return zi, ei, ni, redo, time.time() - t0
+
+
+def lscip_tiled(x, y, z, s, Xi, Yi, d, a, n, tile=200, halo=None, njobs=1,
+                checkpoint=None, save_every=60., verbose=True, index=None):
+    """2D interpolation using ordinary kriging, in parallel over tiles.
+    
+    Same output as lscip. The grid is split into tiles of tile x tile nodes,
+    each solved from the data within halo (km, default d) of the tile on
+    one of njobs processes. Nodes whose neighbourhood reaches beyond the
+    halo are solved from the full data set, so the result does not depend
+    on the tiling. Results are saved to checkpoint (.npz) at most every
+    save_every seconds and a run restarts from the tiles already done.
+    index is the spatial index of the full data (see get_index). Xi may
+    be a Grid (Yi is then not used).
+    
+    Returns zi, ei, ni and the time (s) spent on each tile.
+    """
+    
+    # Cast as int!
+    n = int(n)
+    
+    # Convert to meters
+    a *= 0.595 * 1e3
+    d *= 1e3
+    halo = d if halo is None else halo * 1e3
+    
+    # Tiles as row/col slices of the grid
+    nrow, ncol = Xi.shape
+    tiles = [(slice(r, min(r + tile, nrow)), slice(c, min(c + tile, ncol)))
+             for r in range(0, nrow, tile) for c in range(0, ncol, tile)]
+    
+    # Output vectors (and tiles done) from the checkpoint
+    if checkpoint is not None and os.path.exists(checkpoint):
+        with np.load(checkpoint) as f:
+            zi, ei, ni, times = f['zi'], f['ei'], f['ni'], f['times']
+        if times.size != len(tiles) or zi.shape != Xi.shape:
+            raise ValueError('Checkpoint does not match the grid/tiling: ' + checkpoint)
+    else:
+        zi = np.zeros(Xi.shape) * np.nan
+        ei = np.zeros(Xi.shape) * np.nan
+        ni = np.zeros(Xi.shape) * np.nan
+        times = np.zeros(len(tiles)) * np.nan
+    
+    todo = [i for i in range(len(tiles)) if np.isnan(times[i])]
+    
+    # Data sorted by x, so the halo data of a tile is a slice plus a y test
+    order = np.argsort(x, kind='mergesort')
+    xs = x[order]
+    ymin, ymax = y.min(), y.max()
+    
+    def tile_args(i):
+        rows, cols = tiles[i]
+        if isinstance(Xi, Grid):
+            xt, yt = Xi.window(rows, cols).coords()
+        else:
+            xt, yt = Xi[rows, cols].ravel(), Yi[rows, cols].ravel()
+        box = [xt.min() - halo, xt.max() + halo, yt.min() - halo, yt.max() + halo]
+        i0, i1 = np.searchsorted(xs, box[0], side='left'), np.searchsorted(xs, box[1], side='right')
+        idx = order[i0:i1]
+        idx = idx[(y[idx] >= box[2]) & (y[idx] <= box[3])]
+        # The box edge is only a limit where data was left out
+        if i0 == 0: box[0] = -np.inf
+        if i1 == len(x): box[1] = np.inf
+        if ymin >= box[2]: box[2] = -np.inf
+        if ymax <= box[3]: box[3] = np.inf
+        return xt, yt, x[idx], y[idx], z[idx], s[idx], box, d, a, n
+    
+    tree = None
+    redo = np.zeros(Xi.shape, dtype=bool)
+    saved = time.time()
+    
+    def tile_done(i, result):
+        zt, et, nt, rt, dt = result
+        rows, cols = tiles[i]
+        shape = zi[rows, cols].shape
+        zi[rows, cols] = zt.reshape(shape)
+        ei[rows, cols] = et.reshape(shape)
+        ni[rows, cols] = nt.reshape(shape)
+        redo[rows, cols] = rt.reshape(shape)
+        times[i] = dt
+        if verbose:
+            print('Tile', i + 1, 'of', len(tiles), 'in %.2f s,' % dt, int(rt.sum()), 'nodes from full data')
+    
+    def solve_redo():
+        # Nodes needing the full data set, then save
+        nonlocal tree
+        if redo.any():
+            if tree is None: tree = get_index(x, y, index).tree
+            j = np.flatnonzero(redo)
+            zr, er, nr = lsc_nodes(tree, x, y, z, s, *node_coords(Xi, Yi, j), d=d, a=a, n=n)[0:3]
+            zi.flat[j], ei.flat[j], ni.flat[j] = zr, er, nr
+            redo[:] = False
+        if checkpoint is not None:
+            with open(checkpoint, 'wb') as f:
+                np.savez(f, zi=zi, ei=ei, ni=ni, times=times)
+    
+    if njobs == 1:
+        for i in todo:
+            tile_done(i, lsc_tile(*tile_args(i)))
+            if time.time() - saved > save_every:
+                solve_redo()
+                saved = time.time()
+    else:
+        with ProcessPoolExecutor(max_workers=njobs) as executor:
+            pending = []
+            for i in todo + [None]:
+                if i is not None:
+                    pending.append((i, executor.submit(lsc_tile, *tile_args(i))))
+                # Keep a bounded number of tiles in flight
+                while pending and (len(pending) >= 2 * njobs or i is None):
+                    j, future = pending.pop(0)
+                    tile_done(j, future.result())
+                    if time.time() - saved > save_every:
+                        solve_redo()
+                        saved = time.time()
+    
+    solve_redo()
+    
+    # Return interpolated values
+    return zi.ravel(), ei.ravel(), ni.ravel(), times
+
+
+def bin_index(x, y, Ne, Nn):
+    """Bin numbers of points on an Ne x Nn grid over the data extent.
+    
+    Same numbering as stats.binned_statistic_2d(x, y, z, bins=(Ne,Nn)).
+    """
+    
+    ib = []
+    for v, nb in [(x, Ne), (y, Nn)]:
+        
+        # Bin edges (widened if all values are equal)
+        vmin, vmax = v.min(), v.max()
+        if vmin == vmax: vmin, vmax = vmin - 0.5, vmax + 0.5
+        edges = np.linspace(vmin, vmax, nb + 1)
+        
+        # Values on the last edge go in the last bin
+        i = np.searchsorted(edges, v, side='right')
+        i[v >= edges[-1]] -= 1
+        ib.append(i)
+    
+    return np.ravel_multi_index(ib, (Ne + 2, Nn + 2))
+
+
+def bin_stats(index, z):
+    """Median, std and number of valid values of z in each bin (one sort).
+    
+    Returns the bin numbers with data, the statistics of each and the
+    position of each point's bin in them.
+    """
+    
+    # Sort by bin, then value (nan values last within a bin)
+    order = np.lexsort((z, index))
+    bins, start, inv = np.unique(index[order], return_index=True, return_inverse=True)
+    
+    # Valid values at the start of each bin
+    valid = ~np.isnan(z[order])
+    count = np.bincount(inv, weights=valid, minlength=len(bins)).astype(int)
+    
+    # Median from the middle value(s) of each bin
+    zs = z[order]
+    lo = start + np.maximum(count - 1, 0) // 2
+    hi = start + np.maximum(count, 1) // 2
+    hi = np.where(count % 2 == 1, lo, hi)
+    median = np.where(count > 0, np.mean([zs[lo], zs[hi]], axis=0), np.nan)
+    
+    # Standard deviation of the residuals
+    n = np.maximum(count, 1)
+    dh = np.where(valid, zs - median[inv], 0.)
+    mean = np.bincount(inv, weights=dh, minlength=len(bins)) / n
+    var = np.bincount(inv, weights=np.where(valid, (dh - mean[inv]) ** 2, 0.),
+                      minlength=len(bins)) / n
+    std = np.where(count > 0, np.sqrt(var), np.nan)
+    
+    # Position of each point's bin in the original order
+    ib = np.empty(len(z), dtype=int)
+    ib[order] = inv
+    
+    return bins, median, std, count, ib
+
+
+def spatial_filter(x, y, z, dx, dy, sigma=5.0, niter=1, return_stats=False):
+    """ Cleaning of spatial data 
+    
+    Values further than sigma * std from their bin median are set to nan,
+    repeated niter times (or until no more outliers) on the remaining data.
+    With return_stats the bin numbers (as binned_statistic_2d), median,
+    std and count of the last iteration are also returned.
+    """
     
     # Grid dimensions
     Nn = int((np.abs(y.max() - y.min())) / dy) + 1
     Ne = int((np.abs(x.max() - x.min())) / dx) + 1
     
     # Bin data
-    f_bin = stats.binned_statistic_2d(x, y, z, bins=(Ne,Nn))
-    
-    # Get bin numbers for the data
-    index = f_bin.binnumber
-    
-    # Unique indexes
-    ind = np.unique(index)
+    index = bin_index(x, y, Ne, Nn)
     
     # Create output
     zo = z.copy()
     
-    # Number of unique index
-    for i in range(len(ind)):
+    for it in range(niter):
         
-        # index for each bin
-        idx, = np.where(index == ind[i])
+        # Per-bin statistics in one pass
+        bins, median, std, count, ib = bin_stats(index, zo)
         
-        # Get data
-        zb = z[idx]
+        # Residuals to the median of the bin
+        dh = zo - median[ib]
         
-        # Make sure we have enough
-        if len(zb[~np.isnan(zb)]) == 0:
-            continue
-    
-        # Set to median of values
-        dh = zb - np.nanmedian(zb)
-
         # Identify outliers
-        foo = np.abs(dh) > sigma * np.nanstd(dh)
-    
+        with np.errstate(invalid='ignore'):
+            foo = np.abs(dh) > sigma * std[ib]
+        
         # Set to nan-value
-        zb[foo] = np.nan
+        zo[foo] = np.nan
         
-        # Replace data
-        zo[idx] = zb
+        if not foo.any(): break
     
     # Return filtered array
+    if return_stats:
+        return zo, (bins, median, std, count)
     return zo
 
 
+class RasterStencil(object):
+    """Sampling weights of a set of points on a raster (see RasterSampler.stencil).
+    
+    Built once, it samples the same points on any number of rasters of
+    the same grid, e.g. the time slices of a (nt, ny, nx) cube.
+    """
+    
+    def __init__(self, shape, k, u=None, v=None, valid=None):
+        self.shape = shape
+        # Flat index of the lower-left node (nearest node for u = None)
+        self.k = k
+        # Fractional offsets along the columns and rows
+        self.u = u
+        self.v = v
+        self.valid = valid
+    
+    def apply(self, z, fill=np.nan):
+        """Sample z (ny, nx) or a stack (..., ny, nx) at the stencil points."""
+        
+        z = np.asarray(z)
+        
+        assert z.shape[-2:] == self.shape
+        
+        ny, nx = self.shape
+        
+        # Flat view of each raster (no copy for contiguous input)
+        zf = z.reshape(z.shape[:-2] + (ny * nx,))
+        
+        if self.u is None:
+            zi = zf[..., self.k].astype('float64')
+        else:
+            k, u, v = self.k, self.u, self.v
+            zi = zf[..., k] * ((1 - u) * (1 - v))
+            zi += zf[..., k + 1] * (u * (1 - v))
+            zi += zf[..., k + nx] * ((1 - u) * v)
+            zi += zf[..., k + nx + 1] * (u * v)
+        
+        zi[..., ~self.valid] = fill
+        
+        return zi
+
+
+class RasterSampler(object):
+    """Point sampling of a regular raster (e.g. from geotiffread or make_grid).
+    
+    x/y are the 2D node coordinates (or the 1D axes, or x a Grid) of z.
+    The affine mapping from x/y to columns/rows keeps the sign of the
+    steps, so z is sampled as stored (no flipped copies, whatever its
+    orientation).
+    """
+    
+    def __init__(self, x, y, z=None):
+        
+        # Axes of the grid
+        if isinstance(x, Grid): x, y = x.x, x.y
+        
+        x = np.asarray(x)
+        y = np.asarray(y)
+        
+        x = x[0, :] if x.ndim == 2 else x
+        y = y[:, 0] if y.ndim == 2 else y
+        
+        self.nx, self.ny = x.size, y.size
+        
+        assert self.nx > 1 and self.ny > 1
+        
+        # Origin and (signed) step of the columns and rows
+        self.x0, self.y0 = x[0], y[0]
+        self.dx = (x[-1] - x[0]) / (self.nx - 1.)
+        self.dy = (y[-1] - y[0]) / (self.ny - 1.)
+        
+        self.z = None if z is None else np.ascontiguousarray(z)
+        
+        if self.z is not None: assert self.z.shape[-2:] == (self.ny, self.nx)
+    
+    def coords(self, xi, yi):
+        """Fractional column and row of points."""
+        
+        return (np.asarray(xi, dtype='float64') - self.x0) / self.dx, \
+               (np.asarray(yi, dtype='float64') - self.y0) / self.dy
+    
+    def stencil(self, xi, yi, method='linear'):
+        """Stencil of points for repeated sampling ('linear' or 'nearest')."""
+        
+        # Scalars are broadcast against arrays
+        xi, yi = np.broadcast_arrays(np.asarray(xi, dtype='float64'),
+                                     np.asarray(yi, dtype='float64'))
+        
+        c, r = self.coords(xi.ravel(), yi.ravel())
+        
+        # Points outside the grid are filled
+        valid = (c >= 0) & (c <= self.nx - 1) & (r >= 0) & (r <= self.ny - 1)
+        c[~valid] = 0
+        r[~valid] = 0
+        
+        if method == 'nearest':
+            i = np.floor(c + 0.5).astype(int)
+            j = np.floor(r + 0.5).astype(int)
+            return RasterStencil((self.ny, self.nx), j * self.nx + i, valid=valid)
+        
+        elif method == 'linear':
+            # Last column/row uses the cell before it
+            i = np.minimum(np.floor(c).astype(int), self.nx - 2)
+            j = np.minimum(np.floor(r).astype(int), self.ny - 2)
+            return RasterStencil((self.ny, self.nx), j * self.nx + i, c - i, r - j, valid)
+        
+        else:
+            raise ValueError("method must be 'linear' or 'nearest'")
+    
+    def sample(self, xi, yi, z=None, method='linear', fill=np.nan, size=int(1e6)):
+        """Sample z (default the raster of the sampler) at points xi/yi.
+        
+        z may be a stack (..., ny, nx). Points are done size at a time to
+        bound the temporary arrays. Returns values shaped like xi/yi.
+        """
+        
+        z = self.z if z is None else np.asarray(z)
+        
+        xi, yi = np.broadcast_arrays(np.asarray(xi, dtype='float64'),
+                                     np.asarray(yi, dtype='float64'))
+        shape = xi.shape
+        xi, yi = xi.ravel(), yi.ravel()
+        
+        zi = np.empty(z.shape[:-2] + (len(xi),))
+        
+        for block in node_blocks(len(xi), 1, size):
+            zi[..., block] = self.stencil(xi[block], yi[block], method).apply(z, fill)
+        
+        return zi.reshape(z.shape[:-2] + shape)
+    
+    __call__ = sample
+
+
 def interp2d(x, y, z, xi, yi, **kwargs):
     """Raster to point interpolation."""
     
-    x = np.flipud(x)
-    y = np.flipud(y)
-    z = np.flipud(z)
+    sampler = RasterSampler(x, y, z)
     
-    x = x[0,:]
-    y = y[:,0]
+    order = kwargs.get('order', 3)
     
-    nx, ny = x.size, y.size
+    # Nearest/bilinear without map_coordinates (same result as its 'constant' mode)
+    if order in (0, 1) and kwargs.get('mode', 'constant') == 'constant' and \
+            set(kwargs) <= {'order', 'mode', 'cval'}:
+        zi = sampler.sample(xi, yi, method='linear' if order else 'nearest',
+                            fill=kwargs.get('cval', 0.0))
+        
+        # Integer rasters give rounded integers (as map_coordinates)
+        if sampler.z.dtype.kind in 'iub':
+            zi = np.trunc(zi + np.copysign(0.5, zi)).astype(sampler.z.dtype)
+        
+        return zi
     
-    x_s, y_s = x[1] - x[0], y[1] - y[0]
+    # Spline interpolation
+    xi, yi = np.broadcast_arrays(np.asarray(xi, dtype='float64'),
+                                 np.asarray(yi, dtype='float64'))
     
-    if np.size(xi) == 1 and np.size(yi) > 1:
-        xi = xi * ones(yi.size)
-    elif np.size(yi) == 1 and np.size(xi) > 1:
-        yi = yi * ones(xi.size)
+    xp, yp = sampler.coords(xi.ravel(), yi.ravel())
     
-    xp = (xi - x[0]) * (nx - 1) / (x[-1] - x[0])
-    yp = (yi - y[0]) * (ny - 1) / (y[-1] - y[0])
-
     coord = np.vstack([yp, xp])
     
-    zi = map_coordinates(z, coord, **kwargs)
+    zi = map_coordinates(sampler.z, coord, **kwargs)
     
-    return zi
+    return zi.reshape(xi.shape)
 
 
@@ -0,0 +1,240 @@
+"""
+Crossover finder for reduced ATL06 tracks (see readatl06.py).
+
+Tracks are cut into short pieces of a fixed number of points. Candidate
+pairs of pieces from different tracks are found with a KD-tree over the
+piece centres and pruned with their bounding boxes, so only pieces that
+can actually cross are compared. The segments of each candidate pair are
+intersected all at once and heights/times interpolated on both tracks.
+The search runs region by region, optionally on several processes.
+
+Example:
+
+    tracks = read_tracks(sorted(glob.glob('ATL06_reduced/*.h5')), proj='3031')
+    xo = find_crossovers(tracks, region=500e3, njobs=8)
+    save_crossovers('IS2_XOVER.h5', xo)
+
+"""
+
+import numpy as np
+import h5py
+from scipy.spatial import cKDTree
+from concurrent.futures import ProcessPoolExecutor
+
+from utils import transform_coord
+
+
+def read_tracks(files, proj='3031', vars=('lon', 'lat', 'h_elv', 't_year', 'orbit', 'trk_type')):
+    """Tracks (x, y, h, t arrays sorted by time) from reduced ATL06 files.
+
+    A track is one orbit number and track type (ascending/descending) of
+    one file. Returns a list of (x, y, h, t) tuples.
+    """
+
+    tracks = []
+
+    for fname in files:
+        with h5py.File(fname, 'r') as f:
+            lon, lat, h, t = [f[v][:] for v in vars[0:4]]
+            orb = f[vars[4]][:] if vars[4] in f else np.zeros(len(t))
+            typ = f[vars[5]][:] if vars[5] in f else np.zeros(len(t))
+
+        x, y = transform_coord('4326', proj, lon, lat)
+        x, y = np.asarray(x), np.asarray(y)
+
+        # Split by orbit and track type
+        key = np.unique(np.c_[orb, typ], axis=0, return_inverse=True)[1].ravel()
+        for k in np.unique(key):
+            i = np.flatnonzero(key == k)
+            i = i[np.argsort(t[i], kind='mergesort')]
+            tracks.append((x[i], y[i], h[i], t[i]))
+
+    return tracks
+
+
+def make_pieces(tracks, npts=50, maxgap=200.):
+    """Cut tracks into pieces of npts points (consecutive pieces share a point).
+
+    Tracks are first split where points are more than maxgap apart.
+    Returns padded (pieces x npts) arrays of x, y, h, t (nan padding) and
+    the track number of each piece.
+    """
+
+    X, Y, H, T, trk = [], [], [], [], []
+
+    for k, (x, y, h, t) in enumerate(tracks):
+
+        ok = np.isfinite(x) & np.isfinite(y) & np.isfinite(h) & np.isfinite(t)
+        x, y, h, t = x[ok], y[ok], h[ok], t[ok]
+        if len(x) < 2: continue
+
+        # Split at data gaps
+        gap = np.flatnonzero(np.hypot(np.diff(x), np.diff(y)) > maxgap) + 1
+        for i0, i1 in zip(np.r_[0, gap], np.r_[gap, len(x)]):
+
+            if i1 - i0 < 2: continue
+
+            # Start of each piece (overlap of one point)
+            starts = np.arange(i0, i1 - 1, npts - 1)
+            idx = starts[:, None] + np.arange(npts)[None, :]
+            pad = idx >= i1
+            idx = np.where(pad, i1 - 1, idx)
+
+            for v, out in zip((x, y, h, t), (X, Y, H, T)):
+                out.append(np.where(pad, np.nan, v[idx]))
+            trk.append(np.full(len(starts), k))
+
+    if len(X) == 0:
+        return [np.zeros((0, npts))] * 4 + [np.zeros(0, int)]
+
+    return [np.vstack(v) for v in (X, Y, H, T)] + [np.concatenate(trk)]
+
+
+def intersect_pieces(pa, pb):
+    """Intersections of the segments of pairs of pieces.
+
+    pa/pb are (x, y, h, t) arrays of shape (pairs, npts). Returns the pair
+    number, position x, y and the interpolated h, t on both pieces.
+    """
+
+    xa, ya, ha, ta = [v[:, :, None] for v in pa]
+    xb, yb, hb, tb = [v[:, None, :] for v in pb]
+
+    # Segment start points and directions
+    px, py, rx, ry = xa[:, :-1], ya[:, :-1], np.diff(xa, axis=1), np.diff(ya, axis=1)
+    qx, qy, sx, sy = xb[:, :, :-1], yb[:, :, :-1], np.diff(xb, axis=2), np.diff(yb, axis=2)
+
+    # Solve p + u * r = q + v * s
+    with np.errstate(invalid='ignore', divide='ignore'):
+        den = rx * sy - ry * sx
+        u = ((qx - px) * sy - (qy - py) * sx) / den
+        v = ((qx - px) * ry - (qy - py) * rx) / den
+
+    # Half-open segments so a crossing at a shared vertex counts once
+    hit = (den != 0) & (u >= 0) & (u < 1) & (v >= 0) & (v < 1)
+    k, i, j = np.nonzero(hit)
+    u, v = u[k, i, j], v[k, i, j]
+
+    # Interpolate along each piece
+    xa, ya, ha, ta = [z[:, :, 0] for z in (xa, ya, ha, ta)]
+    xb, yb, hb, tb = [z[:, 0, :] for z in (xb, yb, hb, tb)]
+    x = xa[k, i] + u * (xa[k, i + 1] - xa[k, i])
+    y = ya[k, i] + u * (ya[k, i + 1] - ya[k, i])
+    h1 = ha[k, i] + u * (ha[k, i + 1] - ha[k, i])
+    t1 = ta[k, i] + u * (ta[k, i + 1] - ta[k, i])
+    h2 = hb[k, j] + v * (hb[k, j + 1] - hb[k, j])
+    t2 = tb[k, j] + v * (tb[k, j + 1] - tb[k, j])
+
+    return k, x, y, h1, t1, h2, t2
+
+
+def region_crossovers(ids, pieces, trk, own, radius, batch=2000):
+    """Crossovers among a set of pieces, keeping pairs owned by this region.
+
+    ids are global piece numbers; own flags the pieces of the region (the
+    others are halo). A pair is kept if its lowest piece number is owned.
+    """
+
+    X, Y, H, T = pieces
+
+    # Bounding boxes and centres of the pieces
+    bx0, bx1 = np.nanmin(X, axis=1), np.nanmax(X, axis=1)
+    by0, by1 = np.nanmin(Y, axis=1), np.nanmax(Y, axis=1)
+    c = np.c_[0.5 * (bx0 + bx1), 0.5 * (by0 + by1)]
+
+    # Candidate pairs from the centres, then box overlap and different tracks
+    pairs = cKDTree(c).query_pairs(radius)
+    pairs = np.array(sorted(pairs), dtype=int).reshape(-1, 2)
+    a, b = pairs[:, 0], pairs[:, 1]
+    lo = np.where(ids[a] < ids[b], a, b)
+    keep = ((trk[a] != trk[b]) & own[lo] &
+            (bx0[a] <= bx1[b]) & (bx0[b] <= bx1[a]) & (by0[a] <= by1[b]) & (by0[b] <= by1[a]))
+    a, b = a[keep], b[keep]
+
+    out = []
+    for i0 in range(0, len(a), batch):
+        ia, ib = a[i0:i0 + batch], b[i0:i0 + batch]
+        k, x, y, h1, t1, h2, t2 = intersect_pieces([v[ia] for v in pieces], [v[ib] for v in pieces])
+        out.append((x, y, h1, t1, h2, t2, trk[ia[k]], trk[ib[k]]))
+
+    if len(out) == 0:
+        return [np.zeros(0)] * 6 + [np.zeros(0, int)] * 2
+
+    return [np.concatenate(v) for v in zip(*out)]
+
+
+def find_crossovers(tracks, npts=50, maxgap=200., region=500e3, njobs=1, verbose=True):
+    """Crossovers between all tracks (list of x, y, h, t arrays).
+
+    Tracks are cut into pieces of npts points and split at gaps of more
+    than maxgap (m). The domain is split into square regions of size
+    region, searched on njobs processes.
+
+    Returns a dict of columns: x, y, h1, h2, t1, t2 (1 = the earlier pass),
+    dh = h2 - h1, dt = t2 - t1, dhdt and the track numbers track1/track2.
+    """
+
+    X, Y, H, T, trk = make_pieces(tracks, npts, maxgap)
+
+    # Search radius between piece centres for overlapping boxes
+    hx = 0.5 * (np.nanmax(X, axis=1) - np.nanmin(X, axis=1))
+    hy = 0.5 * (np.nanmax(Y, axis=1) - np.nanmin(Y, axis=1))
+    radius = 2 * np.hypot(hx, hy).max() if len(hx) else 0.
+
+    # Region of each piece (by its centre)
+    cx = np.nanmin(X, axis=1) + hx
+    cy = np.nanmin(Y, axis=1) + hy
+    rx = np.floor(cx / region).astype(int)
+    ry = np.floor(cy / region).astype(int)
+    regions = np.unique(np.c_[rx, ry], axis=0) if len(cx) else np.zeros((0, 2), int)
+
+    if verbose: print(len(tracks), 'tracks,', len(trk), 'pieces,', len(regions), 'regions')
+
+    def args(r):
+        # Pieces of the region plus halo within the search radius
+        x0, y0 = r[0] * region, r[1] * region
+        sel = np.flatnonzero((cx >= x0 - radius) & (cx < x0 + region + radius) &
+                             (cy >= y0 - radius) & (cy < y0 + region + radius))
+        own = (rx[sel] == r[0]) & (ry[sel] == r[1])
+        return sel, [X[sel], Y[sel], H[sel], T[sel]], trk[sel], own, radius
+
+    results = []
+    if njobs == 1:
+        for r in regions: results.append(region_crossovers(*args(r)))
+    else:
+        with ProcessPoolExecutor(max_workers=njobs) as executor:
+            pending = []
+            for r in list(regions) + [None]:
+                if r is not None:
+                    pending.append(executor.submit(region_crossovers, *args(r)))
+                # Keep a bounded number of regions in flight
+                while pending and (len(pending) >= 2 * njobs or r is None):
+                    results.append(pending.pop(0).result())
+
+    if len(results) == 0:
+        x, y, h1, t1, h2, t2 = [np.zeros(0)] * 6
+        k1, k2 = [np.zeros(0, int)] * 2
+    else:
+        x, y, h1, t1, h2, t2, k1, k2 = [np.concatenate(v) for v in zip(*results)]
+
+    # Order each crossover in time
+    swap = t2 < t1
+    h1, h2 = np.where(swap, h2, h1), np.where(swap, h1, h2)
+    t1, t2 = np.where(swap, t2, t1), np.where(swap, t1, t2)
+    k1, k2 = np.where(swap, k2, k1), np.where(swap, k1, k2)
+
+    dh, dt = h2 - h1, t2 - t1
+    with np.errstate(invalid='ignore', divide='ignore'):
+        dhdt = dh / dt
+
+    if verbose: print(len(x), 'crossovers')
+
+    return {'x': x, 'y': y, 'h1': h1, 'h2': h2, 't1': t1, 't2': t2,
+            'dh': dh, 'dt': dt, 'dhdt': dhdt, 'track1': k1, 'track2': k2}
+
+
+def save_crossovers(fname, xo):
+    """Save a crossover table (dict of columns) to HDF5."""
+
+    with h5py.File(fname, 'w') as f:
+        for key, v in xo.items(): f[key] = v
@@ -0,0 +1,123 @@
+""" Benchmark of the GPS/UNIX time utilities in utils.py
+
+Compares the vectorized leap second handling in utils.py against the original
+loop implementations (one full scan of the time array per leap second), and the
+calendar fields of convert_GPS_to_calendar against convert_GPS_time, checks
+they give the same answers and prints the timings.
+
+Run from this directory:
+    python benchmark_time.py [number of times]
+
+"""
+
+import sys
+import time
+import numpy as np
+import utils as ut
+
+
+def count_leaps_loop(GPS_Time):
+    # Original implementation (Tyler Sutterley)
+    leaps = ut.get_leaps()
+    n_leaps = np.zeros_like(GPS_Time, dtype=np.uint)
+    for i,leap in enumerate(leaps):
+        count = np.count_nonzero(GPS_Time >= leap)
+        if (count > 0):
+            indices, = np.nonzero(GPS_Time >= leap)
+            n_leaps[indices] += 1
+    return n_leaps
+
+
+def is_leap_loop(GPS_Time):
+    # Original implementation (Tyler Sutterley)
+    leaps = ut.get_leaps()
+    Flag = np.zeros_like(GPS_Time, dtype=bool)
+    for leap in leaps:
+        count = np.count_nonzero(np.floor(GPS_Time) == leap)
+        if (count > 0):
+            indices, = np.nonzero(np.floor(GPS_Time) == leap)
+            Flag[indices] = True
+    return Flag
+
+
+def convert_GPS_to_UNIX_loop(GPS_Time):
+    # Original implementation (Tyler Sutterley)
+    UNIX_Time = GPS_Time + 315964800
+    n_leaps = count_leaps_loop(GPS_Time)
+    UNIX_Time -= n_leaps
+    Flag = is_leap_loop(GPS_Time)
+    if Flag.any():
+        indices, = np.nonzero(Flag)
+        UNIX_Time[indices] += 0.5
+    return UNIX_Time
+
+
+def convert_UNIX_to_GPS_loop(UNIX_Time):
+    # Original implementation (Tyler Sutterley), modifies UNIX_Time in place
+    offset = np.zeros_like(UNIX_Time)
+    count = np.count_nonzero((UNIX_Time % 1) != 0)
+    if (count > 0):
+        indices, = np.nonzero((UNIX_Time % 1) != 0)
+        UNIX_Time[indices] -= 0.5
+        offset[indices] = 1.0
+    GPS_Time = UNIX_Time - 315964800
+    leaps = ut.get_leaps()
+    n_leaps = np.zeros_like(GPS_Time, dtype=np.uint)
+    for i,leap in enumerate(leaps):
+        count = np.count_nonzero(GPS_Time >= (leap - i))
+        if (count > 0):
+            indices, = np.nonzero(GPS_Time >= (leap - i))
+            n_leaps[indices] += 1
+    GPS_Time += n_leaps + offset
+    return GPS_Time
+
+
+def timeit(func, *args):
+    """ Best of three wall clock times (s) and the result of the last call """
+    times = []
+    for i in range(3):
+        t0 = time.perf_counter()
+        result = func(*args)
+        times.append(time.perf_counter() - t0)
+    return min(times), result
+
+
+if __name__ == '__main__':
+
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 10000000
+
+    # GPS times spanning all leap seconds (and a few leap seconds themselves)
+    GPS_Time = np.sort(np.random.uniform(0, 1.3e9, n))
+    GPS_Time[:len(ut.get_leaps())] = np.asarray(ut.get_leaps()) + 0.25
+    UNIX_Time = convert_GPS_to_UNIX_loop(GPS_Time)
+
+    print('Number of times:', n)
+    print('%-26s %10s %10s %8s' % ('function', 'loop (s)', 'new (s)', 'speedup'))
+
+    tests = [('count_leaps', count_leaps_loop, ut.count_leaps, GPS_Time),
+             ('is_leap', is_leap_loop, ut.is_leap, GPS_Time),
+             ('convert_GPS_to_UNIX', convert_GPS_to_UNIX_loop, ut.convert_GPS_to_UNIX, GPS_Time),
+             ('convert_UNIX_to_GPS', lambda t: convert_UNIX_to_GPS_loop(t.copy()), ut.convert_UNIX_to_GPS, UNIX_Time)]
+
+    for name, loopFunc, newFunc, data in tests:
+        tLoop, resultLoop = timeit(loopFunc, data)
+        tNew, resultNew = timeit(newFunc, data)
+        assert np.array_equal(resultLoop, resultNew), name
+        print('%-26s %10.3f %10.3f %7.1fx' % (name, tLoop, tNew, tLoop/tNew))
+
+    # Calendar fields: Julian date arithmetic (convert_GPS_time) against integer day numbers
+    tCal, resultCal = timeit(ut.convert_GPS_time, GPS_Time)
+    tFields, resultFields = timeit(ut.convert_GPS_to_calendar, GPS_Time)
+    # Same calendar instant (the Julian date seconds can round up to 60 at the end of a minute,
+    # and convert_GPS_time adds half a second inside leap seconds)
+    for key in ['year', 'month', 'day']:
+        assert np.array_equal(resultCal[key], resultFields[key]), key
+    secCal = 3600*resultCal['hour'] + 60*resultCal['minute'] + resultCal['second']
+    secFields = 3600*resultFields['hour'] + 60*resultFields['minute'] + resultFields['second']
+    leap = ut.is_leap(GPS_Time)
+    assert np.abs(secCal - secFields)[~leap].max() < 1e-3, 'convert_GPS_to_calendar'
+    print('%-26s %10.3f %10.3f %7.1fx' % ('convert_GPS_to_calendar', tCal, tFields, tCal/tFields))
+
+    # Datetimes for the same times
+    tDt, _ = timeit(ut.convert_GPS_to_datetime64, GPS_Time)
+    print('%-26s %10s %10.3f' % ('convert_GPS_to_datetime64', '', tDt))
@@ -12,7 +12,7 @@ import h5py
 import xarray as xr
 import datetime as dt
 
-def getATL03data(fileT, numpyout=False, beam='gt1l'):
+def getATL03data(fileT, numpyout=False, beam='gt1l', useFloat32=False, addDatetime=True):
     """ Pandas/numpy ATL03 reader
     Written by Alek Petty, June 2018 (alek.a.petty@nasa.gov)
 
@@ -26,6 +26,9 @@ def getATL03data(fileT, numpyout=False, beam='gt1l'):
         fileT (str): File path of the ATL03 dataset
         numpy (flag): Binary flag for outputting numpy arrays (True) or pandas dataframe (False)
         beam (str): ICESat-2 beam (the number is the pair, r=strong, l=weak)
+        useFloat32 (flag): read heights, lons, lats and delta_time as 32-bit floats 
+            to halve their memory (lon/lat precision drops to ~1 m)
+        addDatetime (flag): add the photon datetime column (skip it to save memory/time)
         
     returns:
         either: select numpy arrays or a pandas dataframe
@@ -37,9 +40,19 @@ def getATL03data(fileT, numpyout=False, beam='gt1l'):
         ATL03 = h5py.File(fileT, 'r')
     except:
         'Not a valid file'
+    
+    floatType = np.float32 if useFloat32 else np.float64
+    
+    def readVar(var):
+        # Read straight into an array of the requested precision (no float64 copy)
+        ds = ATL03[beam+'/heights/'+var]
+        data = np.empty(ds.shape, dtype=floatType)
+        if data.size > 0:
+            ds.read_direct(data)
+        return data
         
-    lons=ATL03[beam+'/heights/lon_ph'][:]
-    lats=ATL03[beam+'/heights/lat_ph'][:]
+    lons=readVar('lon_ph')
+    lats=readVar('lat_ph')
     
     #  Number of seconds since the GPS epoch on midnight Jan. 6, 1980 
     delta_time=ATL03[beam+'/heights/delta_time'][:] 
@@ -47,29 +60,19 @@ def getATL03data(fileT, numpyout=False, beam='gt1l'):
     # #Add this value to delta time parameters to compute the full gps_seconds
     atlas_epoch=ATL03['/ancillary_data/atlas_sdp_gps_epoch'][:] 
     
-    # Conversion of delta_time to a calendar date
-    # This function seems pretty convoluted but it works for now..
-    # I'm sure there is a simpler function we can use here instead.
-    temp = ut.convert_GPS_time(atlas_epoch[0] + delta_time, OFFSET=0.0)
-    
-    # Express delta_time relative to start time of granule
-    delta_time_granule=delta_time-delta_time[0]
-
-    year = temp['year'][:].astype('int')
-    month = temp['month'][:].astype('int')
-    day = temp['day'][:].astype('int')
-    hour = temp['hour'][:].astype('int')
-    minute = temp['minute'][:].astype('int')
-    second = temp['second'][:].astype('int')
-    
-    dFtime=pd.DataFrame({'year':year, 'month':month, 'day':day, 
-                        'hour':hour, 'minute':minute, 'second':second})
+    # Conversion of delta_time to a calendar date, straight to datetime64[ns]
+    if addDatetime:
+        datetimes = ut.convert_GPS_to_datetime64(delta_time, OFFSET=atlas_epoch[0])
     
+    # Express delta_time relative to start time of granule (in place)
+    if delta_time.size > 0:
+        delta_time -= delta_time[0]
+    delta_time_granule=delta_time.astype(floatType, copy=False)
     
     # Primary variables of interest
     
     # Photon height
-    heights=ATL03[beam+'/heights/h_ph'][:]
+    heights=readVar('h_ph')
     print(heights.shape)
     
     # Flag for signal confidence
@@ -93,9 +96,9 @@ def getATL03data(fileT, numpyout=False, beam='gt1l'):
                        'signal_confidence':signal_confidence, 
                        'delta_time':delta_time_granule})
     
-    # Add the datetime string
-    dFtimepd=pd.to_datetime(dFtime)
-    dF['datetime'] = pd.Series(dFtimepd, index=dF.index)
+    # Add the datetime column
+    if addDatetime:
+        dF['datetime'] = datetimes
     
     # Filter out high elevation values 
     #dF = dF[(dF['signal_confidence']>2)]
@@ -127,6 +130,7 @@ def getATL07data(fileT, numpy=False, beamNum=1, maxElev=1e6):
         either: select numpy arrays or a pandas dataframe
         
     Updates:
+        V4 raise an IOError for invalid files instead of returning an error string
         V3 (June 2018) added observatory orientation flag, read in the beam number, not the string
         V2 (June 2018) used astropy to more simply generate a datetime instance form the gps time
 
@@ -135,22 +139,12 @@ def getATL07data(fileT, numpy=False, beamNum=1, maxElev=1e6):
     # Open the file
     try:
         ATL07 = h5py.File(fileT, 'r')
-    except:
-        return 'Not a valid file'
+    except (IOError, OSError):
+        raise IOError('Not a valid file: '+str(fileT))
     
     #flag_values: 0, 1, 2; flag_meanings : backward forward transition
     orientation_flag=ATL07['orbit_info']['sc_orient'][:]
-    
-    if (orientation_flag==0):
-        print('Backward orientation')
-        beamStrs=['gt1l', 'gt1r', 'gt2l', 'gt2r', 'gt3l', 'gt3r']
-                
-    elif (orientation_flag==1):
-        print('Forward orientation')
-        beamStrs=['gt3r', 'gt3l', 'gt2r', 'gt2l', 'gt1r', 'gt1l']
-        
-    elif (orientation_flag==2):
-        print('Transitioning, do not use for science!')
+    beamStrs=getBeamStrs(orientation_flag)
     
     beamStr=beamStrs[beamNum-1]
     print(beamStr)
@@ -249,6 +243,216 @@ def getATL07data(fileT, numpy=False, beamNum=1, maxElev=1e6):
 
 
 
+# ATL07 sea_ice_segments variables (output column name: path relative to /gtXX/sea_ice_segments)
+ATL07vars = {'lons':'longitude', 'lats':'latitude', 'delta_time':'delta_time',
+             'height_segment_id':'height_segment_id', 'seg_dist_x':'seg_dist_x',
+             'elev':'heights/height_segment_height', 'ssh_flag':'heights/height_segment_ssh_flag',
+             'quality_flag':'heights/height_segment_quality', 'elev_rms':'heights/height_segment_rms',
+             'seg_length':'heights/height_segment_length_seg', 
+             'height_confidence':'heights/height_segment_confidence',
+             'reflectance':'heights/height_segment_asr_calc', 'seg_type':'heights/height_segment_type',
+             'gauss_width':'heights/height_segment_w_gaussian',
+             'dac':'geophysical/height_segment_dac', 'earth':'geophysical/height_segment_earth',
+             'geoid':'geophysical/height_segment_geoid', 'loadTide':'geophysical/height_segment_load',
+             'oceanTide':'geophysical/height_segment_ocean', 'poleTide':'geophysical/height_segment_pole',
+             'mss':'geophysical/height_segment_mss',
+             'photon_rate':'stats/photon_rate', 'background_rate':'stats/backgr_calc'}
+
+# Default selection, the same columns as getATL07data
+ATL07defaultVars = ('elev', 'lons', 'lats', 'ssh_flag', 'quality_flag', 'delta_time', 'seg_dist_x',
+                    'height_segment_id', 'photon_rate', 'background_rate', 'mss', 'seg_length')
+
+
+def getBeamStrs(orientation_flag):
+    """ Beam strings ordered by ATLAS beam number (1 to 6) for a given observatory orientation
+    
+    ATLAS beams 1, 3 and 5 are the strong beams, so element 0, 2 and 4 of the list are strong.
+    
+    Args:
+        orientation_flag (int): orbit_info/sc_orient flag (0=backward, 1=forward, 2=transition)
+
+    returns:
+        list of the six beam strings (beam 1 first)
+
+    """
+    
+    if (orientation_flag==0):
+        print('Backward orientation')
+        beamStrs=['gt1l', 'gt1r', 'gt2l', 'gt2r', 'gt3l', 'gt3r']
+                
+    elif (orientation_flag==1):
+        print('Forward orientation')
+        beamStrs=['gt3r', 'gt3l', 'gt2r', 'gt2l', 'gt1r', 'gt1l']
+        
+    else:
+        raise ValueError('Transitioning orientation (sc_orient=2), do not use for science!')
+    
+    return beamStrs
+
+
+def getATL07beams(fileT, beamNums=(1, 2, 3, 4, 5, 6), varNames=ATL07defaultVars, maxElev=1e6, addDatetime=True):
+    """ All-beam pandas ATL07 reader
+    
+    Reads the selected sea_ice_segments variables for all requested beams with one file open,
+    resolving the beam strings (and so strong/weak beams) from sc_orient once. 
+    
+    Args:
+        fileT (str): File path of the ATL07 dataset
+        beamNums (list): ICESat-2 beam numbers (1 to 6) to read, beams missing from the file are skipped
+        varNames (list): column names to read (keys of ATL07vars)
+        maxElev (float): maximum surface elevation to remove anomalies
+        addDatetime (flag): add a datetime64 column
+
+    returns:
+        pandas dataframe with one row per segment and beam, beamStr and strong columns.
+        If seg_dist_x is read, along_track_distance (relative to the start of each beam) is added.
+
+    """
+    
+    # Open the file
+    try:
+        ATL07 = h5py.File(fileT, 'r')
+    except (IOError, OSError):
+        raise IOError('Not a valid file: '+str(fileT))
+    
+    with ATL07:
+        beamStrs=getBeamStrs(ATL07['orbit_info']['sc_orient'][0])
+        atlas_epoch=ATL07['/ancillary_data/atlas_sdp_gps_epoch'][0]
+        
+        # Always need the elevation for the maxElev filter and time for the datetime
+        readVars=list(varNames)
+        for var in ['elev', 'delta_time']:
+            if var not in readVars:
+                readVars.append(var)
+        
+        dFbeams=[]
+        for beamNum in beamNums:
+            beamStr=beamStrs[beamNum-1]
+            if beamStr+'/sea_ice_segments' not in ATL07:
+                continue
+            group=ATL07[beamStr+'/sea_ice_segments']
+            
+            data={}
+            for var in readVars:
+                data[var]=group[ATL07vars[var]][:]
+            
+            # Filter out high elevation values before building the table
+            good=data['elev']<maxElev
+            if 'seg_dist_x' in data and data['seg_dist_x'].size > 0:
+                data['along_track_distance']=data['seg_dist_x']-data['seg_dist_x'][0]
+            if addDatetime:
+                data['datetime']=ut.convert_GPS_to_datetime64(data['delta_time'], OFFSET=atlas_epoch)
+            if not good.all():
+                data={var:data[var][good] for var in data}
+            
+            dF=pd.DataFrame({var:data[var] for var in data if (var in varNames) or (var not in readVars)})
+            dF['beam']=np.int8(beamNum)
+            dF['beamStr']=beamStr
+            dF['strong']=(beamNum%2==1)
+            dFbeams.append(dF)
+    
+    if len(dFbeams)==0:
+        return pd.DataFrame(columns=list(varNames)+['beam', 'beamStr', 'strong'])
+    
+    dF=pd.concat(dFbeams, ignore_index=True)
+    dF['beamStr']=dF['beamStr'].astype('category')
+    return dF
+
+
+def _readGranule(readFunc, fileT, skipErrors, kwargs):
+    """ readFunc for one granule, returning None (and printing why) on an unreadable file if skipErrors
+    (only I/O errors are skipped, anything else is raised) """
+    try:
+        return readFunc(fileT, **kwargs)
+    except (IOError, OSError) as e:
+        if not skipErrors:
+            raise
+        print('Skipping', fileT, e)
+        return None
+
+
+def iterGranules(readFunc, files, njobs=1, skipErrors=True, yieldSkipped=False, **kwargs):
+    """ Apply a granule reader (e.g. getATL07beams, getATL10beams) to many files, optionally in parallel
+    
+    A generator: at most 2*njobs granules are read ahead of the consumer, so memory
+    stays bounded however many files are passed.
+    
+    Args:
+        readFunc (function): module level reader taking the file path as first argument
+        files (list): File paths of the datasets
+        njobs (int): number of worker processes (1 = read in this process)
+        skipErrors (flag): print and skip unreadable granules (I/O errors) instead of raising
+        yieldSkipped (flag): also yield (file, None) for the skipped granules
+        kwargs: passed to readFunc
+
+    returns:
+        yields (file, dataframe) pairs in the order of files
+
+    """
+    
+    if njobs==1:
+        for fileT in files:
+            dF=_readGranule(readFunc, fileT, skipErrors, kwargs)
+            if dF is not None or yieldSkipped:
+                yield fileT, dF
+        return
+    
+    from concurrent.futures import ProcessPoolExecutor
+    
+    with ProcessPoolExecutor(max_workers=njobs) as executor:
+        pending=[]
+        for fileT in files:
+            pending.append((fileT, executor.submit(_readGranule, readFunc, fileT, skipErrors, kwargs)))
+            # Keep a bounded number of granules in flight
+            if len(pending) >= 2*njobs:
+                fileDone, future=pending.pop(0)
+                dF=future.result()
+                if dF is not None or yieldSkipped:
+                    yield fileDone, dF
+        for fileDone, future in pending:
+            dF=future.result()
+            if dF is not None or yieldSkipped:
+                yield fileDone, dF
+
+
+def iterATL07batch(files, njobs=1, skipErrors=True, **kwargs):
+    """ Read many ATL07 granules with getATL07beams (see iterGranules)
+    
+    returns:
+        yields (file, dataframe) pairs in the order of files
+
+    """
+    return iterGranules(getATL07beams, files, njobs=njobs, skipErrors=skipErrors, **kwargs)
+
+
+def getATL07batch(files, njobs=1, skipErrors=True, **kwargs):
+    """ Read many ATL07 granules (all beams) into one pandas dataframe
+    
+    Args:
+        files (list): File paths of the ATL07 datasets
+        njobs (int): number of worker processes
+        skipErrors (flag): print and skip unreadable granules (I/O errors) instead of raising
+        kwargs: passed to getATL07beams (beamNums, varNames, maxElev, addDatetime)
+
+    returns:
+        pandas dataframe with a granule column (index into files) and a beam column
+
+    """
+    
+    fileIndex={fileT:i for i, fileT in enumerate(files)}
+    dFs=[]
+    for fileT, dF in iterATL07batch(files, njobs=njobs, skipErrors=skipErrors, **kwargs):
+        dF['granule']=np.int32(fileIndex[fileT])
+        dFs.append(dF)
+    
+    if len(dFs)==0:
+        return pd.DataFrame()
+    
+    dF=pd.concat(dFs, ignore_index=True)
+    dF['beamStr']=dF['beamStr'].astype('category')
+    return dF
+
+
 def getATL03dict(FILENAME, ATTRIBUTES=True, VERBOSE=False):
     """ Dictionary ATL03 reader
     Created by the NASA GSFC Python 2018
@@ -423,7 +627,7 @@ def getATL03dict(FILENAME, ATTRIBUTES=True, VERBOSE=False):
 
 
 
-def getATL03xr(fileT, beamStr, groupStr='sea_ice_segments', fileinfo=False):
+def getATL03xr(fileT, beamStr, groupStr='sea_ice_segments', fileinfo=False, chunkSize=1000000, toDataframe=False):
     """ xarray ATL03 reader
     Written by Alek Petty, June 2018 (alek.a.petty@nasa.gov)
 
@@ -433,32 +637,20 @@ def getATL03xr(fileT, beamStr, groupStr='sea_ice_segments', fileinfo=False):
 		fileT (str): File path of the ATL03 dataset
 		beamStr (str): ICESat-2 beam (the number is the pair, r=strong, l=weak)
         groupStr (str): subgroup of data in the ATL07 file we want to extract.
+        chunkSize (int): number of photons per dask chunk (None to load eagerly)
+        toDataframe (flag): load everything into a pandas dataframe (the old behaviour)
 
 	returns:
-        xarrray dataframe
+        lazily loaded, chunked xarray dataset indexed by photon number
+        (delta_time is kept as a coordinate), or a pandas dataframe if toDataframe
 
 	"""
-    dsHeights = xr.open_dataset(fileT,group='/'+beamStr+'/heights/')
-    #dalons = xr.DataArray(dsHeights.coords['lon_ph'].values,
-    #              dims=['date_time'],
-    #              coords={dsHeights.coords['lon_ph']})
-    # Add delta time as a variable
-    
-    # Copy to pandas dataframe
-    dsHeightspd = dsHeights.to_dataframe()
-    dsHeightspd.reset_index()
-    
-    #dsHeightspd['delta_time']=dsHeights.coords['delta_time'].values
-    #dsHeights['lats']=dsHeights.coords['lat_ph'].values
-    # The height segment ID is a much better index/dimension (as delta_time has some duplicates)
-    # Need to do this before merging the datasets
-    #dsMain = dsMain.swap_dims({'delta_time': 'height_segment_id'})
+    chunks = None if chunkSize is None else {'delta_time': chunkSize}
+    dsHeights = xr.open_dataset(fileT,group='/'+beamStr+'/heights/', chunks=chunks)
     
-    # Merge the datasets
-    #dsAll=xr.merge([dsHeights, dsMain])
-    
-    #dsHeights = dsHeights.swap_dims({'delta_time': 'height_segment_id'})
-    #calDates=dsMain.coords['delta_time'].values
+    # delta_time has duplicates, so index the photons by their position in the beam instead
+    dsHeights = dsHeights.assign_coords(photon=('delta_time', np.arange(dsHeights.sizes['delta_time'])))
+    dsHeights = dsHeights.swap_dims({'delta_time': 'photon'})
     
     if fileinfo==True:
         f = h5py.File(dataFile,'r')
@@ -472,9 +664,14 @@ def getATL03xr(fileT, beamStr, groupStr='sea_ice_segments', fileinfo=False):
                 print('---')
                 for d in group.keys():
                     print(group[d])
-    return dsHeightspd
+    
+    if toDataframe:
+        # Copy to pandas dataframe (loads every photon variable)
+        return dsHeights.to_dataframe()
+    
+    return dsHeights
 
-def getATL07xr(fileT, beamStr, groupStr='sea_ice_segments', fileinfo=False):
+def getATL07xr(fileT, beamStr, groupStr='sea_ice_segments', fileinfo=False, chunkSize=100000):
     """ xarray ATL07 reader
     Written by Alek Petty, June 2018 (alek.a.petty@nasa.gov)
 
@@ -484,23 +681,28 @@ def getATL07xr(fileT, beamStr, groupStr='sea_ice_segments', fileinfo=False):
 		fileT (str): File path of the ATL07 dataset
 		beamStr (str): ICESat-2 beam (the number is the pair, r=strong, l=weak)
         groupStr (str): subgroup of data in the ATL07 file we want to extract.
+        chunkSize (int): number of segments per dask chunk (None to load eagerly)
 
 	returns:
-        xarrray dataframe
+        lazily loaded, chunked xarray dataset indexed by height_segment_id
 
 	"""
-    dsMain = xr.open_dataset(fileT,group='/'+beamStr+'/'+'sea_ice_segments')
-    dsHeights = xr.open_dataset(fileT,group='/'+beamStr+'/'+'sea_ice_segments/heights/')
+    chunks = None if chunkSize is None else {'delta_time': chunkSize}
+    dsMain = xr.open_dataset(fileT,group='/'+beamStr+'/'+groupStr, chunks=chunks)
+    dsHeights = xr.open_dataset(fileT,group='/'+beamStr+'/'+groupStr+'/heights/', chunks=chunks)
     
     # The height segment ID is a much better index/dimension (as delta_time has some duplicates)
-    # Need to do this before merging the datasets
+    # Need to do this before merging the datasets. Only the index itself is loaded.
+    height_segment_id = dsMain['height_segment_id'].values
+    dsMain = dsMain.assign_coords(height_segment_id=('delta_time', height_segment_id))
     dsMain = dsMain.swap_dims({'delta_time': 'height_segment_id'})
     
-    # Merge the datasets
-    dsAll=xr.merge([dsHeights, dsMain])
+    # The heights subgroup shares the parent delta_time dimension
+    dsHeights = dsHeights.assign_coords(height_segment_id=('delta_time', height_segment_id))
+    dsHeights = dsHeights.swap_dims({'delta_time': 'height_segment_id'})
     
-    #dsHeights = dsHeights.swap_dims({'delta_time': 'height_segment_id'})
-    #calDates=dsMain.coords['delta_time'].values
+    # Merge the datasets (same index, so no data is loaded or realigned)
+    dsAll=xr.merge([dsHeights, dsMain])
     
     if fileinfo==True:
         f = h5py.File(dataFile,'r')
@@ -516,7 +718,169 @@ def getATL07xr(fileT, beamStr, groupStr='sea_ice_segments', fileinfo=False):
                     print(group[d])
     return dsAll
 
+def getATL07xrMulti(files, beamStr, groupStr='sea_ice_segments', chunkSize=100000):
+    """ Lazily open many ATL07 granules (e.g. a month) for one beam as a single xarray dataset
+    
+    Each granule is opened with getATL07xr (metadata and height_segment_id only) and the
+    granules are concatenated along height_segment_id, so selections, reductions and merges 
+    are run by dask, out of core and in parallel, when computed.
+    
+	Args:
+		files (list): File paths of the ATL07 datasets
+		beamStr (str): ICESat-2 beam (the number is the pair, r=strong, l=weak)
+        groupStr (str): subgroup of data in the ATL07 file we want to extract.
+        chunkSize (int): number of segments per dask chunk
+
+	returns:
+        lazily loaded xarray dataset with a granule coordinate (index into files)
+
+	"""
+    dsList = []
+    for i, fileT in enumerate(files):
+        ds = getATL07xr(fileT, beamStr, groupStr=groupStr, chunkSize=chunkSize)
+        ds = ds.assign_coords(granule=('height_segment_id', np.full(ds.sizes['height_segment_id'], i, dtype=np.int32)))
+        dsList.append(ds)
+    
+    return xr.concat(dsList, dim='height_segment_id')
+
+    
+# ATL10 beam_freeboard variables (output column name: path relative to /gtXX/freeboard_beam_segment/beam_freeboard)
+ATL10vars = {'freeboard':'beam_fb_height', 'freeboard_sigma':'beam_fb_sigma',
+             'freeboard_confidence':'beam_fb_confidence', 'freeboard_quality':'beam_fb_quality_flag',
+             'lon':'longitude', 'lat':'latitude', 'delta_time':'delta_time',
+             'height_segment_id':'height_segment_id', 'seg_x':'seg_dist_x'}
+
+
+def getATL10beams(fileT, beams=('gt1r', 'gt2r', 'gt3r'), varNames=('freeboard', 'lon', 'lat', 'delta_time'), 
+                  minFreeboard=0, maxFreeboard=10, maxQuality=None, minConfidence=None, 
+                  relativeTime=False, addDatetime=True):
+    """ Pandas ATL10 reader with the freeboard filters pushed down to the numpy arrays
+    
+    The freeboard (and optionally quality/confidence) predicates are evaluated on the
+    numpy arrays first, then the other variables are read only over the span of rows that
+    survive and masked, so the dataframe is only ever built from the filtered segments.
+    
+    Args:
+        fileT (str): File path of the ATL10 dataset
+        beams (list): ICESat-2 beam strings to read, beams missing from the file are skipped
+        varNames (list): column names to read (keys of ATL10vars)
+        minFreeboard (float): minimum freeboard (meters), rows with freeboard <= minFreeboard are dropped
+        maxFreeboard (float): maximum freeboard (meters), rows with freeboard >= maxFreeboard are dropped
+        maxQuality (int): if set, drop rows with beam_fb_quality_flag > maxQuality
+        minConfidence (float): if set, drop rows with beam_fb_confidence < minConfidence
+        relativeTime (flag): express delta_time relative to the first segment of each beam
+        addDatetime (flag): add datetime, year, month and day columns
+
+    returns:
+        pandas dataframe with a beam column
+
+    """
+    
+    try:
+        f1 = h5py.File(fileT, 'r')
+    except (IOError, OSError):
+        raise IOError('Not a valid file: '+str(fileT))
+    
+    with f1:
+        atlas_epoch=f1['/ancillary_data/atlas_sdp_gps_epoch'][0]
+        
+        dFbeams=[]
+        for beam in beams:
+            if beam+'/freeboard_beam_segment/beam_freeboard' not in f1:
+                continue
+            group=f1[beam]['freeboard_beam_segment']['beam_freeboard']
+            
+            # Evaluate the predicates before reading anything else
+            freeboard=group['beam_fb_height'][:]
+            mask=(freeboard>minFreeboard)&(freeboard<maxFreeboard)
+            if maxQuality is not None:
+                mask&=group['beam_fb_quality_flag'][:]<=maxQuality
+            if minConfidence is not None:
+                mask&=group['beam_fb_confidence'][:]>=minConfidence
+            
+            index,=np.nonzero(mask)
+            if index.size==0:
+                continue
+            
+            # Only read the span of rows holding surviving segments
+            i0, i1=index[0], index[-1]+1
+            maskSpan=mask[i0:i1]
+            
+            data={}
+            for var in varNames:
+                if var=='freeboard':
+                    data[var]=freeboard[index]
+                else:
+                    data[var]=group[ATL10vars[var]][i0:i1][maskSpan]
+            
+            if addDatetime:
+                if 'delta_time' in data:
+                    deltaTime=data['delta_time']
+                else:
+                    deltaTime=group['delta_time'][i0:i1][maskSpan]
+                datetimes=ut.convert_GPS_to_datetime64(deltaTime, OFFSET=atlas_epoch)
+                data['year'], data['month'], data['day']=ut.datetime64_to_ymd(datetimes)
+                data['datetime']=datetimes
+            if relativeTime and ('delta_time' in data):
+                data['delta_time']=data['delta_time']-group['delta_time'][0]
+            
+            dF=pd.DataFrame(data)
+            dF['beam']=beam
+            dFbeams.append(dF)
+    
+    if len(dFbeams)==0:
+        timeCols=['year', 'month', 'day', 'datetime'] if addDatetime else []
+        return pd.DataFrame(columns=list(varNames)+timeCols+['beam'])
+    
+    dF=pd.concat(dFbeams, ignore_index=True)
+    dF['beam']=dF['beam'].astype('category')
+    return dF
+
+
+def getATL10batch(files, beams=('gt1r', 'gt2r', 'gt3r'), groupBy=None, njobs=1, skipErrors=True, **kwargs):
+    """ Read many ATL10 granules and beams into concatenated dataframes
+    
+    Args:
+        files (list): File paths of the ATL10 datasets
+        beams (list): ICESat-2 beam strings to read
+        groupBy (str): None for one dataframe, 'day' or 'month' for one dataframe per day/month
+        njobs (int): number of worker processes
+        skipErrors (flag): print and skip unreadable granules (I/O errors) instead of raising
+        kwargs: passed to getATL10beams (varNames, freeboard/quality/confidence filters)
+
+    returns:
+        pandas dataframe with a granule column (index into files), or if groupBy is set
+        a dictionary of dataframes keyed by date string (YYYYMMDD or YYYYMM)
+
+    """
+    
+    if (groupBy is not None) and not kwargs.get('addDatetime', True):
+        raise ValueError('groupBy needs the datetime columns (addDatetime=True)')
+    
+    fileIndex={fileT:i for i, fileT in enumerate(files)}
+    dFs=[]
+    for fileT, dF in iterGranules(getATL10beams, files, njobs=njobs, skipErrors=skipErrors, beams=beams, **kwargs):
+        dF['granule']=np.int32(fileIndex[fileT])
+        dFs.append(dF)
+    
+    if len(dFs)==0:
+        return pd.DataFrame() if groupBy is None else {}
+    
+    dF=pd.concat(dFs, ignore_index=True)
+    dF['beam']=dF['beam'].astype('category')
     
+    if groupBy is None:
+        return dF
+    elif groupBy=='day':
+        keys, keyFormat=dF['datetime'].values.astype('datetime64[D]'), '%Y%m%d'
+    elif groupBy=='month':
+        keys, keyFormat=dF['datetime'].values.astype('datetime64[M]'), '%Y%m'
+    else:
+        raise ValueError("groupBy must be None, 'day' or 'month'")
+    
+    return {pd.Timestamp(key).strftime(keyFormat):group.reset_index(drop=True) for key, group in dF.groupby(keys)}
+
+
 def getATL10data(fileT, beam='gt1r', maxFreeboard=10):
     """ Pandas/numpy ATL10 reader
     Written by Alek Petty, June 2018 (alek.a.petty@nasa.gov)
@@ -526,6 +890,9 @@ def getATL10data(fileT, beam='gt1r', maxFreeboard=10):
     See the xarray or dictionary readers to load in the more complete ATL10 dataset
     or explore the hdf5 files themselves (I like using the app Panpoly for this) to see what else you might want
     
+    The freeboard filters are applied to the numpy arrays before the dataframe is built 
+    (see getATL10beams, and getATL10batch for many granules/beams)
+    
 	Args:
 		fileT (str): File path of the ATL10 dataset
 		beamStr (str): ICESat-2 beam (the number is the pair, r=strong, l=weak)
@@ -538,45 +905,11 @@ def getATL10data(fileT, beam='gt1r', maxFreeboard=10):
 
     print('ATL10 file:', fileT)
     
-    f1 = h5py.File(fileT, 'r')
-    
-    freeboard=f1[beam]['freeboard_beam_segment']['beam_freeboard']['beam_fb_height'][:]
-
-    freeboard_confidence=f1[beam]['freeboard_beam_segment']['beam_freeboard']['beam_fb_confidence'][:]
-    freeboard_quality=f1[beam]['freeboard_beam_segment']['beam_freeboard']['beam_fb_quality_flag'][:]
-    
-    lons=f1[beam]['freeboard_beam_segment']['beam_freeboard']['longitude'][:]
-    lats=f1[beam]['freeboard_beam_segment']['beam_freeboard']['latitude'][:]
-    deltaTime=f1[beam]['freeboard_beam_segment']['beam_freeboard']['delta_time'][:]-f1[beam]['freeboard_beam_segment']['beam_freeboard']['delta_time'][0]
-    
-    # #Add this value to delta time parameters to compute full gps_seconds
-    atlas_epoch=f1['/ancillary_data/atlas_sdp_gps_epoch'][:] 
-    
-    # Conversion of delta_time to a calendar date
-    temp = ut.convert_GPS_time(atlas_epoch[0] + deltaTime, OFFSET=0.0)
-    
-    
-    year = temp['year'][:].astype('int')
-    month = temp['month'][:].astype('int')
-    day = temp['day'][:].astype('int')
-    hour = temp['hour'][:].astype('int')
-    minute = temp['minute'][:].astype('int')
-    second = temp['second'][:].astype('int')
-    dFtime=pd.DataFrame({'year':year, 'month':month, 'day':day, 
-                        'hour':hour, 'minute':minute, 'second':second})
-    
-    dF = pd.DataFrame({'freeboard':freeboard, 'lon':lons, 'lat':lats, 'delta_time':deltaTime,
-                      'year':year, 'month':month, 'day':day})
-    
-    dFtimepd=pd.to_datetime(dFtime)
-    dF['datetime'] = pd.Series(dFtimepd, index=dF.index)
-    
-    
-    dF = dF[(dF['freeboard']>0)]
-    dF = dF[(dF['freeboard']<maxFreeboard)]
+    dF = getATL10beams(fileT, beams=[beam], varNames=['freeboard', 'lon', 'lat', 'delta_time'],
+                       minFreeboard=0, maxFreeboard=maxFreeboard, relativeTime=True)
     # Decide here if we want to also filter based on the confidence and/or quality flag
+    # (see the maxQuality and minConfidence options of getATL10beams)
     
-    # Reset row indexing
-    dF=dF.reset_index(drop=True)
+    dF = dF[['freeboard', 'lon', 'lat', 'delta_time', 'year', 'month', 'day', 'datetime']]
 
     return dF
@@ -0,0 +1,44 @@
+""" Tests of the NESOSIM snow co-location (run with pytest from this directory) """
+
+import numpy as np
+import xarray as xr
+import pytest
+import utils as ut
+
+
+def mapProj(lon, lat):
+    """ Plain scaling, so the NESOSIM lon/lat grid stays regular in x/y """
+    return np.asarray(lon)*1e5, np.asarray(lat)*1e5
+
+
+@pytest.fixture
+def fileSnow(tmp_path):
+    """ Small NESOSIM file on a regular lon/lat grid """
+    lon, lat = np.meshgrid(np.arange(-10., 10.), np.arange(70., 85.), indexing='ij')
+    rng = np.random.default_rng(0)
+    shape = (2,) + lon.shape
+    ds = xr.Dataset({'snowDepth': (('day', 'x', 'y'), rng.uniform(0.05, 0.5, shape)),
+                     'density': (('day', 'x', 'y'), rng.uniform(250, 350, shape)),
+                     'iceConc': (('day', 'x', 'y'), np.ones(shape)),
+                     'longitude': (('x', 'y'), lon), 'latitude': (('x', 'y'), lat)},
+                    coords={'day': [20181214, 20181215]})
+    path = str(tmp_path/'NESOSIM.nc')
+    ds.to_netcdf(path)
+    return path
+
+
+@pytest.mark.parametrize('method', ['nearest', 'bilinear'])
+def test_nonfinite_points_get_nan_snow(fileSnow, method):
+    index = ut.getNESOSIMindex(fileSnow, '20181214', mapProj)
+    xpts, ypts = mapProj([0.3, np.nan, 2.6, np.inf, 5.], [75.2, 76., np.nan, 80., 78.4])
+
+    snowDepth, snowDensity = ut.queryNESOSIMindex(index, xpts, ypts, method=method)
+
+    bad = ~(np.isfinite(xpts) & np.isfinite(ypts))
+    assert np.all(np.isnan(snowDepth[bad])) and np.all(np.isnan(snowDensity[bad]))
+    # Finite points are unaffected by the others
+    depthOK, densityOK = ut.queryNESOSIMindex(index, xpts[~bad], ypts[~bad], method=method)
+    np.testing.assert_array_equal(snowDepth[~bad], depthOK)
+    np.testing.assert_array_equal(snowDensity[~bad], densityOK)
+    assert np.all(np.isfinite(depthOK))
+
@@ -0,0 +1,219 @@
+#Import necesary modules
+#Use shorter names (np, pd, xr) instead of full (numpy, pandas, xarray) for convenience
+
+import os
+from glob import glob
+import re
+import time
+import numpy as np
+import pandas as pd
+import xarray as xr
+import pyproj
+import readers as rd
+import utils as ut
+
+
+# Map projections built in this process, keyed by proj4 string (built once per worker
+# rather than once per granule)
+projCache = {}
+
+# Stages timed for each granule (plus the write of each day)
+pipelineStages = ['read', 'project', 'snow', 'thickness']
+
+
+def getProj(projStr):
+    """ pyproj projection for a proj4 string, built once per process """
+    if projStr not in projCache:
+        projCache[projStr] = pyproj.Proj(projStr)
+    return projCache[projStr]
+
+
+def getATL10granuleDate(fileT):
+    """ Date string (YYYYMMDD) of the start of an ATL10 granule, from its file name
+    (e.g. ATL10-01_20181115003141_07240101_002_01.h5) """
+    match = re.search(r'ATL10[^_]*_(\d{8})', os.path.basename(fileT))
+    if match is None:
+        raise ValueError('No date in ATL10 file name: '+str(fileT))
+    return match.group(1)
+
+
+def getATL10files(dataPath, startDate, endDate):
+    """ ATL10 granules in dataPath starting between two dates (YYYYMMDD strings, inclusive)
+
+    returns:
+        list of file paths sorted by granule start time
+
+    """
+    files = [fileT for fileT in glob(dataPath+'/ATL10*.h5')
+             if startDate <= getATL10granuleDate(fileT) <= endDate]
+    return sorted(files, key=os.path.basename)
+
+
+def processATL10granule(fileT, snowSource='warren', snowPath=None, projStr=ut.NSIDC_PSN_PROJ,
+                        method='nearest', outVar='ice_thickness', **kwargs):
+    """ Freeboard to thickness for one ATL10 granule: read -> project -> snow co-location -> thickness
+
+    Each stage works on whole numpy arrays and the columns are added to the one dataframe
+    built by the reader (no copy of the dataframe between stages).
+
+    Args:
+        fileT (str): File path of the ATL10 dataset
+        snowSource (str): 'warren' (Warren 1999 climatology) or 'nesosim'
+        snowPath (str): NESOSIM file path prefix (see getNesosimDates), needed for 'nesosim'
+        projStr (str): proj4 string of the map projection for xpts/ypts (default NSIDC north polar stereographic)
+        method (str): NESOSIM co-location method, 'nearest' or 'bilinear'
+        outVar (str): name of the ice thickness column
+        kwargs: passed to getATL10beams (beams, varNames, freeboard/quality/confidence filters)
+
+    returns:
+        pandas dataframe with xpts, ypts, snow_depth, snow_density and outVar columns,
+        and a dictionary of the time (s) taken by each stage
+
+    """
+
+    timings = dict.fromkeys(pipelineStages, 0.)
+
+    t0 = time.time()
+    dF = rd.getATL10beams(fileT, **kwargs)
+    timings['read'] = time.time()-t0
+    if len(dF)==0:
+        return dF, timings
+
+    t0 = time.time()
+    mapProj = getProj(projStr)
+    xpts, ypts = mapProj(dF['lon'].values, dF['lat'].values)
+    dF['xpts'] = xpts
+    dF['ypts'] = ypts
+    timings['project'] = time.time()-t0
+
+    t0 = time.time()
+    if snowSource=='warren':
+        # Subtract 1 from month as warren index in function starts at 0
+        snowDepth, snowDensity = ut.WarrenClimatology(dF['lon'].values, dF['lat'].values, dF['month'].values-1)
+    elif snowSource=='nesosim':
+        # NESOSIM file from the granule start, then each segment gets the snow of its own day
+        fileSnow, _ = ut.getNesosimDates(dF, snowPath)
+        dateStrs = dF['year'].values*10000 + dF['month'].values*100 + dF['day'].values
+        snowDepth, snowDensity = ut.queryNESOSIMbyDay(fileSnow, mapProj, dateStrs, xpts, ypts, method=method)
+    else:
+        raise ValueError("snowSource must be 'warren' or 'nesosim'")
+    dF['snow_depth'] = snowDepth
+    dF['snow_density'] = snowDensity
+    timings['snow'] = time.time()-t0
+
+    t0 = time.time()
+    # freeboard_to_thickness caps the snow depth array in place, so give it a copy
+    dF[outVar] = ut.freeboard_to_thickness(dF['freeboard'].values, np.copy(snowDepth), snowDensity)
+    timings['thickness'] = time.time()-t0
+
+    return dF, timings
+
+
+def writeThicknessDay(dF, outFile, chunkSize=100000):
+    """ Write one day of thickness data to a chunked, compressed netCDF file
+    (variables along a 'segment' dimension) """
+
+    dF = dF.reset_index(drop=True)
+    for col in dF.columns:
+        if str(dF[col].dtype)=='category':
+            dF[col] = dF[col].astype(str)
+    ds = xr.Dataset.from_dataframe(dF).rename({'index': 'segment'})
+
+    chunk = int(max(min(chunkSize, len(dF)), 1))
+    encoding = {var: {'zlib': True, 'chunksizes': (chunk,)} for var in ds.data_vars
+                if ds[var].dtype.kind in 'biuf'}
+    ds.to_netcdf(outFile, encoding=encoding)
+
+
+def runThicknessPipeline(dataPath, startDate, endDate, outPath, snowSource='warren', snowPath=None,
+                         njobs=1, skipErrors=True, chunkSize=100000, **kwargs):
+    """ Batch freeboard to thickness conversion of the ATL10 granules between two dates
+
+    Granules are streamed (and with njobs>1 processed in parallel) through processATL10granule,
+    at most 2*njobs at a time (see iterGranules). Segments are split by their own date (a
+    granule crossing midnight goes to two days) and written to one file per day,
+    IS2ATL10thickness_YYYYMMDD.nc in outPath, once the granules start on a later day, so at
+    most two days are held in memory. Days whose granules are all empty or skipped get no
+    file but are still listed in the summary.
+
+    Args:
+        dataPath (str): directory of the ATL10 granules
+        startDate, endDate (str): first and last day (YYYYMMDD) of granules to process
+        outPath (str): output directory
+        snowSource (str): 'warren' or 'nesosim' (see processATL10granule)
+        snowPath (str): NESOSIM file path prefix, needed for 'nesosim'
+        njobs (int): number of worker processes
+        skipErrors (flag): print and skip unreadable granules (I/O errors) instead of raising
+        chunkSize (int): chunk size (segments) of the output variables
+        kwargs: passed to processATL10granule (projStr, method, outVar) and getATL10beams
+
+    returns:
+        pandas dataframe indexed by day with the output file (missing if no data), number of granules
+        read and skipped and the time (s) spent in each stage (summed over the granules starting
+        that day), and number of segments (of that date)
+
+    """
+
+    files = getATL10files(dataPath, startDate, endDate)
+    print('Number of files:', np.size(files))
+    if not os.path.exists(outPath):
+        os.makedirs(outPath)
+
+    summary = []
+    # Days not written yet: segments gathered (dFs), granule counts and stage timings
+    days = {}
+
+    def getDay(dayStr):
+        if dayStr not in days:
+            days[dayStr] = dict(dict.fromkeys(pipelineStages, 0.), granules=0, skipped=0, dFs=[])
+        return days[dayStr]
+
+    def flushDays(beforeDay=None):
+        # Write out the days before beforeDay (all days if None), no file for a day without data
+        for dayStr in sorted(days):
+            if beforeDay is not None and dayStr >= beforeDay:
+                break
+            dayTimings = days.pop(dayStr)
+            dFs = dayTimings.pop('dFs')
+            outFile, nSegments = None, 0
+            t0 = time.time()
+            if len(dFs) > 0:
+                outFile = os.path.join(outPath, 'IS2ATL10thickness_'+dayStr+'.nc')
+                dF = pd.concat(dFs, ignore_index=True)
+                writeThicknessDay(dF, outFile, chunkSize=chunkSize)
+                nSegments = len(dF)
+                print('Wrote', outFile, nSegments, 'segments')
+            else:
+                print('No data for', dayStr)
+            dayTimings['write'] = time.time()-t0
+            dayTimings.update({'day': dayStr, 'file': outFile, 'segments': nSegments})
+            summary.append(dayTimings)
+
+    for fileT, result in rd.iterGranules(processATL10granule, files, njobs=njobs, skipErrors=skipErrors,
+                                         yieldSkipped=True, snowSource=snowSource, snowPath=snowPath, **kwargs):
+        # Granules are in time order, so no later segment falls before this granule's day
+        granuleDay = getATL10granuleDate(fileT)
+        flushDays(granuleDay)
+        dayTimings = getDay(granuleDay)
+        if result is None:
+            dayTimings['skipped'] += 1
+            continue
+        dF, timings = result
+        dayTimings['granules'] += 1
+        for stage in pipelineStages:
+            dayTimings[stage] += timings[stage]
+        if len(dF) == 0:
+            continue
+        # Split the segments by their own date
+        dateStrs = dF['year'].values*10000 + dF['month'].values*100 + dF['day'].values
+        if str(dateStrs.min()) < granuleDay:
+            raise ValueError('Segments of '+fileT+' are dated before the granule start day')
+        for date in np.unique(dateStrs):
+            getDay(str(date))['dFs'].append(dF[dateStrs==date])
+
+    flushDays()
+
+    columns = ['file', 'granules', 'skipped', 'segments']+pipelineStages+['write']
+    if len(summary)==0:
+        return pd.DataFrame(columns=columns)
+    return pd.DataFrame(summary).set_index('day')[columns]
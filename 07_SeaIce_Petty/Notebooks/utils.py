@@ -11,6 +11,9 @@ import xarray as xr
 import numpy as np
 import pdb
 import numpy.ma as ma
+from glob import glob
+from scipy.spatial import cKDTree
+import pyproj
 
         
 def convert_GPS_time(GPS_Time, OFFSET=0.0):
@@ -135,54 +138,43 @@ def get_leaps():
 def is_leap(GPS_Time):
     #-- PURPOSE: Test to see if any GPS seconds are leap seconds
     # Written and provided by Tyler Sutterley
+    # Vectorized: one sorted lookup into the leap table instead of a scan per leap second
     
-	leaps = get_leaps()
-	Flag = np.zeros_like(GPS_Time, dtype=np.bool)
-	for leap in leaps:
-		count = np.count_nonzero(np.floor(GPS_Time) == leap)
-		if (count > 0):
-			indices, = np.nonzero(np.floor(GPS_Time) == leap)
-			Flag[indices] = True
+	leaps = np.asarray(get_leaps(), dtype=np.float64)
+	GPS_Second = np.floor(GPS_Time)
+	#-- index of the first leap second at or after each time
+	i = np.searchsorted(leaps, GPS_Second, side='left')
+	Flag = leaps[np.minimum(i, len(leaps)-1)] == GPS_Second
 	return Flag
 
 
 def count_leaps(GPS_Time):
     #-- PURPOSE: Count number of leap seconds that have passed for each GPS time
     # Written and provided by Tyler Sutterley
+    # Vectorized: one sorted lookup into the leap table instead of a scan per leap second
 	leaps = get_leaps()
 	#-- number of leap seconds prior to GPS_Time
-	n_leaps = np.zeros_like(GPS_Time, dtype=np.uint)
-	for i,leap in enumerate(leaps):
-		count = np.count_nonzero(GPS_Time >= leap)
-		if (count > 0):
-			indices, = np.nonzero(GPS_Time >= leap)
-			# print(indices)
-			# pdb.set_trace()
-			n_leaps[indices] += 1
+	n_leaps = np.searchsorted(leaps, GPS_Time, side='right').astype(np.uint)
 	return n_leaps
 
 
 def convert_UNIX_to_GPS(UNIX_Time):
     #-- PURPOSE: Convert UNIX Time to GPS Time
+    # Does not modify the input array
     
+	UNIX_Time = np.array(UNIX_Time, dtype=np.float64)
 	#-- calculate offsets for UNIX times that occur during leap seconds
 	offset = np.zeros_like(UNIX_Time)
-	count = np.count_nonzero((UNIX_Time % 1) != 0)
-	if (count > 0):
-		indices, = np.nonzero((UNIX_Time % 1) != 0)
-		UNIX_Time[indices] -= 0.5
-		offset[indices] = 1.0
+	indices = (UNIX_Time % 1) != 0
+	UNIX_Time[indices] -= 0.5
+	offset[indices] = 1.0
 	#-- convert UNIX_Time to GPS without taking into account leap seconds
 	#-- (UNIX epoch: Jan 1, 1970 00:00:00, GPS epoch: Jan 6, 1980 00:00:00)
 	GPS_Time = UNIX_Time - 315964800
-	leaps = get_leaps()
 	#-- calculate number of leap seconds prior to GPS_Time
-	n_leaps = np.zeros_like(GPS_Time, dtype=np.uint)
-	for i,leap in enumerate(leaps):
-		count = np.count_nonzero(GPS_Time >= (leap - i))
-		if (count > 0):
-			indices, = np.nonzero(GPS_Time >= (leap - i))
-			n_leaps[indices] += 1
+	#-- (the i-th leap second falls at GPS time leap - i before it is counted)
+	leaps = np.asarray(get_leaps()) - np.arange(len(get_leaps()))
+	n_leaps = np.searchsorted(leaps, GPS_Time, side='right')
 	#-- take into account leap seconds and offsets
 	GPS_Time += n_leaps + offset
 	return GPS_Time
@@ -192,19 +184,140 @@ def convert_GPS_to_UNIX(GPS_Time):
     #-- PURPOSE: Convert GPS Time to UNIX Time
 	#-- convert GPS_Time to UNIX without taking into account leap seconds
 	#-- (UNIX epoch: Jan 1, 1970 00:00:00, GPS epoch: Jan 6, 1980 00:00:00)
-	UNIX_Time = GPS_Time + 315964800
-	#-- number of leap seconds prior to GPS_Time
-	n_leaps = count_leaps(GPS_Time)
+	UNIX_Time = np.array(GPS_Time, dtype=np.float64) + 315964800
+	#-- number of leap seconds prior to GPS_Time (single lookup)
+	leaps = np.asarray(get_leaps(), dtype=np.float64)
+	n_leaps = np.searchsorted(leaps, GPS_Time, side='right')
 	UNIX_Time -= n_leaps
-	#-- check if GPS Time is leap second
-	Flag = is_leap(GPS_Time)
-	if Flag.any():
-		#-- for leap seconds: add a half second offset
-		indices, = np.nonzero(Flag)
-		UNIX_Time[indices] += 0.5
+	#-- check if GPS Time is leap second (the last leap second passed is this second)
+	Flag = (n_leaps > 0) & (leaps[np.maximum(n_leaps-1, 0)] == np.floor(GPS_Time))
+	#-- for leap seconds: add a half second offset
+	UNIX_Time += 0.5*Flag
 	return UNIX_Time
 
 
+def convert_GPS_to_datetime64(GPS_Time, OFFSET=0.0):
+    """
+    Convert GPS time directly to numpy datetime64[ns] (UTC)
+
+    Avoids the calendar split (year/month/day/hour/minute/second arrays) of
+    convert_GPS_time and the pandas reassembly, so only a couple of
+    full-length temporaries are created. Leap seconds are taken from the
+    get_leaps() table with a single sorted lookup. As in UNIX time, GPS times
+    falling inside a leap second repeat the preceding UTC second.
+
+    Args:
+        GPS_Time (var): GPS time (seconds since January 6, 1980 at 00:00)
+        OFFSET (float): number of seconds to offset each GPS time
+
+    Returns:
+        datetimes (var): datetime64[ns] array, same shape as GPS_Time
+
+    """
+
+    # UNIX time without leap seconds (UNIX epoch: Jan 1, 1970, GPS epoch: Jan 6, 1980)
+    UNIX_Time = np.asarray(GPS_Time, dtype=np.float64) + (315964800 + OFFSET)
+
+    # Subtract the leap seconds that have passed at each time (leap table shifted to the same epoch)
+    UNIX_leaps = np.asarray(get_leaps(), dtype=np.float64) + 315964800
+    UNIX_Time = UNIX_Time - np.searchsorted(UNIX_leaps, UNIX_Time, side='right')
+
+    # Nanoseconds since the UNIX epoch (scalars stay scalars)
+    UNIX_Time = np.asarray(np.rint(UNIX_Time * 1e9))
+
+    return UNIX_Time.astype(np.int64).view('datetime64[ns]')[()]
+
+
+def civil_from_days(days):
+    """
+    Year, month and day (integer arrays) of days since 1970-01-01
+
+    Proleptic Gregorian civil-from-days algorithm (eras of 400 years starting
+    on March 1st, 0000), integer operations only.
+
+    """
+
+    days = np.asarray(days, dtype=np.int64) + 719468
+    era = days // 146097
+    doe = days - 146097*era
+    yoe = (doe - doe//1460 + doe//36524 - doe//146096) // 365
+    doy = doe - (365*yoe + yoe//4 - yoe//100)
+    mp = (5*doy + 2) // 153
+    day = doy - (153*mp + 2)//5 + 1
+    month = np.where(mp < 10, mp + 3, mp - 9)
+    year = yoe + 400*era + (month <= 2)
+
+    return year, month, day
+
+
+def convert_GPS_to_calendar(GPS_Time, OFFSET=0.0):
+    """
+    Calendar fields for GPS times, from integer day numbers
+
+    A single leap-second lookup, then each time is split into a day number
+    since the UNIX epoch and the seconds of that day. Year, month and day come
+    from a table of the days spanned by the data (civil_from_days), so the per
+    time work is one lookup instead of the floating point Julian date
+    arithmetic of convert_GPS_time (see benchmark_time.py). As in
+    convert_GPS_to_datetime64, GPS times falling inside a leap second repeat
+    the preceding UTC second.
+
+    Args:
+        GPS_Time (var): GPS time (seconds since January 6, 1980 at 00:00)
+        OFFSET (float): number of seconds to offset each GPS time
+
+    Returns:
+        dictionary of year, month, day, hour, minute (integer arrays) and
+        second (float array, including fractions of a second)
+
+    """
+
+    # UNIX time without leap seconds (as convert_GPS_to_datetime64)
+    UNIX_Time = np.asarray(GPS_Time, dtype=np.float64) + (315964800 + OFFSET)
+    UNIX_leaps = np.asarray(get_leaps(), dtype=np.float64) + 315964800
+    UNIX_Time = UNIX_Time - np.searchsorted(UNIX_leaps, UNIX_Time, side='right')
+
+    # Days since 1970-01-01 and seconds of the day
+    days = np.floor(UNIX_Time / 86400.0)
+    second = UNIX_Time - 86400.0*days
+
+    # Time of day
+    hour = np.floor(second / 3600.0)
+    second = second - 3600.0*hour
+    minute = np.floor(second / 60.0)
+    second = second - 60.0*minute
+
+    # Calendar date of each day in the range of the data, then one lookup per time
+    days = days.astype(np.int64)
+    day0 = days.min() if days.size else 0
+    days = days - day0
+    year, month, day = [field[days] for field in
+        civil_from_days(np.arange(day0, day0 + (days.max() + 1 if days.size else 0)))]
+
+    return dict(year=year, month=month, day=day,
+        hour=hour.astype(np.int64), minute=minute.astype(np.int64), second=second)
+
+
+def datetime64_to_ymd(datetimes):
+    """
+    Year, month and day (integer arrays) of a datetime64 array
+
+    Args:
+        datetimes (var): datetime64 array
+
+    Returns:
+        year, month, day (var): calendar fields
+
+    """
+
+    months = datetimes.astype('datetime64[M]')
+    year = months.astype('datetime64[Y]').astype(int) + 1970
+    month = months.astype(int) % 12 + 1
+    day = (datetimes.astype('datetime64[D]') - months).astype(int) + 1
+
+    return year, month, day
+
+
 
 def getSnowandConverttoThickness(dF, snowDepthVar='snowDepth', 
                                  snowDensityVar='snowDensity',
@@ -251,6 +364,98 @@ def freeboard_to_thickness(freeboardT, snow_depthT, snow_densityT):
 
     return ice_thicknessT
 
+def seaSurfaceReference(dist, elev, ssh_flag, seg_length, track=None, window=10000., minLeads=1):
+    """
+    Local sea surface height and freeboard along track from the ATL07 lead (ssh_flag) segments
+
+    The sea surface under each segment is the segment length weighted mean height of the 
+    lead segments within +/- window/2 along track (on the same track). Window sums come from 
+    cumulative sums over the lead segments, with the window edges found by one searchsorted,
+    so the cost is O(N log N) for N segments whatever the window size.
+
+    Args:
+        dist (var): along track distance (m), increasing within each track
+        elev (var): segment heights (height_segment_height)
+        ssh_flag (var): sea surface flag (height_segment_ssh_flag), leads are ssh_flag > 0
+        seg_length (var): segment lengths (height_segment_length_seg) used as weights
+        track (var): track identifier of each segment (e.g. beam), each track contiguous. 
+            Leads are never shared between tracks. Default: one track.
+        window (float): full along track window length (m)
+        minLeads (int): minimum number of lead segments in the window for a valid reference
+
+    Returns:
+        ssh (var): local sea surface height (nan where fewer than minLeads leads)
+        freeboard (var): elev - ssh
+        nLeads (var): number of lead segments in each window
+
+    """
+
+    dist = np.asarray(dist, dtype=np.float64)
+    elev = np.asarray(elev, dtype=np.float64)
+    seg_length = np.asarray(seg_length, dtype=np.float64)
+    lead = (np.asarray(ssh_flag) > 0) & np.isfinite(elev) & (seg_length > 0)
+
+    # No segments or no leads: no reference anywhere
+    if not lead.any():
+        ssh = np.full(dist.size, np.nan)
+        return ssh, elev - ssh, np.zeros(dist.size, dtype=int)
+
+    # Shift each track along one axis, far enough apart that windows never span two tracks
+    if track is None:
+        trackStart = np.array([0])
+    else:
+        track = np.asarray(track)
+        trackStart = np.r_[0, np.flatnonzero(track[1:] != track[:-1]) + 1]
+    trackLen = np.diff(np.r_[trackStart, dist.size])
+    trackMin = dist[trackStart]
+    trackSpan = np.maximum.reduceat(dist, trackStart) - trackMin if dist.size > 0 else trackMin
+    trackOffset = np.r_[0., np.cumsum(trackSpan + 2*window)[:-1]]
+    x = dist + np.repeat(trackOffset - trackMin, trackLen)
+    if np.any(np.diff(x) < 0):
+        raise ValueError('dist must increase along each track (and each track be contiguous)')
+
+    # Cumulative sums over the lead segments, differenced at the window edges
+    w = np.where(lead, seg_length, 0.)
+    cumW = np.r_[0., np.cumsum(w)]
+    cumWH = np.r_[0., np.cumsum(w*np.where(lead, elev, 0.))]
+    cumN = np.r_[0, np.cumsum(lead)]
+    i0 = np.searchsorted(x, x - window/2., side='left')
+    i1 = np.searchsorted(x, x + window/2., side='right')
+
+    nLeads = cumN[i1] - cumN[i0]
+    weights = cumW[i1] - cumW[i0]
+    ssh = np.full(dist.size, np.nan)
+    ok = (nLeads >= minLeads) & (weights > 0)
+    ssh[ok] = (cumWH[i1] - cumWH[i0])[ok]/weights[ok]
+
+    return ssh, elev - ssh, nLeads
+
+def addSeaSurfaceFreeboard(dF, window=10000., minLeads=1, distVar='along_track_distance', trackVar='beam'):
+    """
+    Add local sea surface height (ssh), freeboard and lead count (n_leads) columns to an 
+    ATL07 dataframe, e.g. from getATL07beams (all beams at once), see seaSurfaceReference
+
+    Args:
+        dF (data frame): ATL07 segments with elev, ssh_flag, seg_length, distVar and trackVar columns
+        window (float): full along track window length (m)
+        minLeads (int): minimum number of lead segments in the window
+        distVar (string): along track distance column
+        trackVar (string): track (beam) column, or None for a single beam
+
+    Returns:
+        dF (data frame): dataframe including ssh, freeboard and n_leads columns
+
+    """
+
+    track = dF[trackVar].values if trackVar is not None else None
+    ssh, freeboard, nLeads = seaSurfaceReference(dF[distVar].values, dF['elev'].values, dF['ssh_flag'].values,
+                                                 dF['seg_length'].values, track=track, window=window, minLeads=minLeads)
+    dF['ssh'] = pd.Series(ssh, index=dF.index)
+    dF['freeboard'] = pd.Series(freeboard, index=dF.index)
+    dF['n_leads'] = pd.Series(nLeads, index=dF.index)
+
+    return dF
+
 def getWarrenData(dF, outSnowVar, outDensityVar='None'):
     """
     Assign Warren1999 snow dept/density climatology to dataframe
@@ -268,24 +473,11 @@ def getWarrenData(dF, outSnowVar, outDensityVar='None'):
         
     """
     
-    # Generate empty lists
-    snowDepthW99s=ma.masked_all(np.size(dF['freeboard'].values))
-    if (outDensityVar!='None'):
-        snowDensityW99s=ma.masked_all(np.size(dF['freeboard'].values))
-
-    # Loop over all freeboard values (rows)
-    for x in range(np.size(dF['freeboard'].values)):
-        #print(x, dF['lon'].iloc[x], dF['lat'].iloc[x], dF['month'].iloc[x]-1)
-        # SUbtract 1 from month as warren index in fucntion starts at 0
-        snowDepthDayW99T, snowDensityW99T=WarrenClimatology(dF['lon'].iloc[x], dF['lat'].iloc[x], dF['month'].iloc[x]-1)
-        
+    # One vectorized call over all freeboard values (rows)
+    # Subtract 1 from month as warren index in function starts at 0
+    snowDepthW99s, snowDensityW99s=WarrenClimatology(dF['lon'].values, dF['lat'].values, dF['month'].values-1)
 
-        # Append values to list
-        snowDepthW99s[x]=snowDepthDayW99T
-        if (outDensityVar!='None'):
-            snowDensityW99s[x]=snowDensityW99T
-
-    # Assign list to dataframe as a series
+    # Assign arrays to dataframe as a series
     dF[outSnowVar] = pd.Series(snowDepthW99s, index=dF.index)
     if (outDensityVar!='None'):
         dF[outDensityVar] = pd.Series(snowDensityW99s, index=dF.index)
@@ -293,14 +485,29 @@ def getWarrenData(dF, outSnowVar, outDensityVar='None'):
 
     return dF
 
+# Warren et al. (1999) monthly snow depth (cm) and SWE (cm) fit coefficients, January (index 0) to December
+W99_H_0 = np.array([28.01, 30.28, 33.89, 36.8, 36.93, 36.59, 11.02, 4.64, 15.81, 22.66, 25.57, 26.67])
+W99_a = np.array([.127, .1056, .5486, .4046, .0214, .7021, .3008, .31, .2119, .3594, .1496, -0.1876])
+W99_b = np.array([-1.1833, -0.5908, -0.1996, -0.4005, -1.1795, -1.4819, -1.2591, -0.635, -1.0292, -1.3483, -1.4643, -1.4229])
+W99_c = np.array([-0.1164, -0.0263, 0.0280, 0.0256, -0.1076, -0.1195, -0.0811, -0.0655, -0.0868, -0.1063, -0.1409, -0.1413])
+W99_d = np.array([-0.0051, -0.0049, 0.0216, 0.0024, -0.0244, -0.0009, -0.0043, 0.0059, -0.0177, 0.0051, -0.0079, -0.0316])
+W99_e = np.array([0.0243, 0.0044, -0.0176, -0.0641, -0.0142, -0.0603, -0.0959, -0.0005, -0.0723, -0.0577, -0.0258, -0.0029])
+
+W99_H_0swe = np.array([8.37, 9.43,10.74,11.67,11.8,12.48,4.01,1.08,3.84,6.24,7.54,8.0])
+W99_aswe = np.array([-0.027,0.0058,0.1618,0.0841,-0.0043,0.2084,0.097,0.0712,0.0393,0.1158,0.0567,-0.054])
+W99_bswe = np.array([-0.34,-0.1309,0.0276,-0.1328,-0.4284,-0.5739,-0.493,-0.145,-0.2107,-0.2803,-0.3201,-0.365])
+W99_cswe = np.array([-0.0319,0.0017,0.0213,0.0081,-0.038,-0.0468,-0.0333,-0.0155,-0.0182,-0.0215,-0.0284,-0.0362])
+W99_dswe = np.array([-0.0056,-0.0021,0.0076,-0.0003,-0.0071,-0.0023,-0.0026,0.0014,-0.0053,0.0015,-0.0032,-0.0112])
+W99_eswe = np.array([-0.0005,-0.0072,-0.0125,-0.0301,-0.0063,-0.0253,-0.0343,0,-0.019,-0.0176,-0.0129,-0.0035])
+
 def WarrenClimatology(lonT, latT, monthT):
     """
     Get Warren1999 snow depth climatology
 
     Args:
-        lonT (var): longitude
-        latT (var): latitude
-        monthT (var): month with the index starting at 0
+        lonT (var): longitude (scalar or array)
+        latT (var): latitude (scalar or array)
+        monthT (var): month with the index starting at 0 (scalar or integer array)
         
     Returns:
         Hs (var): Snow depth (m)
@@ -308,31 +515,20 @@ def WarrenClimatology(lonT, latT, monthT):
         
     """
 
-    H_0 = [28.01, 30.28, 33.89, 36.8, 36.93, 36.59, 11.02, 4.64, 15.81, 22.66, 25.57, 26.67]
-    a = [.127, .1056, .5486, .4046, .0214, .7021, .3008, .31, .2119, .3594, .1496, -0.1876]
-    b = [-1.1833, -0.5908, -0.1996, -0.4005, -1.1795, -1.4819, -1.2591, -0.635, -1.0292, -1.3483, -1.4643, -1.4229]
-    c = [-0.1164, -0.0263, 0.0280, 0.0256, -0.1076, -0.1195, -0.0811, -0.0655, -0.0868, -0.1063, -0.1409, -0.1413]
-    d = [-0.0051, -0.0049, 0.0216, 0.0024, -0.0244, -0.0009, -0.0043, 0.0059, -0.0177, 0.0051, -0.0079, -0.0316]
-    e = [0.0243, 0.0044, -0.0176, -0.0641, -0.0142, -0.0603, -0.0959, -0.0005, -0.0723, -0.0577, -0.0258, -0.0029]
+    monthT = np.asarray(monthT).astype(int)
+    lonT = np.asarray(lonT)
+    latT = np.asarray(latT)
 
     # Convert lat and lon into degrees of arc, +x axis along 0 degrees longitude and +y axis along 90E longitude
     x = (90.0 - latT)*np.cos(lonT * np.pi/180.0)  
     y = (90.0 - latT)*np.sin(lonT*np.pi/180.0) 
 
-    Hs = H_0[monthT] + a[monthT]*x + b[monthT]*y + c[monthT]*x*y + (d[monthT]*x*x) + (e[monthT]*y*y)
+    Hs = W99_H_0[monthT] + W99_a[monthT]*x + W99_b[monthT]*y + W99_c[monthT]*x*y + (W99_d[monthT]*x*x) + (W99_e[monthT]*y*y)
     
 
     # Now get SWE, although this is not returned by the function
 
-    H_0swe = [8.37, 9.43,10.74,11.67,11.8,12.48,4.01,1.08,3.84,6.24,7.54,8.0]
-    aswe = [-0.027,0.0058,0.1618,0.0841,-0.0043,0.2084,0.097,0.0712,0.0393,0.1158,0.0567,-0.054]
-    bswe = [-0.34,-0.1309,0.0276,-0.1328,-0.4284,-0.5739,-0.493,-0.145,-0.2107,-0.2803,-0.3201,-0.365]
-    cswe = [-0.0319,0.0017,0.0213,0.0081,-0.038,-0.0468,-0.0333,-0.0155,-0.0182,-0.0215,-0.0284,-0.0362]
-    dswe = [-0.0056,-0.0021,0.0076,-0.0003,-0.0071,-0.0023,-0.0026,0.0014,-0.0053,0.0015,-0.0032,-0.0112]
-    eswe = [-0.0005,-0.0072,-0.0125,-0.0301,-0.0063,-0.0253,-0.0343,0,-0.019,-0.0176,-0.0129,-0.0035]
-
-
-    swe = H_0swe[monthT] + aswe[monthT]*x + bswe[monthT]*y + cswe[monthT]*x*y + dswe[monthT]*x*x + eswe[monthT]*y*y
+    swe = W99_H_0swe[monthT] + W99_aswe[monthT]*x + W99_bswe[monthT]*y + W99_cswe[monthT]*x*y + W99_dswe[monthT]*x*x + W99_eswe[monthT]*y*y
 
     # Density in kg/m^3
     rho_s = 1000.*(swe/Hs)  
@@ -353,28 +549,99 @@ def WarrenClimatology(lonT, latT, monthT):
 
     return Hs, rho_s
 
-def get_psnlatslons(data_path, res=25):
-    # Get NSIDC polar stereographic grid data
-    if (res==25):
-        # 25 km grid
-        mask_latf = open(data_path+'/psn25lats_v3.dat', 'rb')
-        mask_lonf = open(data_path+'/psn25lons_v3.dat', 'rb')
-        lats_mask = reshape(fromfile(file=mask_latf, dtype='<i4')/100000., [448, 304])
-        lons_mask = reshape(fromfile(file=mask_lonf, dtype='<i4')/100000., [448, 304])
-    elif (res==12):
-        # 12.5 km grid
-        mask_latf = open(data_path+'/psn12lats_v3.dat', 'rb')
-        mask_lonf = open(data_path+'/psn12lons_v3.dat', 'rb')
-        lats_mask = reshape(fromfile(file=mask_latf, dtype='<i4')/100000., [896, 608])
-        lons_mask = reshape(fromfile(file=mask_lonf, dtype='<i4')/100000., [896, 608])
-    elif (res==6):
-        # 12.5 km grid
-        mask_latf = open(data_path+'/psn06lats_v3.dat', 'rb')
-        mask_lonf = open(data_path+'/psn06lons_v3.dat', 'rb')
-        lats_mask = reshape(fromfile(file=mask_latf, dtype='<i4')/100000., [1792, 1216])
-        lons_mask = reshape(fromfile(file=mask_lonf, dtype='<i4')/100000., [1792, 1216])
-
-    return lats_mask, lons_mask
+# NSIDC polar stereographic ancillary grids: file name, stored dtype, shape (rows, columns) and
+# the divisor to physical units (None if the stored values are used as is)
+NSIDC_GRIDS = {
+    'psn25lats': ('psn25lats_v3.dat', '<i4', (448, 304), 100000.),
+    'psn25lons': ('psn25lons_v3.dat', '<i4', (448, 304), 100000.),
+    'psn12lats': ('psn12lats_v3.dat', '<i4', (896, 608), 100000.),
+    'psn12lons': ('psn12lons_v3.dat', '<i4', (896, 608), 100000.),
+    'psn06lats': ('psn06lats_v3.dat', '<i4', (1792, 1216), 100000.),
+    'psn06lons': ('psn06lons_v3.dat', '<i4', (1792, 1216), 100000.),
+    'sect_fixed_n': ('sect_fixed_n.msk', 'uint8', (448, 304), None),
+}
+
+# Process-wide registry of the memory-mapped grids, keyed by file path
+ancillaryGridCache = {}
+
+class AncillaryGrid(object):
+    """
+    Read-only memory-mapped NSIDC ancillary grid, scaled to physical units lazily 
+    (only the part that is indexed, or the whole grid when converted with np.asarray)
+
+    The pages are backed by the file, so processes reading the same grid share them
+    through the page cache instead of each holding a private copy.
+
+    """
+
+    def __init__(self, raw, scale=None):
+        self.raw = raw
+        self.scale = scale
+
+    @property
+    def shape(self):
+        return self.raw.shape
+
+    @property
+    def ndim(self):
+        return self.raw.ndim
+
+    @property
+    def dtype(self):
+        return self.raw.dtype if self.scale is None else np.dtype('float64')
+
+    def __len__(self):
+        return len(self.raw)
+
+    def __getitem__(self, key):
+        if self.scale is None:
+            return self.raw[key]
+        return self.raw[key]/self.scale
+
+    def __array__(self, dtype=None, copy=None):
+        # copy=False (never copy) is only possible for an unscaled grid in its own type
+        data = self[...]
+        isCopy = self.scale is not None
+        if dtype is not None and data.dtype != np.dtype(dtype):
+            data, isCopy = data.astype(dtype), True
+        if copy is False and isCopy:
+            raise ValueError('AncillaryGrid cannot be converted to an array without a copy')
+        return np.array(data, copy=True) if (copy and not isCopy) else np.asarray(data)
+
+def getAncillaryGrid(data_path, name):
+    """
+    NSIDC ancillary grid from the registry, memory-mapping the file on first use
+
+    Args:
+        data_path (string): directory holding the grid files
+        name (string): grid name (key of NSIDC_GRIDS, e.g. 'psn25lats', 'sect_fixed_n')
+
+    Returns:
+        grid (AncillaryGrid): lazily scaled grid, the raw memmap is grid.raw
+
+    """
+
+    fileName, dtype, shape, scale = NSIDC_GRIDS[name]
+    fileT = data_path+'/'+fileName
+    if fileT not in ancillaryGridCache:
+        ancillaryGridCache[fileT] = AncillaryGrid(np.memmap(fileT, dtype=dtype, mode='r', shape=shape), scale)
+
+    return ancillaryGridCache[fileT]
+
+def get_psnlatslons(data_path, res=25, lazy=False):
+    """ Get NSIDC polar stereographic grid data (res = 25, 12 or 6 km)
+
+    With lazy=True the cached AncillaryGrid objects are returned instead of float64 arrays,
+    so only the parts that are indexed get scaled to degrees.
+    """
+    
+    resStr = {25:'25', 12:'12', 6:'06'}[res]
+    lats_mask = getAncillaryGrid(data_path, 'psn'+resStr+'lats')
+    lons_mask = getAncillaryGrid(data_path, 'psn'+resStr+'lons')
+    if lazy:
+        return lats_mask, lons_mask
+
+    return np.asarray(lats_mask), np.asarray(lons_mask)
 
 
 def getNESOSIM(fileSnowT, dateStrT):
@@ -398,7 +665,85 @@ def getNESOSIM(fileSnowT, dateStrT):
     return dNday
 
 
-def assignRegionMask(dF, mapProj, ancDataPath='../Data/'):
+# NSIDC north polar stereographic grid (EPSG:3411, Hughes 1980 ellipsoid) and the 25 km grid geotransform
+NSIDC_PSN_PROJ = '+proj=stere +lat_0=90 +lat_ts=70 +lon_0=-45 +k=1 +x_0=0 +y_0=0 +a=6378273 +b=6356889.449 +units=m +no_defs'
+# Upper left corner x, y (m) and cell size (m) of the 304 x 448 (columns x rows) 25 km grid
+NSIDC_PSN25_GEOTRANSFORM = (-3850000., 5850000., 25000.)
+
+# Process-wide cache of the coastal fallback index of the region mask, keyed by data path
+regionMaskCache = {}
+
+def getRegionMaskGrid(ancDataPath='../Data/', fallback=False):
+    """
+    NSIDC 25 km region mask (read-only memory map from the ancillary grid registry)
+    and its coastal fallback index
+
+    Args:
+        ancDataPath (string): directory holding sect_fixed_n.msk
+        fallback (flag): also return the coastal fallback index (built and cached the first
+            time it is asked for)
+
+    Returns:
+        region_mask (memmap): 448 x 304 uint8 raster (row 0 is the top/north edge)
+        oceanTree (cKDTree): KD-tree over the (row, col) indices of the ocean region cells (1 to 15),
+            used for the nearest-valid fallback (None without fallback)
+        oceanIndex (var): flat raster indices of the cells in oceanTree (None without fallback)
+
+    """
+
+    region_mask = getAncillaryGrid(ancDataPath, 'sect_fixed_n').raw
+    if not fallback:
+        return region_mask, None, None
+
+    if ancDataPath not in regionMaskCache:
+        oceanIndex = np.flatnonzero((region_mask >= 1) & (region_mask <= 15))
+        oceanTree = cKDTree(np.c_[np.unravel_index(oceanIndex, region_mask.shape)])
+        regionMaskCache[ancDataPath] = (oceanTree, oceanIndex)
+
+    oceanTree, oceanIndex = regionMaskCache[ancDataPath]
+    return region_mask, oceanTree, oceanIndex
+
+def lookupRegionMask(lons, lats, ancDataPath='../Data/', fallback=False):
+    """
+    NSIDC region of many points at once, by index arithmetic on the 25 km polar stereographic grid
+
+    Args:
+        lons, lats (var): longitude and latitude (degrees)
+        ancDataPath (string): directory holding sect_fixed_n.msk
+        fallback (flag): give points falling on land/coast (20, 21), missing cells or outside the grid
+            the region of the nearest ocean cell (1 to 15). Default is the containing cell, as before.
+
+    Returns:
+        regionFlags (var): integer region flag for every point
+
+    """
+
+    region_mask, oceanTree, oceanIndex = getRegionMaskGrid(ancDataPath, fallback=fallback)
+    nrow, ncol = region_mask.shape
+    x0, y0, cell = NSIDC_PSN25_GEOTRANSFORM
+
+    xpts, ypts = pyproj.Proj(NSIDC_PSN_PROJ)(np.asarray(lons), np.asarray(lats))
+
+    # Fractional grid index of each point (cell centres at integer + 0.5)
+    colf = (np.asarray(xpts) - x0)/cell
+    rowf = (y0 - np.asarray(ypts))/cell
+    col = np.floor(colf).astype(int)
+    row = np.floor(rowf).astype(int)
+    inside = (row >= 0) & (row < nrow) & (col >= 0) & (col < ncol)
+
+    # The containing cell is the nearest cell centre; points outside the grid take the nearest edge cell
+    regionFlags = region_mask[np.clip(row, 0, nrow-1), np.clip(col, 0, ncol-1)].astype(int)
+
+    if fallback:
+        # Points off the ocean regions (coast, land, missing, outside): nearest ocean cell
+        redo = ~inside | (regionFlags < 1) | (regionFlags > 15)
+        if redo.any():
+            _, iNear = oceanTree.query(np.c_[rowf[redo] - 0.5, colf[redo] - 0.5])
+            regionFlags[redo] = region_mask.ravel()[oceanIndex[iNear]]
+
+    return regionFlags
+
+def assignRegionMask(dF, mapProj=None, ancDataPath='../Data/', fallback=False):
     """
     Grab the NSIDC region mask and add to dataframe as a new column
 
@@ -420,33 +765,22 @@ def assignRegionMask(dF, mapProj, ancDataPath='../Data/'):
     # 20   Land
     # 21   Coast
 
+    The lookup is direct index arithmetic on the memory-mapped mask (see lookupRegionMask),
+    from the lon/lat columns projected to the NSIDC polar stereographic grid, so mapProj 
+    is no longer needed.
+
     Args:
         dF (data frame): original data frame
-        mapProj (basemap instance): basemap map projection
+        mapProj (basemap instance): not used, kept for compatibility
+        ancDataPath (string): directory holding sect_fixed_n.msk
+        fallback (flag): use the nearest ocean region for points on land/coast cells
           
     Returns:
-        dF (data frame): data frame including ice type column (1 = multiyear ice, 0 = everything else)
+        dF (data frame): data frame including region flag column
 
     """
-    region_mask, xptsI, yptsI = get_region_mask_sect(ancDataPath, mapProj, xypts_return=1)
 
-    xptsI=xptsI.flatten()
-    yptsI=yptsI.flatten()
-    region_mask=region_mask.flatten()
-
-    #iceTypeGs=[]
-    regionFlags=ma.masked_all((size(dF['freeboard'].values)))
-    for x in range(size(dF['freeboard'].values)):
-        # Find nearest ice type
-        dist=sqrt((xptsI-dF['xpts'].iloc[x])**2+(yptsI-dF['ypts'].iloc[x])**2)
-        index_min = np.argmin(dist)
-        regionFlags[x]=int(region_mask[index_min])
-        
-        # This is what I sometimes do but it appears slower in this case..
-        # I checked and they gave the same answers
-        # iceTypeG2 = griddata((xpts_type, ypts_type), ice_typeT2, (dF['xpts'].iloc[x], dF['ypts'].iloc[x]), method='nearest') 
-        # print(iceTypeG)
-        # iceTypeGs.append(iceTypeG)
+    regionFlags = lookupRegionMask(dF['lon'].values, dF['lat'].values, ancDataPath, fallback=fallback)
 
     dF['region_flag'] = pd.Series(regionFlags, index=dF.index)
 
@@ -455,8 +789,6 @@ def assignRegionMask(dF, mapProj, ancDataPath='../Data/'):
 def get_region_mask_sect(datapath, mplot, xypts_return=0):
     """ Get NSIDC section mask data """
     
-    datatype='uint8'
-    file_mask = datapath+'/sect_fixed_n.msk'
     # 1   non-region oceans
     # 2   Sea of Okhotsk and Japan
     # 3   Bering Sea
@@ -474,16 +806,11 @@ def get_region_mask_sect(datapath, mplot, xypts_return=0):
     # 15   Arctic Ocean
     # 20   Land
     # 21   Coast
-    fd = open(file_mask, 'rb')
-    region_mask = fromfile(file=fd, dtype=datatype)
-    region_mask = reshape(region_mask, [448, 304])
+    region_mask = getAncillaryGrid(datapath, 'sect_fixed_n').raw
 
     #xpts, ypts = mplot(lons_mask, lats_mask)
     if (xypts_return==1):
-        mask_latf = open(datapath+'/psn25lats_v3.dat', 'rb')
-        mask_lonf = open(datapath+'/psn25lons_v3.dat', 'rb')
-        lats_mask = reshape(fromfile(file=mask_latf, dtype='<i4')/100000., [448, 304])
-        lons_mask = reshape(fromfile(file=mask_lonf, dtype='<i4')/100000., [448, 304])
+        lats_mask, lons_mask = get_psnlatslons(datapath, res=25)
 
         xpts, ypts = mplot(lons_mask, lats_mask)
 
@@ -497,23 +824,26 @@ def getProcessedATL10ShotdataNCDF(dataPathT, yearStr='2018', monStr='*', dayStr=
     """
     Load ICESat-2 thickness data produced from the raw ATL10 segment data
     By Alek Petty (June 2019)
+
+    If smoothingWindow>0 the data are coarsened to segment length weighted means
+    over blocks of smoothingWindow segments (see coarsenSegmentWeighted)
         
     """
     
     print(dataPathT+'IS2ATL10*'+yearStr+monStr+dayStr+'*'+'_'+beamStr+'.nc')
     files=glob(dataPathT+'IS2ATL10*'+yearStr+monStr+dayStr+'*'+'_'+beamStr+'.nc')
-    print('Number of files:', size(files))
+    print('Number of files:', np.size(files))
     
     #testFile = Dataset(files[0])
     #print(testFile.variables.keys())
     if (fNum>-0.5):
-        if (size(vars)>0):
+        if (np.size(vars)>0):
             IS2dataAll= xr.open_dataset(files[fNum], engine='h5netcdf', data_vars=vars)
         else:
             IS2dataAll= xr.open_dataset(files[fNum], engine='h5netcdf')
     else:
         # apparently autoclose assumed so no longer need to include the True flag
-        if (size(vars)>0):
+        if (np.size(vars)>0):
             IS2dataAll= xr.open_mfdataset(dataPathT+'/IS2ATL10*'+yearStr+monStr+dayStr+'*'+'_'+beamStr+'.nc', engine='h5netcdf', data_vars=vars, parallel=True)
         else:
             IS2dataAll= xr.open_mfdataset(dataPathT+'/IS2ATL10*'+yearStr+monStr+dayStr+'*'+'_'+beamStr+'.nc', engine='h5netcdf', parallel=True)
@@ -525,34 +855,8 @@ def getProcessedATL10ShotdataNCDF(dataPathT, yearStr='2018', monStr='*', dayStr=
 
 
     if (smoothingWindow>0):
-        # If we want to smooth the datasets
-        seg_length=IS2dataAll['seg_length']
-        
-        seg_weightedvarR=seg_length.rolling(index=smoothingWindow, center=True).mean()
-        seg_weightedvar=seg_weightedvarR[int(smoothingWindow/2):-int(smoothingWindow/2):smoothingWindow]
-       # print(seg_weightedvar)
-
-        seg_weightedvars=[]
-        ds = seg_weightedvar.to_dataset(name = 'seg_length')
-        #seg_weightedvars.append(seg_weightedvar)
-        # Skip the first one as that's always (should be) the seg_length
-        for var in vars[1:]:
-            print('Coarsening'+var+'...')
-            varIS2=IS2dataAll[var]
-            seg_weightedvarR=varIS2*seg_length.rolling(index=smoothingWindow, center=True).sum()/seg_length.rolling(index=smoothingWindow, center=True).sum()
-            seg_weightedvar=seg_weightedvarR[int(smoothingWindow/2):-int(smoothingWindow/2):smoothingWindow] 
-            #print(seg_weightedvar)
-            ds[var] = seg_weightedvar
-
-            #seg_weightedvars.append(seg_weightedvar)
-            print('Coarsened var')
-        #Merge the coarsened arrays
-        #seg_weightedvarsM=xr.merge(seg_weightedvars)
-        ds=ds.reset_index('index', drop=True)
-
-        #print('Rechunking...')
-        #ds=ds.chunk(2000)
-        #print('Rechunked')
+        # If we want to smooth the datasets (length weighted means over blocks of smoothingWindow segments)
+        ds = coarsenSegmentWeighted(IS2dataAll, smoothingWindow, vars=vars[1:])
         print(ds)
         return ds
     else:
@@ -560,6 +864,50 @@ def getProcessedATL10ShotdataNCDF(dataPathT, yearStr='2018', monStr='*', dayStr=
         return IS2dataAll
 
 
+def coarsenSegmentWeighted(ds, window, vars=None, weightVar='seg_length', dim='index'):
+    """
+    Segment length weighted coarsening of along-track (processed ATL10) data
+
+    The weighted sums of all variables are built together as one lazy (dask) graph over
+    the dataset, e.g. the multi-file open_mfdataset result, so the data are read once
+    when the result is computed. Missing values get zero weight. Any trailing partial 
+    block is dropped.
+
+    Args:
+        ds (xarray Dataset): along-track data including the weight variable
+        window (int): number of segments in each block
+        vars (list): variables to coarsen (default all variables along dim except the weights)
+        weightVar (string): segment length variable used as the weights
+        dim (string): along-track dimension
+
+    Returns:
+        dsC (xarray Dataset): window means of the weights (weightVar) and the length
+            weighted window means of vars, along dim (reindexed from 0)
+
+    """
+
+    window = int(window)
+    if (vars is None) or (np.size(vars)==0):
+        vars = [var for var in ds.data_vars if (dim in ds[var].dims) and (var != weightVar)]
+    vars = [var for var in vars if var != weightVar]
+
+    seg_length = ds[weightVar]
+    dsV = ds[vars]
+
+    # Zero weight for missing values, then block sums of weights and weighted values
+    weights = seg_length.where(dsV.notnull())
+    weightSums = weights.coarsen({dim: window}, boundary='trim').sum()
+    valueSums = (dsV*weights).coarsen({dim: window}, boundary='trim').sum()
+
+    dsC = valueSums/weightSums.where(weightSums > 0)
+    dsC[weightVar] = seg_length.coarsen({dim: window}, boundary='trim').mean()
+
+    # Block number as the new index (the coarsened coordinates no longer match the segments)
+    dsC = dsC.reset_coords(drop=True).assign_coords(**{dim: np.arange(dsC.sizes[dim])})
+
+    return dsC[[weightVar]+vars]
+
+
 def getNesosimDates(dF, snowPathT):
     """ Get dates from NESOSIM files"""
 
@@ -577,7 +925,7 @@ def getNesosimDates(dF, snowPathT):
 
     # Find the right NESOSIM data file based on the freeboard dates
     
-    fileNESOSIM = glob(snowPathT+'*'+str(yearS)+'-*'+'.nc')[0]
+    fileNESOSIM = getNesosimFile(snowPathT, yearS)
     #if (monthS>8):
     #fileNESOSIM = glob(snowPathT+'*'+str(yearS)+'-*'+'.nc')[0]
     #else:
@@ -588,82 +936,300 @@ def getNesosimDates(dF, snowPathT):
 
     return fileNESOSIM, dateStr
 
+# NESOSIM file found for each (path, year)
+NESOSIMfileCache = {}
+
+def getNesosimFile(snowPathT, year):
+    """ NESOSIM file for a given year (glob done once per path and year) """
+
+    key = (snowPathT, int(year))
+    if key not in NESOSIMfileCache:
+        NESOSIMfileCache[key] = glob(snowPathT+'*'+str(year)+'-*'+'.nc')[0]
+    return NESOSIMfileCache[key]
+
 def getDate(year, month, day):
     """ Get date string from year month and day"""
 
     return str(year)+'%02d' %month+'%02d' %day
 
-def gridNESOSIMtoFreeboard(dF, mapProj, fileSnow, dateStr, outSnowVar='snowDepthN', outDensityVar='snowDensityN', returnMap=0):
+# Lazily opened NESOSIM datasets (keyed by file) and their projected grids (keyed by file and map projection)
+NESOSIMdatasetCache = {}
+NESOSIMgridCache = {}
+NESOSIMgridCacheSize = 4
+
+# Cache of NESOSIM daily spatial indices, keyed by (file, date, map projection)
+NESOSIMindexCache = {}
+NESOSIMindexCacheSize = 8
+
+def getProjKey(mapProj):
+    """ Definition of a map projection (pyproj Proj or Basemap) to key the NESOSIM caches on
+
+    The proj4 definition, plus the lower left corner that Basemap offsets its coordinates to,
+    so an equivalent projection object shares the cache entries and a different one never does.
+    Other callables key on the object itself (held by the cache, so never confused with a
+    later object, as an id() could be).
+    """
+
+    srs = getattr(mapProj, 'srs', None) or getattr(mapProj, 'proj4string', None)
+    if srs is None:
+        return mapProj
+    return (srs, getattr(mapProj, 'llcrnrx', None), getattr(mapProj, 'llcrnry', None))
+
+def getNESOSIMdataset(fileSnow):
+    """ NESOSIM dataset, opened lazily once per process (a day slice is only read when selected) """
+
+    if fileSnow not in NESOSIMdatasetCache:
+        NESOSIMdatasetCache[fileSnow] = xr.open_dataset(fileSnow)
+    return NESOSIMdatasetCache[fileSnow]
+
+def getNESOSIMgrid(fileSnow, mapProj):
+    """ NESOSIM grid projected with mapProj (and its affine, see getGridAffine), computed once per file """
+
+    key = (fileSnow, getProjKey(mapProj))
+    if key not in NESOSIMgridCache:
+        dN = getNESOSIMdataset(fileSnow)
+        xptsN, yptsN = mapProj(np.array(dN.longitude), np.array(dN.latitude))
+        xptsN = np.asarray(xptsN)
+        yptsN = np.asarray(yptsN)
+        # Evict the oldest grid if the cache is full
+        if len(NESOSIMgridCache) >= NESOSIMgridCacheSize:
+            NESOSIMgridCache.pop(next(iter(NESOSIMgridCache)))
+        NESOSIMgridCache[key] = (xptsN, yptsN, getGridAffine(xptsN, yptsN))
+    return NESOSIMgridCache[key]
+
+def getNESOSIMindex(fileSnow, dateStr, mapProj):
+    """
+    Spatial index of the valid NESOSIM grid cells for one day, cached for reuse across granules
+
+    Only the day slice is read from the (lazily opened) file and the projected grid is shared
+    by all days of the file. Valid cells (same masking as before: 
+    0.01 < snow depth < 1 m, ice concentration > 0.01, finite density) go into a KD-tree 
+    for nearest neighbour queries. If the grid is regular in the map projection, the affine 
+    mapping from x/y to grid index is also stored for bilinear queries.
+
+    Args:
+        fileSnow (string): NESOSIM file path
+        dateStr (string): date string
+        mapProj (basemap instance): Basemap map projection
+
+    Returns:
+        index (dict): day slice (dNday), projected grid (xpts, ypts), valid cell mask,
+            snowDepth/density grids, KD-tree of valid cells and the grid affine (or None)
+
+    Raises:
+        ValueError: if the NESOSIM file has no data for dateStr
+
+    """
+
+    key = (fileSnow, str(dateStr), getProjKey(mapProj))
+    if key in NESOSIMindexCache:
+        return NESOSIMindexCache[key]
+
+    dN = getNESOSIMdataset(fileSnow)
+    if int(dateStr) not in dN['day'].values:
+        raise ValueError('No NESOSIM snow data for '+str(dateStr)+' in '+str(fileSnow))
+    dNday = dN.sel(day=int(dateStr)).load()
+    xptsN, yptsN, affine = getNESOSIMgrid(fileSnow, mapProj)
+
+    snowDepthNDay = np.array(dNday.snowDepth)
+    snowDensityNDay = np.array(dNday.density)
+    iceConcNDay = np.array(dNday.iceConc)
+
+    # Remove data where snow depths less than 0 (masked).
+    valid = (snowDepthNDay>0.01)&(snowDepthNDay<1)&(iceConcNDay>0.01)&np.isfinite(snowDensityNDay)
+
+    index = {'dNday':dNday, 'xpts':xptsN, 'ypts':yptsN, 'valid':valid,
+             'snowDepth':snowDepthNDay, 'density':snowDensityNDay,
+             'validIndex':np.flatnonzero(valid),
+             'tree':cKDTree(np.c_[xptsN[valid], yptsN[valid]]),
+             'affine':affine}
+
+    # Evict the oldest day if the cache is full
+    if len(NESOSIMindexCache) >= NESOSIMindexCacheSize:
+        NESOSIMindexCache.pop(next(iter(NESOSIMindexCache)))
+    NESOSIMindexCache[key] = index
+
+    return index
+
+def getGridAffine(xpts, ypts, tol=1e-3):
+    """
+    Affine mapping from (row, col) grid index to projected x/y, if the grid is regular
+
+    Args:
+        xpts, ypts (var): 2D projected grid coordinates
+        tol (float): maximum misfit, as a fraction of the grid spacing
+
+    Returns:
+        (origin, matrix): x/y = origin + matrix @ (row, col), or None if the grid is not regular
+
+    """
+
+    rows, cols = np.indices(xpts.shape)
+    A = np.c_[np.ones(rows.size), rows.ravel(), cols.ravel()]
+    xy = np.c_[xpts.ravel(), ypts.ravel()]
+    if not np.all(np.isfinite(xy)):
+        return None
+
+    coef = np.linalg.lstsq(A, xy, rcond=None)[0]
+    origin = coef[0]
+    matrix = coef[1:].T
+    spacing = np.min(np.abs(np.linalg.eigvals(matrix)))
+    if spacing == 0 or np.max(np.abs(A.dot(coef) - xy)) > tol*spacing:
+        return None
+
+    return origin, matrix
+
+def queryNESOSIMindex(index, xpts, ypts, method='nearest'):
+    """
+    Snow depth and density from a NESOSIM index (see getNESOSIMindex) at many points at once
+
+    Args:
+        index (dict): NESOSIM spatial index
+        xpts, ypts (var): projected point coordinates
+        method (string): 'nearest' (nearest valid cell) or 'bilinear' (over the valid corner
+            cells of a regular grid, falling back to the nearest valid cell)
+
+    Returns:
+        snowDepth, snowDensity (var): arrays the same size as xpts (nan where xpts or ypts
+            is not finite)
+
+    """
+
+    xpts = np.asarray(xpts, dtype=np.float64)
+    ypts = np.asarray(ypts, dtype=np.float64)
+    snowDepthValid = index['snowDepth'].ravel()[index['validIndex']]
+    densityValid = index['density'].ravel()[index['validIndex']]
+
+    # Points with fill value coordinates get no snow
+    finite = np.isfinite(xpts) & np.isfinite(ypts)
+    snowDepth = np.full(xpts.size, np.nan, dtype=np.promote_types(snowDepthValid.dtype, np.float32))
+    snowDensity = np.full(xpts.size, np.nan, dtype=np.promote_types(densityValid.dtype, np.float32))
+
+    # Nearest valid cell for every (finite) point in one batched query
+    _, iNear = index['tree'].query(np.c_[xpts[finite], ypts[finite]])
+    snowDepth[finite] = snowDepthValid[iNear]
+    snowDensity[finite] = densityValid[iNear]
+
+    if method == 'nearest':
+        return snowDepth, snowDensity
+    elif method != 'bilinear':
+        raise ValueError("method must be 'nearest' or 'bilinear'")
+    if index['affine'] is None:
+        raise ValueError('NESOSIM grid is not regular in this map projection, use nearest')
+
+    # Fractional grid index of each point
+    origin, matrix = index['affine']
+    rc = np.linalg.solve(matrix, np.vstack([np.where(finite, xpts - origin[0], 0.), 
+                                            np.where(finite, ypts - origin[1], 0.)]))
+    nrow, ncol = index['valid'].shape
+    r0 = np.floor(rc[0]).astype(int)
+    c0 = np.floor(rc[1]).astype(int)
+    fr = rc[0] - r0
+    fc = rc[1] - c0
+
+    validFlat = index['valid'].ravel()
+    snowFlat = index['snowDepth'].ravel()
+    densFlat = index['density'].ravel()
+    wSum = np.zeros(xpts.size)
+    snowSum = np.zeros(xpts.size)
+    densSum = np.zeros(xpts.size)
+
+    # Accumulate the four corners, using only valid cells inside the grid
+    for dr, dc, w in [(0, 0, (1-fr)*(1-fc)), (0, 1, (1-fr)*fc), (1, 0, fr*(1-fc)), (1, 1, fr*fc)]:
+        r = r0 + dr
+        c = c0 + dc
+        inside = finite & (r >= 0) & (r < nrow) & (c >= 0) & (c < ncol)
+        flat = np.where(inside, r*ncol + c, 0)
+        use = inside & validFlat[flat]
+        w = np.where(use, w, 0.)
+        wSum += w
+        snowSum += w*np.where(use, snowFlat[flat], 0.)
+        densSum += w*np.where(use, densFlat[flat], 0.)
+
+    ok = wSum > 0
+    snowDepth[ok] = snowSum[ok]/wSum[ok]
+    snowDensity[ok] = densSum[ok]/wSum[ok]
+
+    return snowDepth, snowDensity
+
+def queryNESOSIMbyDay(fileSnow, mapProj, dateStrs, xpts, ypts, method='nearest'):
+    """
+    NESOSIM snow depth and density at points spanning any number of days
+
+    Points are grouped by day and each group is matched against that day's (cached) 
+    spatial index, so each day slice is read and indexed once however the points are ordered.
+    Points of days missing from the file get nan snow (and the day is printed).
+
+    Args:
+        fileSnow (string): NESOSIM file path
+        mapProj (basemap instance): Basemap map projection (or any callable lon, lat -> x, y)
+        dateStrs (var): date (YYYYMMDD, string or integer) of every point
+        xpts, ypts (var): projected point coordinates
+        method (string): 'nearest' or 'bilinear' (see queryNESOSIMindex)
+
+    Returns:
+        snowDepth, snowDensity (var): arrays the same size as xpts
+
+    """
+
+    xpts = np.asarray(xpts)
+    ypts = np.asarray(ypts)
+    days, dayIndex = np.unique(np.asarray(dateStrs).astype(int), return_inverse=True)
+
+    snowDepth = np.full(xpts.size, np.nan)
+    snowDensity = np.full(xpts.size, np.nan)
+    # Row indices of each day
+    order = np.argsort(dayIndex, kind='mergesort')
+    bounds = np.r_[0, np.cumsum(np.bincount(dayIndex, minlength=days.size))]
+    fileDays = getNESOSIMdataset(fileSnow)['day'].values
+    for d, day in enumerate(days):
+        rows = order[bounds[d]:bounds[d+1]]
+        if day not in fileDays:
+            print('No NESOSIM snow data for', day, 'in', fileSnow, '- snow set to nan for', rows.size, 'points')
+            continue
+        index = getNESOSIMindex(fileSnow, str(day), mapProj)
+        snowDepth[rows], snowDensity[rows] = queryNESOSIMindex(index, xpts[rows], ypts[rows], method=method)
+
+    return snowDepth, snowDensity
+
+def gridNESOSIMtoFreeboard(dF, mapProj, fileSnow, dateStr=None, outSnowVar='snowDepthN', outDensityVar='snowDensityN', returnMap=0, method='nearest'):
     """
     Load relevant NESOSIM snow data file and assign to freeboard values
 
+    Uses the cached daily spatial index (getNESOSIMindex), so granules from the same day
+    do not re-open or re-project the NESOSIM grid, and all points are queried at once.
+    With dateStr=None the points are matched to the NESOSIM day of their own date 
+    (year, month, day columns, see queryNESOSIMbyDay), for multi-day data.
+
     Args:
         dF (data frame): Pandas dataframe
         mapProj (basemap instance): Basemap map projection
         fileSnow (string): NESOSIM file path
-        dateStr (string): date string
+        dateStr (string): date string, or None to use the date of each row
         outSnowVar (string): Name of snow depth column
         outDensityVar (string): Name of snow density column
+        method (string): 'nearest' or 'bilinear' (see queryNESOSIMindex)
 
     Returns:
         dF (data frame): dataframe updated to include colocated NESOSIM (and dsitributed) snow data
 
     """
 
-    dN = xr.open_dataset(fileSnow)
+    if dateStr is None:
+        dateStrs = dF['year'].values*10000 + dF['month'].values*100 + dF['day'].values
+        snowDepthGISs, snowDensityGISs = queryNESOSIMbyDay(fileSnow, mapProj, dateStrs, dF['xpts'].values, dF['ypts'].values, method=method)
+        # Map of the first day
+        index = getNESOSIMindex(fileSnow, str(np.min(dateStrs)), mapProj)
+    else:
+        # Get NESOSIM snow depth and density data for that date
+        index = getNESOSIMindex(fileSnow, dateStr, mapProj)
 
-    # Get NESOSIM snow depth and density data for that date
-    # Should move this into the loop if there is a significant date cahgne in the freeboard data.
-    # Not done this to improve processing speed. 
-    dNday = dN.sel(day=int(dateStr))
-    
-    lonsN = array(dNday.longitude)
-    latsN = array(dNday.latitude)
-    xptsN, yptsN = mapProj(lonsN, latsN)
-
-    # Get dates at start and end of freeboard file
-    dateStrStart= getDate(dF['year'].iloc[0], dF['month'].iloc[0], dF['day'].iloc[0])
-    dateStrEnd= getDate(dF['year'].iloc[-1], dF['month'].iloc[-1], dF['day'].iloc[-1])
-    print('Check dates (should be within a day):', dateStr, dateStrStart, dateStrEnd)
-  
-    snowDepthNDay = array(dNday.snowDepth)
-    snowDensityNDay = array(dNday.density)
-    iceConcNDay = array(dNday.iceConc)
-    
-    # Remove data where snow depths less than 0 (masked).
-    # Might need to chek if I need to apply any other masks here.
-    mask=where((snowDepthNDay>0.01)&(snowDepthNDay<1)&(iceConcNDay>0.01)&np.isfinite(snowDensityNDay))
-
-    snowDepthNDay = snowDepthNDay[mask]
-    snowDensityNDay = snowDensityNDay[mask]
-    xptsNDay = xptsN[mask]
-    yptsNDay = yptsN[mask]
-
-    # Load into array, sppeds up later computation and may aid parallelization
-    freeboardsT=dF['freeboard'].values
-    xptsT=dF['xpts'].values
-    yptsT=dF['ypts'].values
-    
-    # I think it's better to declare array now so memory is allocated before the loop?
-    snowDepthGISs=ma.masked_all(size(freeboardsT))
-    snowDensityGISs=ma.masked_all(size(freeboardsT))
-    #snowDepthDists=ma.masked_all(size(freeboardsT))
+        # Get dates at start and end of freeboard file
+        dateStrStart= getDate(dF['year'].iloc[0], dF['month'].iloc[0], dF['day'].iloc[0])
+        dateStrEnd= getDate(dF['year'].iloc[-1], dF['month'].iloc[-1], dF['day'].iloc[-1])
+        print('Check dates (should be within a day):', dateStr, dateStrStart, dateStrEnd)
 
-    #for x in prange(size(freeboardsT)):
-    for x in range(size(freeboardsT)):
-        
-        # Could embed the NESOSIM dates here
-        
-        # Use nearest neighbor to find snow depth at IS2 point
-        #snowDepthGISs[x] = griddata((xptsDay, yptsDay), snowDepthDay, (dF['xpts'].iloc[x], dF['ypts'].iloc[x]), method='nearest') 
-        #snowDensityGISs[x] = griddata((xptsDay, yptsDay), densityDay, (dF['xpts'].iloc[x], dF['ypts'].iloc[x]), method='nearest')
-
-        # Think this is the much faster way to find nearest neighbor!
-        dist = sqrt((xptsNDay-xptsT[x])**2+(yptsNDay-yptsT[x])**2)
-        index_min = np.argmin(dist)
-        snowDepthGISs[x]=snowDepthNDay[index_min]
-        snowDensityGISs[x]=snowDensityNDay[index_min]
-        #print(snowDepthNDay[index_min], densityNDay[index_min])
+        snowDepthGISs, snowDensityGISs = queryNESOSIMindex(index, dF['xpts'].values, dF['ypts'].values, method=method)
         
     dF[outSnowVar] = pd.Series(snowDepthGISs, index=dF.index)
     dF[outDensityVar] = pd.Series(snowDensityGISs, index=dF.index)
@@ -677,20 +1243,107 @@ def gridNESOSIMtoFreeboard(dF, mapProj, fileSnow, dateStr, outSnowVar='snowDepth
     #    snowDepthDists[x] = snowDistribution(snowDepthGISs[x], freeboardsT[x], meanFreeboard)
 
     #dF[outSnowVar+'dist'] = pd.Series(snowDepthDists, index=dF.index)
-
-    #print ('Snow depth (m): ', snowDepthGIS)
-    #print ('Snow density (kg/m3): ', snowDensityGIS)
-    #print ('Snow depth (m): ', snowDepthDists)
     
     if (returnMap==1):
-        return dF, xptsN, yptsN, dNday, 
+        return dF, index['xpts'], index['ypts'], index['dNday'], 
     else:
         return dF
-    
+
+def binSegmentWeighted(x, y, z, seg, xG, yG, binsize=None):
+    """
+    Segment length weighted binning of unevenly spaced 2D data onto a regular grid, 
+    in linear time: each point is assigned to its cell by index arithmetic and the 
+    sums/weights/counts are accumulated with bincount.
+
+    A point belongs to the cell centred on (xc, yc) if |x - xc| < binsize/2 and 
+    |y - yc| < binsize/2, as in bindataSegment. With binsize larger than the grid 
+    spacing the bins overlap and a point counts in every cell it falls in (the few 
+    cells around its nearest one are tested).
+
+    Args:
+        x, y (var): point coordinates (same units as the grid)
+        z (var): values to grid
+        seg (var): segment lengths used as weights
+        xG, yG (var): 2D grid coordinates of the cell centres (e.g. from np.meshgrid or basemap makegrid)
+        binsize (float): full width and height of each bin. Defaults to the grid spacing.
+
+    Returns:
+        binned (dict): with 
+            'grid': segment length weighted mean of each cell (nan where empty)
+            'counts': number of points in each cell
+            'weights': summed segment length of each cell
+            'offsets', 'indices': per-cell membership in CSR form, the indices of the points
+                in flat cell k are indices[offsets[k]:offsets[k+1]] (in ascending order)
+
+    """
+
+    x = np.asarray(x)
+    y = np.asarray(y)
+    z = np.asarray(z)
+    seg = np.asarray(seg)
+
+    # Cell centre coordinates along each axis (regular grid)
+    xi = np.asarray(xG)[0]
+    yi = np.asarray(yG)[:, 0]
+    nrow, ncol = yi.size, xi.size
+    dx = xi[1] - xi[0] if ncol > 1 else binsize
+    dy = yi[1] - yi[0] if nrow > 1 else binsize
+    if (dx is None) or (dy is None):
+        raise ValueError('binsize is needed for a grid with a single row or column')
+    if binsize is None:
+        binsize = abs(dx)
+
+    # Nearest cell centre of each point
+    with np.errstate(invalid='ignore'):
+        col0 = np.rint((x - xi[0])/dx)
+        row0 = np.rint((y - yi[0])/dy)
+    finite = np.isfinite(col0) & np.isfinite(row0)
+    col0 = np.where(finite, col0, 0).astype(int)
+    row0 = np.where(finite, row0, 0).astype(int)
+
+    # Cells within binsize/2 can be this many cells from the nearest one (0 without overlap)
+    mx = int(np.ceil(binsize/(2.*abs(dx)) + 0.5)) - 1
+    my = int(np.ceil(binsize/(2.*abs(dy)) + 0.5)) - 1
+
+    # Exact bin test on each candidate cell
+    indices, cell = [], []
+    for oy in range(-my, my+1):
+        for ox in range(-mx, mx+1):
+            col = col0 + ox
+            row = row0 + oy
+            inside = finite & (col >= 0) & (col < ncol) & (row >= 0) & (row < nrow)
+            col = np.where(inside, col, 0)
+            row = np.where(inside, row, 0)
+            member = np.flatnonzero(inside & (np.abs(x - xi[col]) < binsize/2.) & (np.abs(y - yi[row]) < binsize/2.))
+            indices.append(member)
+            cell.append(row[member]*ncol + col[member])
+    indices = np.concatenate(indices)
+    cell = np.concatenate(cell)
+
+    ncell = nrow*ncol
+    counts = np.bincount(cell, minlength=ncell)
+    weights = np.bincount(cell, weights=seg[indices], minlength=ncell)
+    sums = np.bincount(cell, weights=z[indices]*seg[indices], minlength=ncell)
+
+    grid = np.full(ncell, np.nan, dtype=np.result_type(x.dtype, np.float32))
+    filled = counts > 0
+    with np.errstate(invalid='ignore', divide='ignore'):
+        grid[filled] = sums[filled]/weights[filled]
+
+    # CSR membership (points in ascending order within each cell)
+    indices = indices[np.lexsort((indices, cell))]
+    offsets = np.zeros(ncell + 1, dtype=int)
+    np.cumsum(counts, out=offsets[1:])
+
+    return {'grid': grid.reshape(nrow, ncol), 'counts': counts.reshape(nrow, ncol), 
+            'weights': weights.reshape(nrow, ncol), 'offsets': offsets, 'indices': indices}
+
 def bindataSegment(x, y, z, seg, xG, yG, binsize=0.01, retbin=True, retloc=True):
     """
     Place unevenly spaced 2D data on a grid by 2D binning (nearest
     neighbor interpolation) and weight using the IS2 segment lengths.
+
+    Wrapper of binSegmentWeighted, kept for the original call signature.
     
     Parameters
     ----------
@@ -716,8 +1369,8 @@ def bindataSegment(x, y, z, seg, xG, yG, binsize=0.01, retbin=True, retloc=True)
     Returns
     -------
     grid : ndarray (2D)
-        The evenly gridded data.  The value of each cell is the median
-        value of the contents of the bin.
+        The evenly gridded data.  The value of each cell is the segment
+        length weighted mean of the contents of the bin.
     bins : ndarray (2D)
         A grid the same shape as `grid`, except the value of each cell
         is the number of points in that bin.  Returns only if
@@ -725,53 +1378,23 @@ def bindataSegment(x, y, z, seg, xG, yG, binsize=0.01, retbin=True, retloc=True)
     wherebin : list (2D)
         A 2D list the same shape as `grid` and `bins` where each cell
         contains the indicies of `z` which contain the values stored
-        in the particular bin.
+        in the particular bin. Use binSegmentWeighted for the same
+        information as flat offsets/indices arrays.
 
     Revisions
     ---------
     2010-07-11  ccampo  Initial version
     """
-    # get extrema values.
-    xmin, xmax = xG.min(), xG.max()
-    ymin, ymax = yG.min(), yG.max()
-
-    # make coordinate arrays.
-    xi      = xG[0]
-    yi      = yG[:, 0] #np.arange(ymin, ymax+binsize, binsize)
-    xi, yi = np.meshgrid(xi,yi)
 
-    # make the grid.
-    grid           = np.zeros(xi.shape, dtype=x.dtype)
-    nrow, ncol = grid.shape
-    if retbin: bins = np.copy(grid)
+    binned = binSegmentWeighted(x, y, z, seg, xG, yG, binsize=binsize)
+    grid = binned['grid'].astype(np.asarray(x).dtype)
+    bins = binned['counts'].astype(grid.dtype)
 
-    # create list in same shape as grid to store indices
     if retloc:
-        wherebin = np.copy(grid)
-        wherebin = wherebin.tolist()
-
-    # fill in the grid.
-    for row in prange(nrow):
-        for col in prange(ncol):
-            xc = xi[row, col]    # x coordinate.
-            yc = yi[row, col]    # y coordinate.
-
-            # find the position that xc and yc correspond to.
-            posx = np.abs(x - xc)
-            posy = np.abs(y - yc)
-            ibin = np.logical_and(posx < binsize/2., posy < binsize/2.)
-            ind  = np.where(ibin == True)[0]
-
-            # fill the bin.
-            bin = z[ibin]
-            segbin = seg[ibin]
-            if retloc: wherebin[row][col] = ind
-            if retbin: bins[row, col] = bin.size
-            if bin.size != 0:
-                binvalseg         = np.sum(bin*segbin)/np.sum(segbin)
-                grid[row, col] = binvalseg
-            else:
-                grid[row, col] = np.nan   # fill empty bins with nans.
+        nrow, ncol = grid.shape
+        offsets, indices = binned['offsets'], binned['indices']
+        wherebin = [[indices[offsets[row*ncol + col]:offsets[row*ncol + col + 1]] 
+            for col in range(ncol)] for row in range(nrow)]
 
     # return the grid
     if retbin: